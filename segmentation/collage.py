@@ -0,0 +1,234 @@
+"""Generates many collages of cutouts in parallel, for building datasets.
+
+Each canvas gets its own random generator, derived from a master seed and the
+canvas index, so the collages don't depend on the number of workers or on the
+order in which they finish. The positions of the placed cutouts are written to
+`collages.jsonl` next to the images.
+"""
+
+import argparse
+import functools
+import json
+import multiprocessing
+from pathlib import Path
+import time
+from typing import Literal
+
+import numpy as np
+import tqdm.auto
+from pydantic import BaseModel
+
+from segmentation.loading import DATA_DIR, list_images, open_image
+from segmentation.placement import CANVAS_SIZE, Canvas, propose_random_positions
+
+COLLAGES_DIR = DATA_DIR / "collages"
+METADATA_FILENAME = "collages.jsonl"
+
+
+class CollageConfig(BaseModel):
+    canvas_size: tuple[int, int] = CANVAS_SIZE
+    n_cutouts: int = 50
+    # "greedy" takes the first free one of `n_attempts` random positions,
+    # "tightest" the tightest of all free positions.
+    strategy: Literal["greedy", "tightest"] = "tightest"
+    n_attempts: int = 100
+    scale: float = 0.5
+    # After this many cutouts in a row that don't fit, the scale is reduced.
+    max_consecutive_failures: int = 100
+    scale_decay: float = 0.9
+    min_scale: float = 0.05
+
+
+def get_collage_name(canvas_index: int) -> str:
+    return f"collage-{canvas_index:06d}.png"
+
+
+def get_rng(seed: int, canvas_index: int) -> np.random.Generator:
+    return np.random.default_rng(
+        np.random.SeedSequence(seed, spawn_key=(canvas_index,))
+    )
+
+
+def make_collage(
+    names: list[str],
+    input_dir: Path,
+    config: CollageConfig,
+    rng: np.random.Generator,
+) -> tuple[Canvas, list[dict]]:
+    """Places random cutouts until there are `config.n_cutouts` of them or
+    even the smallest scale doesn't fit.
+
+    Returns the canvas and the name, position and size of each placed cutout.
+    """
+    canvas = Canvas(config.canvas_size)
+    placements = []
+    scale = config.scale
+    n_consecutive_failures = 0
+
+    while len(placements) < config.n_cutouts and scale >= config.min_scale:
+        name = names[rng.integers(len(names))]
+        cutout = open_image(input_dir, name).convert("RGBA")
+        # crop to content
+        cutout = cutout.crop(cutout.getbbox())
+        size = (max(1, int(cutout.width * scale)), max(1, int(cutout.height * scale)))
+        cutout = cutout.resize(size)
+
+        if config.strategy == "tightest":
+            position = canvas.place_tightest(cutout)
+        else:
+            position = canvas.place_greedily(
+                propose_random_positions(
+                    cutout, canvas.size, attempts=config.n_attempts, rng=rng
+                )
+            )
+
+        if position is not None:
+            x, y = position
+            placements.append(
+                {"name": name, "position": [int(x), int(y)], "size": size}
+            )
+            n_consecutive_failures = 0
+        else:
+            n_consecutive_failures += 1
+            if n_consecutive_failures > config.max_consecutive_failures:
+                scale *= config.scale_decay
+                n_consecutive_failures = 0
+
+    return canvas, placements
+
+
+# Set in each worker process by `init_worker`, so that the list of names is
+# sent to each worker once rather than with every canvas.
+worker_names = None
+
+
+def init_worker(names: list[str]):
+    global worker_names
+    worker_names = names
+
+
+def make_and_save_collage(
+    canvas_index: int,
+    input_dir: Path,
+    output_dir: Path,
+    config: CollageConfig,
+    seed: int,
+) -> dict:
+    canvas, placements = make_collage(
+        worker_names, input_dir, config, get_rng(seed, canvas_index)
+    )
+    name = get_collage_name(canvas_index)
+    canvas.to_image().save(output_dir / name)
+
+    return {
+        "canvas_index": canvas_index,
+        "image": name,
+        "seed": seed,
+        "placements": placements,
+    }
+
+
+def get_done(output_dir: Path, seed: int) -> set[int]:
+    """Returns the indices of the canvases already generated into the directory.
+
+    Raises a ValueError if they were generated from a different master seed,
+    since a mix of both would be neither.
+    """
+    metadata_path = output_dir / METADATA_FILENAME
+    if not metadata_path.exists():
+        return set()
+
+    done = set()
+    with open(metadata_path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by a crash
+                continue
+
+            if result["seed"] != seed:
+                raise ValueError(
+                    f"The collages in {output_dir} were generated with seed "
+                    f"{result['seed']}, not {seed}"
+                )
+            done.add(result["canvas_index"])
+    return done
+
+
+def main(
+    input_dir: Path = DATA_DIR / "cutouts2",
+    output_dir: Path = COLLAGES_DIR,
+    n_canvases: int = 1000,
+    seed: int = 0,
+    config: CollageConfig | None = None,
+    n_workers: int | None = None,
+):
+    config = config or CollageConfig()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    names = list_images(input_dir)
+    if not names:
+        raise ValueError(f"No cutouts found in {input_dir}")
+
+    done = get_done(output_dir, seed)
+    canvas_indices = [i for i in range(n_canvases) if i not in done]
+
+    f = functools.partial(
+        make_and_save_collage,
+        input_dir=input_dir,
+        output_dir=output_dir,
+        config=config,
+        seed=seed,
+    )
+    start = time.perf_counter()
+
+    with (
+        multiprocessing.Pool(
+            n_workers, initializer=init_worker, initargs=(names,)
+        ) as pool,
+        open(output_dir / METADATA_FILENAME, "a") as metadata_file,
+    ):
+        for result in tqdm.auto.tqdm(
+            pool.imap_unordered(f, canvas_indices), total=len(canvas_indices)
+        ):
+            metadata_file.write(json.dumps(result) + "\n")
+            metadata_file.flush()
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Generated {len(canvas_indices)} collages in {elapsed:.1f} s, "
+        f"{len(canvas_indices) / elapsed:.2f} canvases/s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates collages of cutouts")
+    parser.add_argument("--input-dir", "-i", type=Path, default=DATA_DIR / "cutouts2")
+    parser.add_argument("--output-dir", "-o", type=Path, default=COLLAGES_DIR)
+    parser.add_argument("--n-canvases", type=int, default=1000)
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Master seed, the same one gives the same collages",
+    )
+    parser.add_argument("--n-cutouts", type=int, default=50, help="Per canvas")
+    parser.add_argument(
+        "--strategy", choices=["greedy", "tightest"], default="tightest"
+    )
+    parser.add_argument("--scale", type=float, default=0.5)
+    parser.add_argument(
+        "--n-workers", type=int, default=None, help="Default is the number of CPUs"
+    )
+    args = parser.parse_args()
+
+    main(
+        input_dir=args.input_dir,
+        output_dir=args.output_dir,
+        n_canvases=args.n_canvases,
+        seed=args.seed,
+        config=CollageConfig(
+            n_cutouts=args.n_cutouts, strategy=args.strategy, scale=args.scale
+        ),
+        n_workers=args.n_workers,
+    )
@@ -1,3 +1,13 @@
+import argparse
+import functools
+import hashlib
+import itertools
+import math
+import multiprocessing
+from pathlib import Path
+from typing import Callable, Sequence
+
+from bayes_opt import BayesianOptimization
 import diskcache
 
 from PIL.Image import Image as ImageType
@@ -6,6 +16,7 @@ import numpy as np
 import tqdm.auto
 
 from segmentation.loading import DATA_DIR, images_in_dir
+from segmentation.mask_store import open_mask_store
 from segmentation.optimization import select_best
 from segmentation.placement import to_mask
 
@@ -16,7 +27,7 @@ ESCHER_CACHE_DIR = DATA_DIR / "escher" / "cache"
 ESCHER_IMAGES_DIR = DATA_DIR / "escher" / "images"
 
 
-def is_reasonable(image: ImageType) -> bool:
+def is_reasonable(image: ImageType | np.ndarray) -> bool:
     return 0.1 < to_mask(image).mean() < 0.95
 
 
@@ -34,12 +45,16 @@ class TilingConfig(BaseModel):
     delta2: tuple[int, int]
 
 
+# The multiples of delta1 and delta2 used when tiling.
+TILE_RANGE = range(-20, 20)
+
+
 def place_tiled(canvas: ImageType, reference_image: ImageType, config: TilingConfig):
     dx1, dy1 = config.delta1
     dx2, dy2 = config.delta2
 
-    for i in range(-20, 20):
-        for j in range(-20, 20):
+    for i in TILE_RANGE:
+        for j in TILE_RANGE:
             # skip if the image would be completely out of bounds
             x, y = (i * dx1 + j * dx2, i * dy1 + j * dy2)
             if x + reference_image.width < 0 or y + reference_image.height < 0:
@@ -57,11 +72,15 @@ def place_tiled(canvas: ImageType, reference_image: ImageType, config: TilingCon
     return canvas
 
 
-def score_tiling(
+def score_tiling_composited(
     canvas: ImageType,
     reference_image: ImageType,
     config: TilingConfig,
-) -> list[float]:
+) -> float:
+    """Reference implementation of `score_tiling` that actually composites the tiles.
+
+    Much slower, kept for cross-checking `TilingScorer`.
+    """
     reference_image_1 = set_alpha_to_1(reference_image)
     canvas = place_tiled(canvas, reference_image_1, config)
     alpha = np.array(canvas)[..., 3]
@@ -75,67 +94,655 @@ def score_tiling(
     return frac_exact - frac_overlap
 
 
-def iter_deltas():
-    for dx in range(0, 256, 32):
-        for dy in range(0, 256, 32):
+def mask_to_runs(mask: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Run-length encodes a boolean mask row by row.
+
+    Returns:
+        arrays (ys, x_starts, x_ends) with one entry per horizontal run of
+        True pixels, the run covering mask[y, x_start:x_end].
+    """
+    padded = np.pad(mask.astype(np.int8), ((0, 0), (1, 1)))
+    ys, xs = np.nonzero(np.diff(padded, axis=1))
+    # Changes come in (start, end) pairs within each row.
+    return ys[::2], xs[::2], xs[1::2]
+
+
+def get_lattice_basis(config: TilingConfig) -> tuple[int, int, int] | None:
+    """Returns the Hermite normal form (n1, n2, s) of the tiling lattice.
+
+    The lattice generated by delta1 and delta2 is also generated by (n1, 0) and
+    (s, n2) with n1 * n2 = |det| and 0 <= s < n1. Each pixel (x, y) is then
+    equivalent to exactly one pixel of the n1 x n2 fundamental domain.
+    Returns None if the deltas are collinear.
+    """
+    (a, b), (c, d) = config.delta1, config.delta2
+    det = a * d - b * c
+    if det == 0:
+        return None
+
+    # Extended Euclid for p * b + q * d == gcd(b, d), where b and d are the
+    # y-components of the deltas.
+    old_r, r, old_p, p, old_q, q = b, d, 1, 0, 0, 1
+    while r != 0:
+        k = old_r // r
+        old_r, r = r, old_r - k * r
+        old_p, p = p, old_p - k * p
+        old_q, q = q, old_q - k * q
+    if old_r < 0:
+        old_r, old_p, old_q = -old_r, -old_p, -old_q
+
+    n2 = old_r
+    n1 = abs(det) // n2
+    s = (old_p * a + old_q * c) % n1
+    return n1, n2, s
+
+
+def fold_runs(
+    runs: tuple[np.ndarray, np.ndarray, np.ndarray], bases: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Folds the runs onto the fundamental domains of several lattices at once.
+
+    `bases` has one row (n1, n2, s) per lattice (see `get_lattice_basis`), and
+    classes of a fundamental domain are indexed by their row yr and column xr.
+    Rather than dense histograms, returns events (rows, columns, deltas) with
+    one row per lattice: the number of pixels in a class is the sum of the
+    deltas of all events at or before it in row-major order. Events never go
+    past (n2, 0), and events at (yr, n1) are at (yr + 1, 0) too.
+    """
+    n1, n2, s = bases.T[:, :, None]
+    ys, x_starts, x_ends = runs
+
+    ty, yr = np.divmod(ys, n2)
+    n_full, n_rest = np.divmod(x_ends - x_starts, n1)
+    # The rest of a run is an arc of classes in its row of the domain, which
+    # can wrap around the end of the row.
+    starts = (x_starts - ty * s) % n1
+    ends = starts + n_rest
+    wraps = ends > n1
+    ends -= n1 * wraps
+
+    # Full periods hit every class in the row. So does a wrapped arc, minus
+    # the classes between its end and its start. Rows past n2 are padding.
+    n_lattices, max_n2 = len(bases), n2.max()
+    bins = np.arange(n_lattices)[:, None] * max_n2 + yr
+    row_counts = np.bincount(
+        bins.ravel(), weights=(n_full + wraps).ravel(), minlength=n_lattices * max_n2
+    ).reshape(n_lattices, max_n2)
+    row_starts = np.minimum(np.arange(max_n2), n2)
+    ones = np.ones_like(starts)
+
+    rows = np.concatenate([yr, yr, row_starts], axis=1)
+    columns = np.concatenate([starts, ends, np.zeros_like(row_starts)], axis=1)
+    deltas = np.concatenate(
+        [ones, -ones, np.diff(row_counts, axis=1, prepend=0).astype(int)], axis=1
+    )
+    return rows, columns, deltas
+
+
+def count_canvas_before(
+    canvas_size: tuple[int, int],
+    bases: np.ndarray,
+    rows: np.ndarray,
+    columns: np.ndarray,
+) -> np.ndarray:
+    """Counts the pixels of a full canvas that fold into the classes before the
+    classes of some events, like those of `fold_runs`.
+
+    Each canvas row is a run of the full width, so instead of folding all of
+    them, the counts are worked out per row of the fundamental domain. The
+    canvas rows ty * n2 + yr start at column (-ty * s) % n1 of domain row yr,
+    whatever yr is.
+    """
+    n1, n2, s = bases.T
+    width, height = canvas_size
+    n_full, n_rest = np.divmod(width, n1)
+    n_tiles, n_extra_rows = np.divmod(height, n2)
+
+    # The canvas rows of all lattices at once, up to ty = n_tiles, which only
+    # the first n_extra_rows domain rows have. Each covers the whole domain
+    # row n_full times plus an arc of n_rest classes. An arc ending past n1
+    # wraps around to 0, so it covers the whole row once more, minus the
+    # classes between its end and its start.
+    n_rows = n_tiles + 1
+    lattices = np.repeat(np.arange(len(bases)), n_rows)
+    ty = np.arange(len(lattices)) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+    row_n1 = n1[lattices]
+    arc_starts = (-ty * s[lattices]) % row_n1
+    arc_ends = arc_starts + n_rest[lattices]
+    wraps = arc_ends > row_n1
+    arc_ends -= row_n1 * wraps
+    n_whole = n_full[lattices] + wraps
+
+    # How many pixels of the rows fall into each class of a domain row, and
+    # into the classes before it, in one table per lattice for the rows before
+    # n_tiles and one for the row n_tiles
+    table_lengths = n1 + 1
+    table_starts = 2 * (np.cumsum(table_lengths) - table_lengths)
+    tables = table_starts[lattices] + table_lengths[lattices] * (
+        ty == n_tiles[lattices]
+    )
+    ones = np.ones_like(n_whole)
+    n_covering = np.cumsum(
+        np.bincount(
+            np.concatenate(
+                [tables, tables + row_n1, tables + arc_starts, tables + arc_ends]
+            ),
+            weights=np.concatenate([n_whole, -n_whole, ones, -ones]),
+            minlength=2 * table_lengths.sum(),
+        )
+    )
+    n_before = np.concatenate([[0], np.cumsum(n_covering).astype(int)])
+
+    table_starts = table_starts[:, None]
+    extra_table_starts = table_starts + table_lengths[:, None]
+    n_rows_before = rows * n_tiles[:, None] + np.minimum(rows, n_extra_rows[:, None])
+    # Domain rows before n_extra_rows have the extra row n_tiles.
+    has_extra_row = rows < n_extra_rows[:, None]
+    return (
+        n_rows_before * width
+        + n_before[table_starts + columns]
+        - n_before[table_starts]
+        + has_extra_row
+        * (n_before[extra_table_starts + columns] - n_before[extra_table_starts])
+    )
+
+
+def is_within_tile_range(
+    config: TilingConfig,
+    canvas_size: tuple[int, int],
+    tile_bbox: tuple[int, int, int, int],
+) -> bool:
+    """Checks that every tile that can reach the canvas is placed by `place_tiled`.
+
+    `place_tiled` only uses the multiples in `TILE_RANGE`, so for lattices that
+    are very skewed relative to the canvas, some tiles are missing.
+    `tile_bbox` is the bounding box of the tile's content as (left, top, right,
+    bottom), like `Image.getbbox()` returns it.
+    """
+    (a, b), (c, d) = config.delta1, config.delta2
+    det = a * d - b * c
+    width, height = canvas_size
+    left, top, right, bottom = tile_bbox
+
+    # Tiles with an offset outside of this box cannot overlap the canvas.
+    x0, x1 = 1 - right, width - 1 - left
+    y0, y1 = 1 - bottom, height - 1 - top
+
+    # The range of the multiples i and j of the box' corners, as the range
+    # of the numerators of Cramer's rule
+    for u, v in [(d, -c), (-b, a)]:
+        low = min(u * x0, u * x1) + min(v * y0, v * y1)
+        high = max(u * x0, u * x1) + max(v * y0, v * y1)
+        if det < 0:
+            low, high = high, low
+        if (
+            math.ceil(low / det) < TILE_RANGE.start
+            or math.floor(high / det) >= TILE_RANGE.stop
+        ):
+            return False
+
+    return True
+
+
+class TilingScorer:
+    """Computes `score_tiling` for one canvas and reference image and many configs.
+
+    Instead of compositing the tiles, the reference mask is folded onto the
+    fundamental domain of the tiling lattice and the coverage counts are read
+    off from there, which is orders of magnitude faster. Configs the folding
+    doesn't cover are scored from the runs of the tiles. Most of the time of
+    a single config goes to the overhead of NumPy calls, so use `score_batch`
+    for many configs.
+    """
+
+    def __init__(self, canvas: ImageType, reference_image: ImageType | np.ndarray):
+        """`reference_image` can also be just its boolean alpha mask."""
+        self.canvas_size = canvas.size
+        self.canvas_counts = np.minimum(np.array(canvas.convert("RGBA"))[..., 3], 2)
+        self.is_canvas_empty = not self.canvas_counts.any()
+        # Where the canvas content starts and ends in each row, like the tile
+        # runs in `_score_explicitly`
+        self.canvas_changes = np.diff(
+            self.canvas_counts.astype(int), axis=1, prepend=0, append=0
+        ).ravel()
+
+        if isinstance(reference_image, np.ndarray):
+            mask = to_mask(reference_image)
+        else:
+            mask = to_mask(reference_image.convert("RGBA"))
+        self.mask_runs = mask_to_runs(mask)
+        self.tile_bbox = Image.fromarray(mask).getbbox() or (0, 0, 0, 0)
+
+        # The multiples of delta1 and delta2 of the tiles `place_tiled` places
+        i, j = np.meshgrid(TILE_RANGE, TILE_RANGE, indexing="ij")
+        self.tile_multiples = i.ravel(), j.ravel()
+
+    def __call__(self, config: TilingConfig) -> float:
+        return self.score_batch([config])[0]
+
+    def score_batch(self, configs: Sequence[TilingConfig]) -> list[float]:
+        """Scores several configs at once, which spreads the overhead of the
+        NumPy calls over them. Can be passed to `select_best` with `batched`."""
+        scores = [0.0] * len(configs)
+        folded_indices, bases = [], []
+
+        for i, config in enumerate(configs):
+            basis = get_lattice_basis(config)
+            if (
+                basis is None
+                or not self.is_canvas_empty
+                or not is_within_tile_range(config, self.canvas_size, self.tile_bbox)
+            ):
+                scores[i] = self._score_explicitly(config)
+            else:
+                folded_indices.append(i)
+                bases.append(basis)
+
+        if bases:
+            folded_scores = self._score_folded(np.array(bases)).tolist()
+            for i, score in zip(folded_indices, folded_scores):
+                scores[i] = score
+
+        return scores
+
+    def _score_folded(self, bases: np.ndarray) -> np.ndarray:
+        # Sweep over the classes of each fundamental domain, keeping track of
+        # how many mask pixels fall into the current class. The canvas is
+        # full, so how many of its pixels fall between the events is known
+        # without folding it.
+        rows, columns, deltas = fold_runs(self.mask_runs, bases)
+        # Sorting the events is faster with all of them packed into one number
+        # than with `np.argsort`. The deltas are much smaller than 2**31.
+        n_column_bits = int(bases[:, 0].max()).bit_length()
+        events = np.sort(
+            (((rows << n_column_bits) + columns) << 32) + (deltas + 2**31), axis=1
+        )
+        mask_counts = np.cumsum((events & (2**32 - 1)) - 2**31, axis=1)
+        classes = events >> 32
+        # The end of the domain, up to which the last count holds
+        rows = np.concatenate([classes >> n_column_bits, bases[:, 1:2]], axis=1)
+        columns = np.concatenate(
+            [classes & ((1 << n_column_bits) - 1), 0 * bases[:, 1:2]], axis=1
+        )
+        covered = np.diff(count_canvas_before(self.canvas_size, bases, rows, columns))
+
+        n_exact = (covered * (mask_counts == 1)).sum(axis=1)
+        n_overlap = (covered * (mask_counts > 1)).sum(axis=1)
+        n_pixels = self.canvas_counts.size
+
+        # Divide separately to be bit-for-bit identical to `np.mean`.
+        return n_exact / n_pixels - n_overlap / n_pixels
+
+    def _score_explicitly(self, config: TilingConfig) -> float:
+        """Scores the tiles `place_tiled` places one by one, for the cases the
+        folding doesn't cover.
+
+        The original canvas content counts as 1 if its alpha is 1 and as 2 for
+        larger alphas, because that's how it behaves when compositing.
+        """
+        width, height = self.canvas_size
+        left, top, right, bottom = self.tile_bbox
+
+        i, j = self.tile_multiples
+        xs = i * config.delta1[0] + j * config.delta2[0]
+        ys = i * config.delta1[1] + j * config.delta2[1]
+        overlaps = (
+            (xs + right > 0)
+            & (xs + left < width)
+            & (ys + bottom > 0)
+            & (ys + top < height)
+        )
+        xs, ys = xs[overlaps, None], ys[overlaps, None]
+
+        # The runs of all tiles at once, one row per tile. The rows are shifted
+        # by one, so that runs outside of the canvas can go to an extra row on
+        # either side of it, and the runs are clipped to the canvas columns.
+        # That way nothing needs to be filtered out. A clipped run can be
+        # empty, but then its start and end cancel out.
+        run_ys, run_starts, run_ends = self.mask_runs
+        rows = np.clip(ys + 1 + run_ys, 0, height + 1) * (width + 1)
+        starts = np.clip(xs + run_starts, 0, width) + rows
+        ends = np.clip(xs + run_ends, 0, width) + rows
+
+        # How the coverage changes at each pixel of the canvas rows, with an
+        # extra pixel at the end of each row where all runs have ended.
+        # Counting the run ends per pixel sorts them without a sort.
+        n_bins = height * (width + 1)
+        n_bins_used = n_bins + 2 * (width + 1)
+        changes = (
+            np.bincount(starts.ravel(), minlength=n_bins_used)
+            - np.bincount(ends.ravel(), minlength=n_bins_used)
+        )[width + 1 : n_bins + width + 1]
+        if not self.is_canvas_empty:
+            changes += self.canvas_changes
+
+        # Sweep over the changes only, the coverage is constant in between.
+        positions = np.flatnonzero(changes != 0)
+        counts = np.cumsum(changes[positions])
+        lengths = np.diff(positions, append=n_bins)
+        n_exact = lengths[counts == 1].sum()
+        n_overlap = lengths[counts > 1].sum()
+        n_pixels = width * height
+
+        # Divide separately to be bit-for-bit identical to `np.mean`.
+        return n_exact / n_pixels - n_overlap / n_pixels
+
+
+def score_tiling(
+    canvas: ImageType,
+    reference_image: ImageType,
+    config: TilingConfig,
+) -> float:
+    """Scores how well the tiling covers the canvas exactly once.
+
+    When scoring many configs for the same image, use `TilingScorer` directly
+    to avoid repeating the preprocessing.
+    """
+    return TilingScorer(canvas, reference_image)(config)
+
+
+# Both coordinates of the deltas are searched in range(0, DELTA_LIMIT).
+DELTA_LIMIT = 256
+
+
+def iter_deltas(step: int = 32):
+    for dx in range(0, DELTA_LIMIT, step):
+        for dy in range(0, DELTA_LIMIT, step):
             yield (dx, dy)
 
 
-def iter_configs():
-    for delta1 in iter_deltas():
-        for delta2 in iter_deltas():
+def iter_configs(step: int = 32):
+    for delta1 in iter_deltas(step):
+        for delta2 in iter_deltas(step):
             # check that delta2 is "on the right" of delta1 to reduce duplicates
             if delta1[0] * delta2[1] - delta1[1] * delta2[0] < 0:
                 yield TilingConfig(delta1=delta1, delta2=delta2)
 
 
-def main():
-    cache = diskcache.Cache(directory=ESCHER_CACHE_DIR)
-    canvas = Image.new("RGBA", (256, 256), 0)
+class SearchTracker:
+    """Wraps a scoring function, caching the scores and keeping track of the best."""
+
+    def __init__(self, scoring_fn: Callable[[TilingConfig], float]):
+        self.scoring_fn = scoring_fn
+        self.scores: dict[tuple[tuple[int, int], tuple[int, int]], float] = {}
+        self.best_config: TilingConfig | None = None
+        self.best_score = -np.inf
+
+    @property
+    def n_evaluations(self) -> int:
+        return len(self.scores)
+
+    def __call__(self, config: TilingConfig) -> float:
+        key = (config.delta1, config.delta2)
+        if key not in self.scores:
+            score = self.scoring_fn(config)
+            self.scores[key] = score
+            if score > self.best_score:
+                self.best_config = config
+                self.best_score = score
+
+        return self.scores[key]
+
+    def get_top_configs(self, k: int) -> list[tuple[TilingConfig, float]]:
+        top = sorted(self.scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [
+            (TilingConfig(delta1=delta1, delta2=delta2), score)
+            for (delta1, delta2), score in top
+        ]
+
+
+def search_exhaustive(
+    scoring_fn: Callable[[TilingConfig], float], budget: int, step: int = 32
+) -> tuple[TilingConfig, float]:
+    """Tries the configs of `iter_configs` in order until the budget runs out."""
+    configs = itertools.islice(iter_configs(step), budget)
+    # A `TilingScorer` is much faster on whole batches.
+    score_batch = getattr(scoring_fn, "score_batch", None)
+    if score_batch is not None:
+        return select_best(configs, score_batch, batched=True)
+    return select_best(configs, scoring_fn)
+
+
+def iter_neighbors(config: TilingConfig, step: int):
+    """Yields the configs that differ from `config` by `step` in one coordinate."""
+    coords = [*config.delta1, *config.delta2]
+
+    for i in range(len(coords)):
+        for sign in [-1, 1]:
+            neighbor = coords.copy()
+            neighbor[i] += sign * step
+            if 0 <= neighbor[i] < DELTA_LIMIT:
+                yield TilingConfig(delta1=neighbor[:2], delta2=neighbor[2:])
+
+
+def refine_config(
+    tracker: SearchTracker,
+    config: TilingConfig,
+    score: float,
+    step: int,
+    max_evaluations: int,
+) -> tuple[TilingConfig, float]:
+    """Compass search: moves to better neighbors, halving the step when there are none."""
+    while step >= 1:
+        improved = False
+
+        for neighbor in iter_neighbors(config, step):
+            if tracker.n_evaluations >= max_evaluations:
+                return config, score
+
+            neighbor_score = tracker(neighbor)
+            if neighbor_score > score:
+                config, score = neighbor, neighbor_score
+                improved = True
+
+        if not improved:
+            step //= 2
+
+    return config, score
+
+
+def search_coarse_to_fine(
+    scoring_fn: Callable[[TilingConfig], float],
+    budget: int,
+    coarse_step: int = 64,
+    top_k: int = 4,
+) -> tuple[TilingConfig, float]:
+    """Scores a coarse grid, then refines the `top_k` best configs with compass search.
+
+    Unlike the grid, the refinement can end up at any integer deltas.
+    """
+    tracker = SearchTracker(scoring_fn)
+
+    for config in itertools.islice(iter_configs(coarse_step), budget):
+        tracker(config)
+
+    top_configs = tracker.get_top_configs(top_k)
+    for i, (config, score) in enumerate(top_configs):
+        # Split the remaining budget evenly among the configs left to refine.
+        n_remaining = budget - tracker.n_evaluations
+        max_evaluations = tracker.n_evaluations + n_remaining // (len(top_configs) - i)
+        refine_config(tracker, config, score, coarse_step // 2, max_evaluations)
+
+    return tracker.best_config, tracker.best_score
+
+
+def search_bayesian(
+    scoring_fn: Callable[[TilingConfig], float],
+    budget: int,
+    n_initial: int | None = None,
+    seed: int = 0,
+) -> tuple[TilingConfig, float]:
+    """Bayesian optimization over the four (rounded) delta coordinates."""
+    tracker = SearchTracker(scoring_fn)
+
+    def f(x1, y1, x2, y2):
+        return tracker(
+            TilingConfig(
+                delta1=(round(x1), round(y1)),
+                delta2=(round(x2), round(y2)),
+            )
+        )
 
-    ESCHER_IMAGES_DIR.mkdir(exist_ok=True)
+    optimizer = BayesianOptimization(
+        f=f,
+        pbounds={k: (0, DELTA_LIMIT - 1) for k in ["x1", "y1", "x2", "y2"]},
+        random_state=seed,
+        verbose=0,
+    )
 
-    n_skipped = 0
+    if n_initial is None:
+        n_initial = max(budget // 4, 1)
+    n_initial = min(n_initial, budget)
+    optimizer.maximize(init_points=n_initial, n_iter=budget - n_initial)
 
-    progress_bar = tqdm.auto.tqdm(
-        # islice(images_in_dir(DATA_DIR / "cutouts2"), 0, 200, 10)
-        images_in_dir(DATA_DIR / "cutouts2")
-    )
+    return tracker.best_config, tracker.best_score
 
-    for path in progress_bar:
-        reference_image = Image.open(path)
-        progress_bar.set_description(f"Processing {path.name}")
-        progress_bar.set_postfix(n_skipped=n_skipped)
 
-        if not is_reasonable(reference_image):
-            n_skipped += 1
-            continue
+SEARCH_STRATEGIES = {
+    "exhaustive": search_exhaustive,
+    "coarse_to_fine": search_coarse_to_fine,
+    "bayesian": search_bayesian,
+}
 
-        best_config, best_score = select_best(
-            tqdm.auto.tqdm(iter_configs(), leave=False),
-            lambda x: score_tiling(canvas, reference_image, x),
-        )
 
-        cache[f"v1:{path}"] = {
-            "score": best_score,
-            "config": best_config.model_dump(mode="json"),
-            "path": path,
-            "image": place_tiled(canvas, reference_image, best_config),
-        }
+def get_default_budget(strategy: str) -> int:
+    """The size of the 32px grid, except for Bayesian optimization. Each of its
+    steps fits a Gaussian process to all evaluations before it, so with as many
+    evaluations as the grid has, it would never finish."""
+    if strategy == "bayesian":
+        return 50
+    return len(list(iter_configs()))
+
+
+def get_shard(path: Path, n_shards: int) -> int:
+    """Assigns a cutout to a shard by its filename, so it's stable across machines."""
+    digest = hashlib.sha1(path.name.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % n_shards
+
+
+def get_cache_key(path: Path) -> str:
+    return f"v1:{path}"
+
+
+def escherize_cutout(
+    path: Path,
+    strategy: str,
+    budget: int,
+    mask_store_dir: Path | None = None,
+    input_dir: Path | None = None,
+) -> dict:
+    """With a mask store built from `input_dir`, the cutout only needs to be
+    decoded once it has passed `is_reasonable`."""
+    if mask_store_dir is not None:
+        store = open_mask_store(mask_store_dir)
+        mask = store.get_by_name(path.relative_to(input_dir).as_posix())
+    else:
+        mask = to_mask(Image.open(path))
+
+    # Rejections are returned too so that they get cached and skipped next time.
+    if not is_reasonable(mask):
+        return {"path": path, "is_reasonable": False}
 
-        place_tiled(canvas, reference_image, best_config).save(
-            ESCHER_IMAGES_DIR / f"{path.stem}.png"
+    reference_image = Image.open(path)
+    canvas = Image.new("RGBA", (256, 256), 0)
+    search = SEARCH_STRATEGIES[strategy]
+    best_config, best_score = search(TilingScorer(canvas, mask), budget)
+
+    return {
+        "path": path,
+        "is_reasonable": True,
+        "score": best_score,
+        "config": best_config.model_dump(mode="json"),
+        "image": place_tiled(canvas, reference_image, best_config),
+    }
+
+
+def main(
+    input_dir: Path = DATA_DIR / "cutouts2",
+    strategy: str = "exhaustive",
+    budget: int | None = None,
+    n_workers: int | None = None,
+    shard: int = 0,
+    n_shards: int = 1,
+    mask_store_dir: Path | None = None,
+):
+    if budget is None:
+        budget = get_default_budget(strategy)
+
+    cache = diskcache.Cache(directory=ESCHER_CACHE_DIR)
+    ESCHER_IMAGES_DIR.mkdir(parents=True, exist_ok=True)
+
+    # Skip what a previous (possibly crashed) run already did.
+    done_stems = {path.stem for path in ESCHER_IMAGES_DIR.glob("*.png")}
+    paths = [
+        path
+        for path in images_in_dir(input_dir)
+        if get_shard(path, n_shards) == shard
+        and path.stem not in done_stems
+        and get_cache_key(path) not in cache
+    ]
+
+    f = functools.partial(
+        escherize_cutout,
+        strategy=strategy,
+        budget=budget,
+        mask_store_dir=mask_store_dir,
+        input_dir=input_dir,
+    )
+    n_skipped = 0
+
+    with multiprocessing.Pool(n_workers) as pool:
+        progress_bar = tqdm.auto.tqdm(
+            pool.imap_unordered(f, paths, chunksize=1), total=len(paths)
         )
-        # print(path, best_score, best_config)
-        # display(place_tiled(canvas, reference_image, best_config))
-        # display(
-        #     show_comparison(
-        #         reference_image, place_tiled(canvas, reference_image, best_config)
-        #     )
-        # )
 
-        # break
+        for result in progress_bar:
+            path = result["path"]
+
+            if result["is_reasonable"]:
+                result["image"].save(ESCHER_IMAGES_DIR / f"{path.stem}.png")
+            else:
+                n_skipped += 1
+
+            cache[get_cache_key(path)] = result
+            progress_bar.set_postfix(n_skipped=n_skipped)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-dir", "-i", type=Path, default=DATA_DIR / "cutouts2")
+    parser.add_argument(
+        "--strategy", choices=list(SEARCH_STRATEGIES), default="exhaustive"
+    )
+    parser.add_argument(
+        "--budget",
+        type=int,
+        default=None,
+        help="Score evaluations per cutout, default is the size of the 32px grid "
+        "or 50 for bayesian",
+    )
+    parser.add_argument(
+        "--n-workers", type=int, default=None, help="Default is the number of CPUs"
+    )
+    parser.add_argument("--shard", type=int, default=0)
+    parser.add_argument("--n-shards", type=int, default=1)
+    parser.add_argument(
+        "--mask-store",
+        type=Path,
+        default=None,
+        help="A store built from the input dir by segmentation.mask_store",
+    )
+    args = parser.parse_args()
+
+    if not 0 <= args.shard < args.n_shards:
+        parser.error(f"--shard must be in [0, {args.n_shards})")
+
+    main(
+        input_dir=args.input_dir,
+        strategy=args.strategy,
+        budget=args.budget,
+        n_workers=args.n_workers,
+        shard=args.shard,
+        n_shards=args.n_shards,
+        mask_store_dir=args.mask_store,
+    )
@@ -1,45 +1,407 @@
 import argparse
+from collections import Counter
+import contextlib
 import functools
-from pathlib import Path
+import itertools
+import json
+from pathlib import Path, PurePosixPath
 import multiprocessing
 import sys
 import re
+import tarfile
+import threading
+import time
+from typing import Callable, Iterable, Iterator, TypeVar
 
+from PIL.Image import Image as ImageType
 import tqdm.auto
 
 from segmentation import gcp
-from segmentation.cutting import extract_cutouts
+from segmentation.cutting import (
+    extract_cutouts,
+    extract_cutouts_from_image,
+    load_from_bytes,
+)
+from segmentation.manifest import STATUS_DONE, STATUS_MISSING, Manifest
+from segmentation.shards import ShardWriter, encode_cutout
+from segmentation.telemetry import StageTimer, maybe_profile
+
+MANIFEST_FILENAME = "manifest.sqlite"
+# One report per run, so that a resumed run doesn't replace the one before
+REPORT_FILENAME_FORMAT = "extraction_report-%Y%m%d-%H%M%S.json"
+
+T = TypeVar("T")
+
+# An SA-1B image read from a tar: (name without suffix, jpg bytes, json bytes).
+# The bytes of a file missing from the tar are None, see `iter_tar_images`.
+TarImage = tuple[str, bytes | None, bytes | None]
 
 
 def get_image_index(filename: str) -> int:
     match = re.match(r"sa_([0-9]+).*", filename)
     if match is None:
         raise ValueError(f"Could not extract image index from {filename}")
-    
+
     return int(match.groups()[0])
 
 
+def save_cutouts(
+    image_index: int,
+    cutouts: Iterable[tuple[int, ImageType]],
+    output_dir: Path,
+    timer: StageTimer | None = None,
+) -> list[Path]:
+    if timer is None:
+        timer = StageTimer()
+
+    paths = []
+
+    for cutout_index, cutout in cutouts:
+        filename = f"{image_index:08d}_{cutout_index:05d}.webp"
+        with timer("webp_save"):
+            cutout.save(output_dir / filename)
+        paths.append(output_dir / filename)
+
+    return paths
+
+
+def store_cutouts(
+    image_index: int,
+    cutouts: Iterable[tuple[int, ImageType]],
+    output_dir: Path,
+    to_shards: bool = False,
+    timer: StageTimer | None = None,
+) -> dict:
+    """Saves the cutouts as loose files, or only encodes them so that the parent
+    process can write them into shards. Returns that part of the result for
+    `run_extraction`."""
+    if timer is None:
+        timer = StageTimer()
+
+    if to_shards:
+        encoded_cutouts = []
+        for i, cutout in cutouts:
+            with timer("webp_encode"):
+                encoded_cutouts.append((i, encode_cutout(cutout)))
+        return {"encoded_cutouts": encoded_cutouts}
+    else:
+        return {"output_paths": save_cutouts(image_index, cutouts, output_dir, timer)}
+
+
+def get_profile_path(output_dir: Path, name: str, profile_image: str | None):
+    """Where to write the profile of the image, None if it's not the one to profile."""
+    return output_dir / f"profile-{name}.prof" if name == profile_image else None
+
+
 def save_cutouts_for_image(
     image_path: Path,
     output_dir: Path,
     error_on_missing_file: bool = True,
-    gcp_prefix: str | None = None,
-):
-    try:
-        for cutout_index, cutout in extract_cutouts(image_path):
-            image_index = get_image_index(image_path.name)
-            filename = f"{image_index:08d}_{cutout_index:05d}.webp"
-            cutout.save(output_dir / filename)
+    to_shards: bool = False,
+    profile_image: str | None = None,
+    draft: bool = False,
+) -> dict:
+    """Returns a result for the manifest, see `run_extraction`.
+
+    If the image is `profile_image` (a name like "sa_1"), its processing is
+    profiled into `output_dir`. With `draft`, the image may be decoded at a
+    lower resolution, see `cutting.draft_for_boxes`.
+    """
+    stats = Counter()
+    timer = StageTimer()
 
-            if gcp_prefix:
-                gcp.upload_blob(output_dir / filename, gcp_prefix + filename)
+    try:
+        with maybe_profile(
+            get_profile_path(output_dir, image_path.stem, profile_image)
+        ):
+            stored = store_cutouts(
+                get_image_index(image_path.name),
+                extract_cutouts(image_path, stats=stats, timer=timer, draft=draft),
+                output_dir,
+                to_shards,
+                timer,
+            )
     except FileNotFoundError:
         if error_on_missing_file:
             raise
         else:
             # The image indices are _almost_ continuous but not quite, some of them
             # are skipped. Just ignore them.
-            return
+            return {"image": image_path.stem, "status": STATUS_MISSING}
+
+    return {"image": image_path.stem, "stats": stats, "timer": timer, **stored}
+
+
+def save_cutouts_for_tar_image(
+    tar_image: TarImage,
+    output_dir: Path,
+    to_shards: bool = False,
+    profile_image: str | None = None,
+    draft: bool = False,
+) -> dict:
+    """Like `save_cutouts_for_image`, for an image read by `iter_tar_images`."""
+    name, image_bytes, json_bytes = tar_image
+    if image_bytes is None or json_bytes is None:
+        return {"image": name, "status": STATUS_MISSING}
+
+    stats = Counter()
+    timer = StageTimer()
+
+    with maybe_profile(get_profile_path(output_dir, name, profile_image)):
+        with timer("load"):
+            image, annotations = load_from_bytes(image_bytes, json_bytes)
+        stored = store_cutouts(
+            get_image_index(name),
+            extract_cutouts_from_image(
+                image, annotations, stats=stats, timer=timer, draft=draft
+            ),
+            output_dir,
+            to_shards,
+            timer,
+        )
+    return {"image": name, "stats": stats, "timer": timer, **stored}
+
+
+def get_report_path(output_dir: Path) -> Path:
+    return output_dir / time.strftime(REPORT_FILENAME_FORMAT)
+
+
+def print_stats(stats: Counter):
+    n_total = sum(stats.values())
+    print(f"Processed {n_total} annotations:")
+    for key, count in sorted(stats.items()):
+        print(f"  {key}: {count} ({count / max(n_total, 1):.1%})")
+
+
+def run_extraction(
+    f: Callable[[T], dict],
+    inputs: Iterable[T],
+    manifest: Manifest,
+    shard: str,
+    parallel: bool = True,
+    total: int | None = None,
+    initial: int = 0,
+    gcp_prefix: str | None = None,
+    shards_dir: Path | None = None,
+    report_path: Path | None = None,
+):
+    """Runs `f` on the inputs and records the results in the manifest.
+
+    `f` returns a dict with the source image name under "image" and optionally
+    "status", "output_paths", "stats" (the annotation counts from
+    `extract_cutouts`) and "timer" (a `StageTimer`). The manifest is only
+    written from this process.
+
+    If `shards_dir` is given, `f` returns "encoded_cutouts" instead of
+    "output_paths" and this process writes them into shards there.
+
+    If `gcp_prefix` is given, the cutouts (or whole shards) are uploaded from a
+    thread pool in this process while the workers carry on extracting.
+
+    If `report_path` is given, the time per stage, summed over the workers and
+    for this process, and the reject reasons are written there as JSON, unless
+    there were no inputs left to process.
+    """
+    # The pool would otherwise consume `inputs` as fast as it can, which for a
+    # tar would mean reading all of it into memory.
+    n_workers = 8
+    in_flight = threading.Semaphore(2 * n_workers)
+    stopped = threading.Event()
+    input_errors = []
+
+    def throttle(items):
+        try:
+            for item in items:
+                in_flight.acquire()
+                if stopped.is_set():
+                    return
+                yield item
+        except Exception as e:
+            # Raised from the pool, it would skip the results still in flight,
+            # so it's raised once they're all recorded.
+            input_errors.append(e)
+
+    total_stats = Counter()
+    n_images_per_status = Counter()
+    worker_timer = StageTimer()
+    # What this process spends on each image, apart from waiting for the workers
+    parent_timer = StageTimer()
+
+    def record(results: Iterable[dict]):
+        for result in tqdm.auto.tqdm(results, initial=initial, total=total):
+            in_flight.release()
+
+            stats = result.get("stats", Counter())
+            total_stats.update(stats)
+            n_images_per_status[result.get("status", STATUS_DONE)] += 1
+            if "timer" in result:
+                worker_timer.update(result["timer"])
+
+            output_paths = result.get("output_paths", [])
+            if shard_writer:
+                image_index = get_image_index(result["image"])
+                with parent_timer("shard_write"):
+                    output_paths = [
+                        shard_writer.write(image_index, cutout_index, data)
+                        for cutout_index, data in result.get("encoded_cutouts", [])
+                    ]
+            elif gcp_prefix:
+                with parent_timer("upload_submit"):
+                    for path in output_paths:
+                        uploader.submit(path, gcp_prefix + path.name)
+
+            with parent_timer("manifest_record"):
+                manifest.record(
+                    result["image"],
+                    shard=shard,
+                    status=result.get("status", STATUS_DONE),
+                    output_paths=output_paths,
+                    reject_reasons={k: v for k, v in stats.items() if k != "accepted"},
+                )
+
+    uploader = gcp.Uploader() if gcp_prefix else None
+
+    def upload_shard(pack_path: Path):
+        if gcp_prefix:
+            for path in [pack_path, pack_path.with_suffix(".idx")]:
+                uploader.submit(path, f"{gcp_prefix}{shard}/{path.name}")
+
+    shard_writer = (
+        ShardWriter(shards_dir, on_shard_closed=upload_shard) if shards_dir else None
+    )
+
+    start = time.perf_counter()
+
+    # The writer is closed first, so that the last shard is uploaded too.
+    with uploader or contextlib.nullcontext(), shard_writer or contextlib.nullcontext():
+        if not parallel:
+            record(map(f, throttle(inputs)))
+        else:
+            with multiprocessing.Pool(n_workers) as pool:
+                try:
+                    record(pool.imap_unordered(f, throttle(inputs), chunksize=1))
+                finally:
+                    # If a worker raised, the pool's feeder thread may be
+                    # waiting in `throttle` for a result that will never come,
+                    # and terminating the pool would wait for it forever.
+                    stopped.set()
+                    in_flight.release()
+
+        if input_errors:
+            raise input_errors[0]
+
+    elapsed = time.perf_counter() - start
+
+    print_stats(total_stats)
+    if uploader:
+        print(f"Uploads: {uploader.get_stats()}")
+
+    n_images = sum(n_images_per_status.values())
+    if report_path is not None and n_images > 0:
+        report = {
+            "shard": shard,
+            "n_workers": n_workers if parallel else 1,
+            "wall_seconds": elapsed,
+            "n_images": n_images,
+            "images_per_second": n_images / elapsed if elapsed > 0 else None,
+            "n_images_per_status": dict(n_images_per_status),
+            "n_accepted": total_stats["accepted"],
+            "reject_reasons": {k: v for k, v in total_stats.items() if k != "accepted"},
+            "worker_stages": worker_timer.to_dict(),
+            "parent_stages": parent_timer.to_dict(),
+            "uploads": uploader.get_stats() if uploader else None,
+        }
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        report_path.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"Wrote the run report to {report_path}")
+
+
+def iter_tar_images(
+    tar_path: Path,
+    skip: set[str] = frozenset(),
+    error_on_missing_file: bool = True,
+) -> Iterator[TarImage]:
+    """Reads the image/annotation pairs from an SA-1B tar without extracting it.
+
+    The tar is read as a stream, so it can't seek: each file is kept in memory
+    until its counterpart arrives, which in SA-1B tars is right after it.
+    Images whose names are in `skip` are not read at all. Files without their
+    counterpart raise a FileNotFoundError at the end of the tar, or with
+    `error_on_missing_file=False` are yielded there with None for the missing
+    file.
+    """
+    pending: dict[str, dict[str, bytes]] = {}
+
+    with tarfile.open(tar_path, mode="r|*") as tar:
+        for member in tar:
+            path = PurePosixPath(member.name)
+            if not member.isfile() or path.suffix not in [".jpg", ".json"]:
+                continue
+            if path.stem in skip:
+                continue
+
+            files = pending.setdefault(path.stem, {})
+            files[path.suffix] = tar.extractfile(member).read()
+
+            if len(files) == 2:
+                del pending[path.stem]
+                yield path.stem, files[".jpg"], files[".json"]
+
+    # Same as for directories: the indices are not quite continuous, so
+    # an unpaired file is an error only if we ask for it.
+    if pending and error_on_missing_file:
+        name, files = next(iter(pending.items()))
+        raise FileNotFoundError(f"{tar_path} has {name}{list(files)[0]} only")
+
+    for name, files in pending.items():
+        yield name, files.get(".jpg"), files.get(".json")
+
+
+def main_from_tar(
+    input_tar: Path,
+    output_dir: Path,
+    max_n_images: int,
+    gcp_prefix: str | None = None,
+    parallel: bool = True,
+    manifest_path: Path | None = None,
+    to_shards: bool = False,
+    report_path: Path | None = None,
+    profile_image: str | None = None,
+    draft: bool = False,
+    error_on_missing_file: bool = True,
+):
+    """Like `main`, but streams the images from an SA-1B tar instead of a directory."""
+    output_dir.mkdir(exist_ok=True)
+
+    with Manifest(manifest_path or output_dir / MANIFEST_FILENAME) as manifest:
+        shard = input_tar.stem
+        done = manifest.get_done(shard)
+
+        f = functools.partial(
+            save_cutouts_for_tar_image,
+            output_dir=output_dir,
+            to_shards=to_shards,
+            profile_image=profile_image,
+            draft=draft,
+        )
+        tar_images = itertools.islice(
+            iter_tar_images(
+                input_tar, skip=done, error_on_missing_file=error_on_missing_file
+            ),
+            max(max_n_images - len(done), 0),
+        )
+        run_extraction(
+            f,
+            tar_images,
+            manifest,
+            shard,
+            parallel=parallel,
+            total=max_n_images,
+            initial=len(done),
+            gcp_prefix=gcp_prefix,
+            shards_dir=output_dir if to_shards else None,
+            report_path=report_path or get_report_path(output_dir),
+        )
 
 
 def main(
@@ -48,29 +410,101 @@ def main(
     max_n_images: int,
     gcp_prefix: str | None = None,
     parallel: bool = True,
+    manifest_path: Path | None = None,
+    to_shards: bool = False,
+    report_path: Path | None = None,
+    profile_image: str | None = None,
+    draft: bool = False,
+    error_on_missing_file: bool = True,
 ):
+    """Extracts the cutouts of the SA-1B images in `input_dir` into `output_dir`,
+    as loose .webp files or, with `to_shards`, packed into shards.
+
+    A report of the time per stage and the reject reasons is written to
+    `report_path`, by default in the output dir. The processing of the image
+    named `profile_image`, e.g. "sa_1", is profiled into the output dir. With
+    `draft`, images whose cutouts are all large enough are decoded at a lower
+    resolution, which is faster but changes the cutouts slightly. Without
+    `error_on_missing_file`, images without their annotations are recorded as
+    missing instead of failing the run.
+    """
     output_dir.mkdir(exist_ok=True)
 
-    f = functools.partial(
-        save_cutouts_for_image, output_dir=output_dir, gcp_prefix=gcp_prefix
-    )
-    image_paths = tqdm.auto.tqdm(sorted(input_dir.glob("sa_*.jpg"))[:max_n_images])
+    with Manifest(manifest_path or output_dir / MANIFEST_FILENAME) as manifest:
+        shard = input_dir.name
+        done = manifest.get_done(shard)
 
-    if not parallel:
-        for path in image_paths:
-            f(path)
-    else:
-        with multiprocessing.Pool(8) as pool:
-            pool.map(f, image_paths, chunksize=1)
+        f = functools.partial(
+            save_cutouts_for_image,
+            output_dir=output_dir,
+            error_on_missing_file=error_on_missing_file,
+            to_shards=to_shards,
+            profile_image=profile_image,
+            draft=draft,
+        )
+        image_paths = [
+            path
+            for path in sorted(input_dir.glob("sa_*.jpg"))[:max_n_images]
+            if path.stem not in done
+        ]
+        run_extraction(
+            f,
+            image_paths,
+            manifest,
+            shard,
+            parallel=parallel,
+            gcp_prefix=gcp_prefix,
+            shards_dir=output_dir if to_shards else None,
+            report_path=report_path or get_report_path(output_dir),
+        )
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input-dir", "-i", type=Path, required=True)
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument("--input-dir", "-i", type=Path)
+    input_group.add_argument(
+        "--input-tar", type=Path, help="Stream the images from an SA-1B .tar"
+    )
     parser.add_argument("--output-dir", "-o", type=Path, required=True)
     parser.add_argument("--max-n-images", type=int, default=100)
     parser.add_argument("--gcp-prefix", type=str, default=None)
     parser.add_argument("--no-parallel", action="store_false", dest="parallel")
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help=f"Defaults to {MANIFEST_FILENAME} in the output dir",
+    )
+    parser.add_argument(
+        "--to-shards",
+        action="store_true",
+        help="Pack the cutouts into large shard files instead of one file each",
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        default=None,
+        help="Where to write the run report, defaults to a new "
+        "extraction_report-<date>-<time>.json in the output dir",
+    )
+    parser.add_argument(
+        "--profile-image",
+        type=str,
+        default=None,
+        help="Profile the processing of this image, e.g. sa_1, into the output dir",
+    )
+    parser.add_argument(
+        "--draft",
+        action="store_true",
+        help="Decode the JPEGs at a lower resolution when all cutouts allow it",
+    )
+    parser.add_argument(
+        "--no-error-on-missing-file",
+        action="store_false",
+        dest="error_on_missing_file",
+        help="Record images without their .jpg or .json as missing instead of failing",
+    )
     args = parser.parse_args()
 
     gcp_prefix = args.gcp_prefix
@@ -83,10 +517,31 @@ if __name__ == "__main__":
             print("gcp-prefix should end with a slash, adding automatically")
             gcp_prefix += "/"
 
-    main(
-        input_dir=args.input_dir,
-        output_dir=args.output_dir,
-        max_n_images=args.max_n_images,
-        gcp_prefix=gcp_prefix,
-        parallel=args.parallel,
-    )
+    if args.input_tar is not None:
+        main_from_tar(
+            input_tar=args.input_tar,
+            output_dir=args.output_dir,
+            max_n_images=args.max_n_images,
+            gcp_prefix=gcp_prefix,
+            parallel=args.parallel,
+            manifest_path=args.manifest,
+            to_shards=args.to_shards,
+            report_path=args.report,
+            profile_image=args.profile_image,
+            draft=args.draft,
+            error_on_missing_file=args.error_on_missing_file,
+        )
+    else:
+        main(
+            input_dir=args.input_dir,
+            output_dir=args.output_dir,
+            max_n_images=args.max_n_images,
+            gcp_prefix=gcp_prefix,
+            parallel=args.parallel,
+            manifest_path=args.manifest,
+            to_shards=args.to_shards,
+            report_path=args.report,
+            profile_image=args.profile_image,
+            draft=args.draft,
+            error_on_missing_file=args.error_on_missing_file,
+        )
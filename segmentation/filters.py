@@ -0,0 +1,225 @@
+"""Cutout filters that work directly on boolean masks.
+
+These make the same decisions as `cutting.get_rejection_reason`, but without
+converting between PIL images and NumPy arrays: the edge cut-off tests only need
+the row and column sums of the mask, and the connectivity test stops as soon as
+it finds a second component.
+"""
+
+from typing import Iterable
+
+import numpy as np
+
+MIN_CUTOUT_SIZE = 256
+
+# How many rows from the edge `is_edge_cut_off` compares the edge row with.
+EDGE_N_ROWS = 5
+
+
+def get_bbox(mask: np.ndarray) -> tuple[int, int, int, int] | None:
+    """Returns (left, top, right, bottom) like `Image.getbbox()`, or None if empty."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+
+    cols = np.flatnonzero(mask.any(axis=0))
+    return cols[0], rows[0], cols[-1] + 1, rows[-1] + 1
+
+
+def is_edge_cut_off(line_counts: np.ndarray, width: int) -> bool:
+    """Checks whether the shape looks cut off, given the filled pixel counts of
+    the lines starting from the edge and the length of the edge.
+
+    Same as `cutting.is_top_cut_off`: if the first line is about as wide as the
+    next few, the shape probably continues beyond the edge.
+    """
+    edge_width = np.sum(line_counts[:EDGE_N_ROWS]) / EDGE_N_ROWS
+
+    # If the edge is thin, it should look ok even if it is cut off.
+    if edge_width < 0.2 * width:
+        return False
+
+    return line_counts[0] >= 0.85 * edge_width
+
+
+def get_cut_off_sides(mask: np.ndarray) -> tuple[bool, bool, bool, bool]:
+    """Computes which sides of the mask's content are cut off.
+
+    Returns:
+        a tuple of booleans in the order top, right, bottom, left.
+    """
+    bbox = get_bbox(mask)
+    if bbox is None:
+        return False, False, False, False
+
+    left, top, right, bottom = bbox
+    mask = mask[top:bottom, left:right]
+    row_counts = mask.sum(axis=1)
+    col_counts = mask.sum(axis=0)
+    height, width = mask.shape
+
+    return (
+        is_edge_cut_off(row_counts, width),
+        is_edge_cut_off(col_counts[::-1], height),
+        is_edge_cut_off(row_counts[::-1], width),
+        is_edge_cut_off(col_counts, height),
+    )
+
+
+def get_runs(mask: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns (ys, x_starts, x_ends) of the horizontal runs of True pixels."""
+    height, width = mask.shape
+    changes = np.empty((height, width + 1), dtype=bool)
+    changes[:, 0] = mask[:, 0]
+    changes[:, width] = mask[:, -1]
+    np.not_equal(mask[:, 1:], mask[:, :-1], out=changes[:, 1:width])
+
+    ys, xs = np.nonzero(changes)
+    return ys[::2], xs[::2], xs[1::2]
+
+
+def is_connected(mask: np.ndarray) -> bool:
+    """Checks that the mask has exactly one 8-connected component.
+
+    Sweeps the rows top to bottom, joining the runs of each row with the
+    touching runs of the row above. As soon as a component ends while there is
+    anything else in the mask, the answer is known to be False.
+    """
+    ys, x_starts, x_ends = get_runs(mask)
+    if len(ys) == 0:
+        return False
+
+    row_starts = np.searchsorted(ys, np.arange(mask.shape[0] + 1)).tolist()
+    x_starts, x_ends = x_starts.tolist(), x_ends.tolist()
+
+    # Union-find over the runs
+    parents = list(range(len(x_starts)))
+
+    def find(i: int) -> int:
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    previous = range(0)
+
+    for y in range(mask.shape[0]):
+        current = range(row_starts[y], row_starts[y + 1])
+
+        # Both lists of runs are sorted, so we can advance through them together.
+        j = previous.start
+        for i in current:
+            while j < previous.stop and x_ends[j] < x_starts[i]:
+                j += 1
+
+            # With 8-connectivity, runs that touch diagonally are connected too.
+            k = j
+            while k < previous.stop and x_starts[k] <= x_ends[i]:
+                root_i, root_k = find(i), find(k)
+                if root_i != root_k:
+                    parents[root_i] = root_k
+                k += 1
+
+        previous_roots = {find(k) for k in previous}
+        current_roots = {find(i) for i in current}
+
+        if previous_roots - current_roots:
+            # A component has ended, so it had better be the only one.
+            is_last_row = row_starts[y] == len(x_starts)
+            return len(previous_roots) == 1 and is_last_row
+
+        previous = current
+
+    return len({find(k) for k in previous}) == 1
+
+
+def get_rejection_reason(mask: np.ndarray) -> str | None:
+    """Returns why the mask is not a good cutout, or None if it is.
+
+    Same as `cutting.get_rejection_reason` for an image with this alpha mask.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    height, width = mask.shape
+
+    is_big_enough = width >= MIN_CUTOUT_SIZE or height >= MIN_CUTOUT_SIZE
+    if not is_big_enough:
+        return "too_small"
+
+    if any(get_cut_off_sides(mask)):
+        return "cut_off"
+
+    if not is_connected(mask):
+        return "not_connected"
+
+    return None
+
+
+def get_rejection_reasons(masks: Iterable[np.ndarray]) -> list[str | None]:
+    """`get_rejection_reason` for masks of possibly different sizes."""
+    return [get_rejection_reason(mask) for mask in masks]
+
+
+def get_cut_off_sides_stacked(masks: np.ndarray) -> np.ndarray:
+    """`get_cut_off_sides` for an N x H x W stack of masks, vectorized over N.
+
+    Returns:
+        an N x 4 boolean array with the sides in the order top, right, bottom, left.
+    """
+    row_counts = masks.sum(axis=2)
+    col_counts = masks.sum(axis=1)
+
+    def get_extent(counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        is_filled = counts > 0
+        start = np.argmax(is_filled, axis=1)
+        end = counts.shape[1] - np.argmax(is_filled[:, ::-1], axis=1)
+        return start, end
+
+    top, bottom = get_extent(row_counts)
+    left, right = get_extent(col_counts)
+    steps = np.arange(EDGE_N_ROWS)
+
+    def is_cut_off(counts, start, end, from_end: bool, width):
+        # The counts of the first lines from the edge, zero past the other edge.
+        start, end = start[:, np.newaxis], end[:, np.newaxis]
+        lines = end - 1 - steps if from_end else start + steps
+        is_inside = (lines >= start) & (lines < end)
+        lines = np.clip(lines, 0, counts.shape[1] - 1)
+        line_counts = np.take_along_axis(counts, lines, axis=1) * is_inside
+
+        edge_width = line_counts.sum(axis=1) / EDGE_N_ROWS
+        return (edge_width >= 0.2 * width) & (line_counts[:, 0] >= 0.85 * edge_width)
+
+    width, height = right - left, bottom - top
+    is_empty = row_counts.max(axis=1) == 0
+
+    cut_off = np.stack(
+        [
+            is_cut_off(row_counts, top, bottom, False, width),
+            is_cut_off(col_counts, left, right, True, height),
+            is_cut_off(row_counts, top, bottom, True, width),
+            is_cut_off(col_counts, left, right, False, height),
+        ],
+        axis=1,
+    )
+    cut_off[is_empty] = False
+    return cut_off
+
+
+def get_rejection_reasons_stacked(masks: np.ndarray) -> list[str | None]:
+    """`get_rejection_reason` for an N x H x W stack of equally sized masks.
+
+    The cut-off tests are vectorized over the whole stack, only the masks that
+    pass them are checked for connectivity one by one.
+    """
+    masks = np.asarray(masks, dtype=bool)
+    _, height, width = masks.shape
+
+    if width < MIN_CUTOUT_SIZE and height < MIN_CUTOUT_SIZE:
+        return ["too_small"] * len(masks)
+
+    is_cut_off = get_cut_off_sides_stacked(masks).any(axis=1)
+
+    return [
+        "cut_off" if cut_off else None if is_connected(mask) else "not_connected"
+        for mask, cut_off in zip(masks, is_cut_off)
+    ]
@@ -7,8 +7,14 @@ credentials to use.
 2. Make sure that the user account or service account that you are using
    has the required permissions. For this sample, you must have "storage.buckets.list".
 """
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import functools
 from pathlib import Path
 import logging
+import threading
+import time
+from typing import Protocol
 
 from google.cloud import storage
 
@@ -31,12 +37,188 @@ def authenticate_implicit_with_adc():
     print("Listed all storage buckets.")
 
 
-def upload_blob(source_file_name: str | Path, destination_blob_name: str):
-    """Uploads a file to the bucket."""
+@functools.cache
+def get_bucket(bucket_id: str = BUCKET_ID) -> storage.Bucket:
+    """Returns the bucket, creating the client only once per process.
+
+    Like all of google-cloud-storage, this talks to a local fake GCS server
+    instead if the STORAGE_EMULATOR_HOST environment variable is set.
+    """
     storage_client = storage.Client()
-    bucket = storage_client.bucket(BUCKET_ID)
+    return storage_client.bucket(bucket_id)
+
 
-    blob = bucket.blob(destination_blob_name)
+def upload_blob(source_file_name: str | Path, destination_blob_name: str):
+    """Uploads a file to the bucket."""
+    blob = get_bucket().blob(destination_blob_name)
     blob.upload_from_filename(str(source_file_name))
 
     logger.debug(f"File {source_file_name} uploaded to {destination_blob_name}.")
+
+
+class UploadBackend(Protocol):
+    def upload(self, source_file_name: Path, destination_blob_name: str): ...
+
+
+class GCSBackend:
+    def __init__(self, bucket_id: str = BUCKET_ID):
+        self.bucket_id = bucket_id
+
+    def upload(self, source_file_name: Path, destination_blob_name: str):
+        blob = get_bucket(self.bucket_id).blob(destination_blob_name)
+        blob.upload_from_filename(str(source_file_name))
+
+
+class InMemoryBackend:
+    """Keeps the uploaded files in a dict, for trying out the uploader offline.
+
+    `latency` simulates the round trip of a request, `fail_every` makes every
+    n-th upload attempt raise, to exercise the retries.
+    """
+
+    def __init__(self, latency: float = 0.0, fail_every: int | None = None):
+        self.blobs: dict[str, bytes] = {}
+        self.latency = latency
+        self.fail_every = fail_every
+        self.n_attempts = 0
+        self.lock = threading.Lock()
+
+    def upload(self, source_file_name: Path, destination_blob_name: str):
+        with self.lock:
+            self.n_attempts += 1
+            n_attempts = self.n_attempts
+
+        time.sleep(self.latency)
+        if self.fail_every and n_attempts % self.fail_every == 0:
+            raise ConnectionError(f"Simulated failure of attempt {n_attempts}")
+
+        data = Path(source_file_name).read_bytes()
+        with self.lock:
+            self.blobs[destination_blob_name] = data
+
+
+class Uploader:
+    """Uploads files from a bounded pool of threads, so that uploading doesn't
+    block the caller and the client is shared between uploads.
+
+    At most `max_queue_size` uploads are pending at a time, `submit` blocks
+    when the queue is full. Failed uploads are retried with exponential backoff.
+    `flush` (also called on exit of the `with` block) waits for all pending
+    uploads and raises if any of them failed for good.
+    """
+
+    def __init__(
+        self,
+        backend: UploadBackend | None = None,
+        n_threads: int = 8,
+        max_queue_size: int = 64,
+        max_retries: int = 3,
+        backoff: float = 1.0,
+    ):
+        self.backend = backend or GCSBackend()
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.executor = ThreadPoolExecutor(n_threads, thread_name_prefix="upload")
+        self.slots = threading.BoundedSemaphore(max_queue_size)
+        self.lock = threading.Lock()
+        self.is_idle = threading.Condition(self.lock)
+
+        self.start_time = time.perf_counter()
+        self.n_uploaded = 0
+        self.n_bytes = 0
+        self.n_retries = 0
+        # Of the successful attempts, summed over the threads, so it can be more
+        # than the wall time.
+        self.upload_seconds = 0.0
+        self.failed: list[tuple[Path, str, Exception]] = []
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+
+    def __enter__(self) -> "Uploader":
+        return self
+
+    def __exit__(self, exc_type, *args):
+        # Don't hide the original exception behind a failed upload.
+        self.close(raise_on_failure=exc_type is None)
+
+    def submit(self, source_file_name: Path, destination_blob_name: str) -> Future:
+        self.slots.acquire()
+        with self.lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+        return self.executor.submit(
+            self._upload, Path(source_file_name), destination_blob_name
+        )
+
+    def _upload(self, source_file_name: Path, destination_blob_name: str):
+        try:
+            for attempt in range(self.max_retries + 1):
+                start = time.perf_counter()
+                try:
+                    self.backend.upload(source_file_name, destination_blob_name)
+                    break
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        logger.error(
+                            f"Failed to upload {source_file_name} to "
+                            f"{destination_blob_name}: {e}"
+                        )
+                        with self.lock:
+                            self.failed.append(
+                                (source_file_name, destination_blob_name, e)
+                            )
+                        raise
+
+                    with self.lock:
+                        self.n_retries += 1
+                    time.sleep(self.backoff * 2**attempt)
+
+            n_bytes = source_file_name.stat().st_size
+            with self.lock:
+                self.upload_seconds += time.perf_counter() - start
+                self.n_uploaded += 1
+                self.n_bytes += n_bytes
+
+            logger.debug(
+                f"File {source_file_name} uploaded to {destination_blob_name}."
+            )
+        finally:
+            with self.lock:
+                self.queue_depth -= 1
+                if self.queue_depth == 0:
+                    self.is_idle.notify_all()
+            self.slots.release()
+
+    def flush(self, raise_on_failure: bool = True):
+        """Waits for all pending uploads."""
+        with self.is_idle:
+            self.is_idle.wait_for(lambda: self.queue_depth == 0)
+
+        if raise_on_failure and self.failed:
+            raise RuntimeError(
+                f"{len(self.failed)} uploads failed, the first one: "
+                f"{self.failed[0][0]} -> {self.failed[0][1]}"
+            ) from self.failed[0][2]
+
+    def close(self, raise_on_failure: bool = True):
+        try:
+            self.flush(raise_on_failure)
+        finally:
+            self.executor.shutdown()
+
+    def get_stats(self) -> dict:
+        elapsed = time.perf_counter() - self.start_time
+        with self.lock:
+            return {
+                "n_uploaded": self.n_uploaded,
+                "n_failed": len(self.failed),
+                "n_retries": self.n_retries,
+                "n_bytes": self.n_bytes,
+                "files_per_second": self.n_uploaded / elapsed,
+                "bytes_per_second": self.n_bytes / elapsed,
+                "upload_seconds": self.upload_seconds,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+            }
@@ -1,10 +1,43 @@
+import functools
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
 from pathlib import Path
+import re
+import threading
+import types
+from typing import Callable, Iterator
 from PIL import Image
 import numpy as np
 import tqdm.auto
 import faiss
 
-from segmentation.loading import DATA_DIR, iterate_images
+from segmentation.loading import (
+    DATA_DIR,
+    iterate_encoded_images,
+    list_images,
+    open_image,
+)
+from segmentation.mask_store import open_mask_store
+
+# Bump when the format of the cache changes
+CACHE_VERSION = 1
+
+HASH_DTYPES = [np.float32, np.uint8]
+# Same as 256 float32s. Bit-packed hashes can have up to 8192 bits.
+MAX_HASH_BYTES = 1024
+
+# Shorthands for `HashIndex(index_type=...)`, see `get_factory_string`.
+INDEX_TYPES = ["flat", "hnsw", "ivf_flat", "ivf_pq"]
+
+# Neighbors per node of HNSW indices, more is slower but more accurate.
+HNSW_N_NEIGHBORS = 32
+
+# IVF and PQ indices are trained on a random sample of at most this many hashes.
+MAX_N_TRAINING = 100_000
 
 
 def get_example_image():
@@ -12,68 +45,557 @@ def get_example_image():
     return Image.fromarray((rng.random((256, 256, 4)) * 256).astype(np.uint8))
 
 
-def check_hash_function(hash_function) -> int:
-    """Returns the number of elements the hash function returns."""
-    example_image = get_example_image()
-    example_hash = hash_function(example_image)
+def check_hash_function(
+    hash_function, example_image: Image.Image | np.ndarray | None = None
+) -> tuple[int, np.dtype]:
+    """Returns the number of elements the hash function returns and their type.
+
+    Hashes are either float32 vectors compared by L2 distance, or bit-packed
+    uint8 arrays (see `shapes.get_shape_hash`) compared by Hamming distance.
+    """
+    if example_image is None:
+        example_image = get_example_image()
+    example_hash = hash_batch(hash_function, [example_image])[0]
     assert isinstance(example_hash, np.ndarray)
     assert (
-        example_hash.dtype == np.float32
-    ), f"Hash must be float32, got {example_hash.dtype}"
+        example_hash.dtype in HASH_DTYPES
+    ), f"Hash must be float32 or packed uint8, got {example_hash.dtype}"
     assert example_hash.ndim == 1
 
-    if len(example_hash) > 256:
+    if example_hash.nbytes > MAX_HASH_BYTES:
         raise ValueError(
-            "For 1M images, a hash of more than 256 elements would "
-            f"be over 2GB in total. Got {len(example_hash)} elements."
+            f"For 1M images, a hash of more than {MAX_HASH_BYTES} bytes would "
+            f"be over 1GB in total. Got {example_hash.nbytes} bytes."
+        )
+
+    return len(example_hash), example_hash.dtype
+
+
+def batched(hash_function: Callable) -> Callable:
+    """Marks a hash function as taking a whole batch at once: a list of images,
+    or an N x H x W array of masks if the index reads from a mask store. It
+    must return an N x hash size array."""
+    hash_function.is_batched = True
+    return hash_function
+
+
+def hash_batch(hash_function: Callable, images: list | np.ndarray) -> np.ndarray:
+    if getattr(hash_function, "is_batched", False):
+        return hash_function(images)
+    else:
+        return np.stack([hash_function(image) for image in images])
+
+
+# Set in each worker process by `init_worker`.
+worker_hash_function = None
+
+
+def init_worker(hash_function: Callable):
+    global worker_hash_function
+    worker_hash_function = hash_function
+
+
+def hash_encoded_batch(batch: tuple[int, list[bytes]]) -> tuple[int, np.ndarray]:
+    start, encoded_images = batch
+    images = [Image.open(io.BytesIO(data)) for data in encoded_images]
+    return start, hash_batch(worker_hash_function, images)
+
+
+def hash_mask_batch(batch: tuple[int, np.ndarray, Path]) -> tuple[int, np.ndarray]:
+    start, store_indices, mask_store_dir = batch
+    masks = open_mask_store(mask_store_dir)[store_indices]
+    return start, hash_batch(worker_hash_function, masks)
+
+
+def get_factory_string(
+    index_type: str, hash_size: int, is_binary: bool, n_items: int
+) -> str:
+    """Returns the faiss index factory string for one of `INDEX_TYPES`, sized for
+    `n_items` hashes. Other strings are passed on to faiss as they are."""
+    # The usual rule of thumb is 4 * sqrt(n) lists, but faiss wants at least
+    # 39 training points per list.
+    n_lists = max(1, min(int(4 * np.sqrt(n_items)), n_items // 39))
+
+    if is_binary:
+        if index_type == "ivf_pq":
+            raise ValueError("Product quantization is not supported for binary hashes")
+
+        presets = {
+            "flat": "BFlat",
+            "hnsw": f"BHNSW{HNSW_N_NEIGHBORS}",
+            "ivf_flat": f"BIVF{n_lists}",
+        }
+    else:
+        # Subquantizers of about 4 dimensions, each with at most 256 centroids
+        # and at least 39 training points per centroid. Hashes of fewer than
+        # 4 dimensions get a single one.
+        n_subquantizers = max(
+            (m for m in range(1, hash_size // 4 + 1) if hash_size % m == 0),
+            default=1,
         )
+        n_bits = int(np.clip(np.log2(max(n_items, 1) / 39), 1, 8))
+        presets = {
+            "flat": "Flat",
+            "hnsw": f"HNSW{HNSW_N_NEIGHBORS}",
+            "ivf_flat": f"IVF{n_lists},Flat",
+            "ivf_pq": f"IVF{n_lists},PQ{n_subquantizers}x{n_bits}",
+        }
+
+    return presets.get(index_type, index_type)
+
+
+def make_faiss_index(
+    hash_size: int,
+    is_binary: bool,
+    index_type: str = "flat",
+    hashes: np.ndarray | None = None,
+    max_n_training: int = MAX_N_TRAINING,
+) -> faiss.Index | faiss.IndexBinary:
+    """Makes an index for hashes of `hash_size` float32s or packed bytes.
+
+    `index_type` is one of `INDEX_TYPES` or a faiss index factory string. If
+    the index needs training, it is trained on a random sample of `hashes`,
+    which are then added to it.
+    """
+    n_items = 0 if hashes is None else len(hashes)
+    factory_string = get_factory_string(index_type, hash_size, is_binary, n_items)
 
-    return len(example_hash)
+    if is_binary:
+        index = faiss.index_binary_factory(hash_size * 8, factory_string)
+    else:
+        index = faiss.index_factory(hash_size, factory_string)
+
+    if hashes is None:
+        return index
+
+    if not index.is_trained:
+        rng = np.random.default_rng(0)
+        sample = rng.choice(n_items, min(n_items, max_n_training), replace=False)
+        index.train(np.ascontiguousarray(hashes[np.sort(sample)]))
+
+    index.add(np.ascontiguousarray(hashes))
+    return index
+
+
+def set_search_parameters(
+    index: faiss.Index | faiss.IndexBinary,
+    nprobe: int | None = None,
+    ef_search: int | None = None,
+):
+    """Sets how many lists an IVF index searches (`nprobe`), or how many
+    candidates an HNSW index keeps while searching (`ef_search`). More is
+    slower but finds more of the true nearest neighbors."""
+    if nprobe is not None:
+        if isinstance(index, faiss.IndexBinary):
+            ivf_index = index if isinstance(index, faiss.IndexBinaryIVF) else None
+        else:
+            ivf_index = faiss.try_extract_index_ivf(index)
+        if ivf_index is None:
+            raise ValueError(
+                f"nprobe is only for IVF indexes, not {type(index).__name__}"
+            )
+        ivf_index.nprobe = nprobe
+
+    if ef_search is not None:
+        if not isinstance(index, (faiss.IndexHNSW, faiss.IndexBinaryHNSW)):
+            raise ValueError(
+                f"ef_search is only for HNSW indexes, not {type(index).__name__}"
+            )
+        index.hnsw.efSearch = ef_search
+
+
+def get_code_digest(code: types.CodeType) -> str:
+    parts = [code.co_code, repr(code.co_names).encode()]
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            parts.append(get_code_digest(const).encode())
+        else:
+            parts.append(repr(const).encode())
+
+    return hashlib.sha1(b"\0".join(parts)).hexdigest()[:12]
+
+
+def get_hash_function_id(hash_function: Callable) -> str:
+    """Identifies a hash function by its name and code, including constants
+    like the `size=8` in `lambda image: get_edges_hash(image, size=8)`.
+
+    Changes to the functions it calls are not detected, so for those pass an
+    explicit `hash_function_id` to `HashIndex` and change it when needed.
+    """
+    if isinstance(hash_function, functools.partial):
+        keywords = sorted(hash_function.keywords.items())
+        return (
+            f"{get_hash_function_id(hash_function.func)}"
+            f"({hash_function.args!r}, {keywords!r})"
+        )
+
+    if not hasattr(hash_function, "__qualname__"):
+        # A callable object, identified by its class and its `__call__`, but
+        # not its attributes
+        hash_function = type(hash_function)
+        code = getattr(hash_function.__call__, "__code__", None)
+    else:
+        code = getattr(hash_function, "__code__", None)
+    name = f"{hash_function.__module__}.{hash_function.__qualname__}"
+    return f"{name}:{get_code_digest(code)}" if code is not None else name
+
+
+def get_fingerprint(names: list[str]) -> str:
+    return hashlib.sha1("\n".join(names).encode()).hexdigest()
 
 
 class HashIndex:
+    """A nearest-neighbor index over the hashes of the cutouts in `input_dir`.
+
+    The hashes are persisted in `cache_file`, with a JSON sidecar next to it
+    recording the name of the cutout of every row, the hash function and a
+    fingerprint of the corpus. The cache is only used if the hash function
+    matches. If cutouts were added, only those are hashed and appended.
+    """
+
     def __init__(
         self,
-        hash_function: callable,
+        hash_function: Callable,
         cache_file: Path,
         max_n_images: int | None = None,
+        input_dir: Path = DATA_DIR / "cutouts2",
+        mask_store_dir: Path | None = None,
+        n_workers: int | None = None,
+        batch_size: int = 64,
+        hash_function_id: str | None = None,
+        index_type: str = "flat",
+        nprobe: int | None = None,
+        ef_search: int | None = None,
     ):
+        """If `mask_store_dir` is given, the hash function gets the boolean masks
+        from that store (built from `input_dir`) instead of the images.
+
+        The kind of index is chosen by the hash dtype: L2 distance for float32
+        hashes, Hamming distance for bit-packed uint8 ones. `index_type` is
+        "flat" for exact search, one of the approximate `INDEX_TYPES` or a faiss
+        factory string; see `set_search_parameters` for `nprobe` and
+        `ef_search`. Indices other than "flat" are persisted next to the cache,
+        since they are slow to build. New cutouts are added to a trained index
+        without retraining it, delete the .faiss file to retrain.
+
+        The hashes are computed by `n_workers` processes (by default one per
+        CPU), in batches of `batch_size`. The hash function is passed to them
+        by forking, so it doesn't need to be picklable and can be a lambda.
+        """
         self.hash_function = hash_function
         self.cache_file = cache_file
         self.max_n_images = max_n_images
+        self.input_dir = input_dir
+        self.mask_store_dir = mask_store_dir
+        self.n_workers = n_workers
+        self.batch_size = batch_size
+        self.hash_function_id = hash_function_id or get_hash_function_id(hash_function)
 
-        hash_size = check_hash_function(hash_function)
-        self.hash_size = hash_size
-
-        if cache_file.exists():
-            hashes = np.load(cache_file)
-            self.make_index(hashes)
+        if mask_store_dir is not None:
+            example = open_mask_store(mask_store_dir)[0]
         else:
-            self.make_index()
+            example = get_example_image()
+
+        self.hash_size, self.hash_dtype = check_hash_function(hash_function, example)
+        self.is_binary = self.hash_dtype == np.uint8
+        self.index_type = index_type
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+
+        self.names: list[str] = []
+        self.index = None
+        self.update()
+
+    @property
+    def metadata_file(self) -> Path:
+        return self.cache_file.with_suffix(".json")
+
+    @property
+    def index_file(self) -> Path:
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", self.index_type)
+        return self.cache_file.with_name(f"{self.cache_file.stem}.{slug}.faiss")
 
     def make_index(self, hashes: np.ndarray | None = None) -> None:
         if hashes is None:
-            hashes = self.compute_hashes()
+            hashes = self.compute_hashes(self.get_names())
 
         print(hashes.shape)
 
-        self.index = faiss.IndexFlatL2(self.hash_size)
-        self.index.add(hashes)
+        self.index = make_faiss_index(
+            self.hash_size, self.is_binary, self.index_type, hashes
+        )
+        self.set_search_parameters(self.nprobe, self.ef_search)
+
+    def set_search_parameters(
+        self, nprobe: int | None = None, ef_search: int | None = None
+    ):
+        self.nprobe = nprobe or self.nprobe
+        self.ef_search = ef_search or self.ef_search
+        set_search_parameters(self.index, nprobe, ef_search)
+
+    def get_index_metadata(self, names: list[str]) -> dict:
+        """Identifies the rows of the index, like `get_metadata` for the cache."""
+        return {**self.get_metadata(names), "index_type": self.index_type}
+
+    def save_index(self):
+        if self.index_type == "flat":
+            return
+
+        tmp_index_file = self.index_file.with_suffix(".tmp")
+        if self.is_binary:
+            faiss.write_index_binary(self.index, str(tmp_index_file))
+        else:
+            faiss.write_index(self.index, str(tmp_index_file))
+        os.replace(tmp_index_file, self.index_file)
+
+        index_metadata = self.get_index_metadata(self.names)
+        self.index_file.with_suffix(".json").write_text(json.dumps(index_metadata))
+
+    def load_index(self, names: list[str]) -> bool:
+        """Loads the persisted index if it contains exactly the rows `names`."""
+        metadata_file = self.index_file.with_suffix(".json")
+        if self.index_type == "flat" or not metadata_file.exists():
+            return False
+
+        metadata = json.loads(metadata_file.read_text())
+        if metadata != self.get_index_metadata(names):
+            return False
+
+        if self.is_binary:
+            self.index = faiss.read_index_binary(str(self.index_file))
+        else:
+            self.index = faiss.read_index(str(self.index_file))
+        self.set_search_parameters(self.nprobe, self.ef_search)
+        return True
+
+    def get_names(self) -> list[str]:
+        """Returns the names of the cutouts in the corpus, in order."""
+        if self.mask_store_dir is not None:
+            return open_mask_store(self.mask_store_dir).names[: self.max_n_images]
+        else:
+            return list_images(self.input_dir, self.max_n_images)
+
+    def get_metadata(self, names: list[str]) -> dict:
+        return {
+            "version": CACHE_VERSION,
+            "hash_function_id": self.hash_function_id,
+            "hash_size": self.hash_size,
+            "hash_dtype": self.hash_dtype.name,
+            "source": "masks" if self.mask_store_dir is not None else "images",
+            "fingerprint": get_fingerprint(names),
+        }
+
+    def load_cache(self) -> tuple[list[str], np.ndarray | None, dict]:
+        """Returns the names and hashes of the cached rows and the metadata, or
+        no rows if there is no usable cache."""
+        if not (self.cache_file.exists() and self.metadata_file.exists()):
+            return [], None, {}
+
+        metadata = json.loads(self.metadata_file.read_text())
+        names = metadata.pop("names")
+        hashes = np.load(self.cache_file, mmap_mode="r")
+
+        expected = self.get_metadata(names)
+        keys = ["version", "hash_function_id", "hash_size", "hash_dtype", "source"]
+        for key in keys:
+            if metadata.get(key) != expected[key]:
+                print(f"Ignoring the cache in {self.cache_file}, {key} has changed.")
+                return [], None, {}
+
+        if hashes.shape != (len(names), self.hash_size):
+            print(f"Ignoring the cache in {self.cache_file}, it is inconsistent.")
+            return [], None, {}
+
+        return names, hashes, metadata
+
+    def update(self) -> None:
+        """Brings the index up to date with the corpus, hashing only the cutouts
+        that are not in the cache yet."""
+        corpus_names = self.get_names()
+        cached_names, cached_hashes, metadata = self.load_cache()
+
+        if metadata.get("fingerprint") == get_fingerprint(corpus_names):
+            if self.names != cached_names:
+                if not self.load_index(cached_names):
+                    self.make_index(cached_hashes)
+                self.names = cached_names
+                self.save_index()
+            return
+
+        corpus = set(corpus_names)
+        cached = set(cached_names)
+        kept = [i for i, name in enumerate(cached_names) if name in corpus]
+        new_names = [name for name in corpus_names if name not in cached]
+        names = [cached_names[i] for i in kept] + new_names
+
+        # Write to temporary files first, so that a crash can't leave a cache
+        # whose rows don't match its names.
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_cache_file = self.cache_file.with_suffix(".tmp.npy")
+        tmp_metadata_file = self.metadata_file.with_suffix(".tmp.json")
+
+        hashes = np.lib.format.open_memmap(
+            tmp_cache_file,
+            mode="w+",
+            dtype=self.hash_dtype,
+            shape=(len(names), self.hash_size),
+        )
+        if kept:
+            hashes[: len(kept)] = cached_hashes[kept]
+        self.compute_hashes(new_names, out=hashes[len(kept) :])
+        hashes.flush()
+
+        metadata = {**self.get_metadata(corpus_names), "names": names}
+        tmp_metadata_file.write_text(json.dumps(metadata))
+        os.replace(tmp_cache_file, self.cache_file)
+        os.replace(tmp_metadata_file, self.metadata_file)
+
+        print(
+            f"Hashed {len(new_names)} new cutouts, kept {len(kept)}, "
+            f"removed {len(cached_names) - len(kept)}."
+        )
 
-    def compute_hashes(self):
-        hashes = []
+        # If the index already has the cached rows, there's no need to rebuild it.
+        if self.index is None and len(kept) == len(cached_names):
+            self.load_index(cached_names)
+            self.names = cached_names if self.index is not None else []
 
-        for image in tqdm.auto.tqdm(
-            iterate_images(DATA_DIR / "cutouts2", max_n_images=self.max_n_images),
-            total=self.max_n_images,
+        if (
+            self.index is not None
+            and len(kept) == len(cached_names)
+            and self.names == cached_names
         ):
-            h = self.hash_function(image)
-            assert len(h) == self.hash_size
-            hashes.append(h)
+            self.index.add(np.ascontiguousarray(hashes[len(kept) :]))
+        else:
+            self.make_index(hashes)
+        self.names = names
+        self.save_index()
+
+    def iter_batches(self, names: list[str]) -> Iterator[tuple]:
+        """Yields the tasks for `hash_encoded_batch` or `hash_mask_batch`."""
+        if self.mask_store_dir is not None:
+            store = open_mask_store(self.mask_store_dir)
+            store_indices = np.array(
+                [store.name_to_index[name] for name in names], dtype=np.int64
+            )
+            for start in range(0, len(names), self.batch_size):
+                end = start + self.batch_size
+                yield start, store_indices[start:end], self.mask_store_dir
+        else:
+            encoded_images = iterate_encoded_images(
+                self.input_dir, self.max_n_images, only=set(names)
+            )
+            for start in itertools.count(0, self.batch_size):
+                batch = list(itertools.islice(encoded_images, self.batch_size))
+                if not batch:
+                    break
+
+                batch_names = [name for name, _ in batch]
+                assert batch_names == names[start : start + len(batch)]
+                yield start, [data for _, data in batch]
+
+    def compute_hashes(
+        self, names: list[str], out: np.ndarray | None = None
+    ) -> np.ndarray:
+        """Computes the hashes of the named cutouts, which must be in the order
+        of `get_names`.
+
+        They are written into `out` if given, which can be a memmap, otherwise
+        into a new array.
+        """
+        n_images = len(names)
+        if out is None:
+            out = np.empty((n_images, self.hash_size), dtype=self.hash_dtype)
+        assert out.shape == (n_images, self.hash_size)
+
+        if n_images == 0:
+            return out
+
+        if self.mask_store_dir is not None:
+            f = hash_mask_batch
+        else:
+            f = hash_encoded_batch
+
+        # Keep the pool from reading all images into memory ahead of the workers.
+        n_workers = self.n_workers or multiprocessing.cpu_count()
+        in_flight = threading.Semaphore(4 * n_workers)
+        stopped = threading.Event()
 
-        return np.array(hashes)
+        def throttle(batches):
+            for batch in batches:
+                in_flight.acquire()
+                if stopped.is_set():
+                    return
+                yield batch
+
+        def write(results: Iterator[tuple[int, np.ndarray]]):
+            with tqdm.auto.tqdm(total=n_images, unit="image") as progress_bar:
+                for start, hashes in results:
+                    in_flight.release()
+                    assert hashes.shape[1:] == (self.hash_size,)
+                    out[start : start + len(hashes)] = hashes
+                    progress_bar.update(len(hashes))
+
+        batches = throttle(self.iter_batches(names))
+
+        if n_workers == 1:
+            init_worker(self.hash_function)
+            write(map(f, batches))
+        else:
+            context = multiprocessing.get_context("fork")
+            with context.Pool(
+                n_workers, initializer=init_worker, initargs=(self.hash_function,)
+            ) as pool:
+                try:
+                    write(pool.imap_unordered(f, batches))
+                finally:
+                    # Like in `extract_good_cutouts.run_extraction`: if a
+                    # worker raised, the pool's feeder thread may be stuck in
+                    # `throttle` and terminating the pool would wait for it.
+                    stopped.set()
+                    in_flight.release()
+
+        return out
+
+    def get_hashes(self) -> np.ndarray:
+        """Returns the hashes of all rows, memory-mapped from the cache."""
+        return np.load(self.cache_file, mmap_mode="r")
+
+    def open_image(self, name: str) -> Image.Image:
+        """Opens a cutout by its name, as returned by `get_closest_batch`."""
+        return open_image(self.input_dir, name)
 
     def get_closest(self, image: Image.Image, n: int = 10):
-        h = self.hash_function(image)
-        distances, indices = self.index.search(h[np.newaxis, :], n)
+        h = hash_batch(self.hash_function, [image])
+        distances, indices = self.index.search(h, n)
         return indices[0]
+
+    def get_closest_batch(
+        self, images: list[Image.Image] | np.ndarray, k: int = 10
+    ) -> tuple[np.ndarray, np.ndarray, list[list[str | None]]]:
+        """Finds the k closest cutouts for each of a batch of images, or of
+        hashes if given an N x hash size array of the hash dtype.
+
+        Returns:
+            the N x k distances (squared L2 or Hamming), the N x k row indices and
+            the names of the cutouts, relative to `input_dir`. If there are
+            fewer than k rows, the missing results have index -1 and name None.
+        """
+        is_hashes = (
+            isinstance(images, np.ndarray)
+            and images.dtype == self.hash_dtype
+            and images.shape[1:] == (self.hash_size,)
+        )
+
+        if is_hashes:
+            hashes = images
+        elif len(images) == 0:
+            hashes = np.zeros((0, self.hash_size), dtype=self.hash_dtype)
+        else:
+            hashes = hash_batch(self.hash_function, images)
+
+        distances, indices = self.index.search(np.ascontiguousarray(hashes), k)
+        names = [
+            [self.names[i] if i >= 0 else None for i in row] for row in indices.tolist()
+        ]
+        return distances, indices, names
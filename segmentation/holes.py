@@ -0,0 +1,143 @@
+"""Finds cutouts that fit into the empty regions left on a canvas.
+
+Instead of trying random cutouts at random positions, each empty region
+("hole") of the occupancy mask is turned into a query shaped like a
+standardized cutout and hashed with the hash function of a `HashIndex`. The
+closest cutouts are then scaled to the hole and kept only if they fit into it,
+so the proposals that reach placement scoring are few and all feasible.
+"""
+
+from typing import Iterable
+
+import numpy as np
+from PIL import Image
+from PIL.Image import Image as ImageType
+import scipy.ndimage
+import skimage.feature
+import skimage.measure
+import skimage.segmentation
+
+from segmentation.cutting import to_standard_cutout
+from segmentation.hash_index import HashIndex
+from segmentation.placement import PlacementProposal, get_overlap_map, to_mask
+
+Box = tuple[int, int, int, int]
+
+# Scales of a cutout relative to the hole it's fitted into, tried in order.
+HOLE_SCALES = (1.0, 0.9, 0.8, 0.7, 0.6, 0.5)
+
+
+def find_holes(
+    occupancy: np.ndarray | ImageType, min_area: int = 256, min_distance: int = 16
+) -> list[tuple[Box, np.ndarray]]:
+    """Splits the empty space of the canvas into holes, largest first.
+
+    The free space is usually all connected, so it's split at its narrow
+    parts by a watershed of the distance to the nearest occupied pixel, with
+    one hole per local maximum at least `min_distance` apart. Returns
+    (box, mask of the hole inside the box) pairs. Boxes are (left, top, right,
+    bottom) like in PIL.
+    """
+    free = ~to_mask(occupancy)
+    distance = scipy.ndimage.distance_transform_edt(free)
+    peaks = skimage.feature.peak_local_max(
+        distance, min_distance=min_distance, labels=skimage.measure.label(free)
+    )
+    markers = np.zeros(free.shape, dtype=np.int32)
+    markers[tuple(peaks.T)] = np.arange(1, len(peaks) + 1)
+    labels = skimage.segmentation.watershed(-distance, markers, mask=free)
+
+    holes = []
+    for region in skimage.measure.regionprops(labels):
+        if region.area < min_area:
+            continue
+        top, left, bottom, right = region.bbox
+        holes.append(((left, top, right, bottom), region.image))
+
+    holes.sort(key=lambda hole: -hole[1].sum())
+    return holes
+
+
+def get_hole_query(hole_mask: np.ndarray) -> ImageType:
+    """Makes a standardized cutout with the shape of the hole, to hash it like
+    the cutouts in the index."""
+    alpha = Image.fromarray(hole_mask.astype(np.uint8) * 255, mode="L")
+    query = Image.new("RGBA", alpha.size)
+    query.putalpha(alpha)
+    return to_standard_cutout(query)
+
+
+def fit_into_hole(
+    occupancy: np.ndarray,
+    box: Box,
+    cutout: ImageType,
+    scales: Iterable[float] = HOLE_SCALES,
+) -> PlacementProposal | None:
+    """Scales the cutout to the hole, trying smaller scales until it fits.
+
+    Returns the scaled cutout and the free position closest to the center of
+    the hole, in canvas coordinates, or None if it doesn't fit at any scale.
+    """
+    left, top, right, bottom = box
+    cutout = cutout.crop(cutout.getbbox())
+    hole_scale = min((right - left) / cutout.width, (bottom - top) / cutout.height)
+    region = occupancy[top:bottom, left:right]
+    # A cutout with more pixels than the free ones can't fit, no need to check.
+    max_area_ratio = np.count_nonzero(~region) / np.count_nonzero(to_mask(cutout))
+
+    for scale in scales:
+        if (hole_scale * scale) ** 2 > max_area_ratio:
+            continue
+
+        width = int(cutout.width * hole_scale * scale)
+        height = int(cutout.height * hole_scale * scale)
+        if width < 1 or height < 1:
+            return None
+
+        scaled = cutout.resize((width, height))
+        y, x = np.nonzero(get_overlap_map(region, scaled) == 0)
+        if len(x) == 0:
+            continue
+
+        center_x, center_y = (right - left - width) / 2, (bottom - top - height) / 2
+        closest = np.argmin((x - center_x) ** 2 + (y - center_y) ** 2)
+        return scaled, (left + int(x[closest]), top + int(y[closest]))
+
+    return None
+
+
+def propose_for_holes(
+    occupancy: np.ndarray | ImageType,
+    index: HashIndex,
+    n_candidates: int = 10,
+    min_area: int = 256,
+    max_n_holes: int | None = None,
+    scales: Iterable[float] = HOLE_SCALES,
+) -> list[PlacementProposal]:
+    """Proposes cutouts from the index that fit into the holes of the canvas.
+
+    For each hole, largest first, the `n_candidates` cutouts with the closest
+    hashes are fitted into it, and those that fit are proposed, closest first.
+    The hash function of the index must accept RGBA images. Nearly every proposal
+    is of a different cutout, so place them with
+    `placement.place_best_tightness_locally`.
+    """
+    occupancy = to_mask(occupancy)
+    holes = find_holes(occupancy, min_area)[:max_n_holes]
+    if not holes:
+        return []
+
+    queries = [get_hole_query(hole_mask) for _, hole_mask in holes]
+    _, _, candidate_names = index.get_closest_batch(queries, n_candidates)
+
+    proposals = []
+    for (box, _), names in zip(holes, candidate_names):
+        for name in names:
+            if name is None:
+                continue
+            cutout = index.open_image(name).convert("RGBA")
+            proposal = fit_into_hole(occupancy, box, cutout, scales)
+            if proposal is not None:
+                proposals.append(proposal)
+
+    return proposals
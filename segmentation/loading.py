@@ -1,9 +1,13 @@
+import functools
+import io
 import itertools
 from pathlib import Path
-from typing import Iterable
+from typing import Callable, Iterable
 from PIL import Image
 from PIL.Image import Image as ImageType
 
+from segmentation import shards
+
 DATA_DIR = Path(__file__).parent.parent / "data"
 
 
@@ -18,6 +22,86 @@ def images_in_dir(dir: Path):
         yield from images_in_dir(subdir)
 
 
+def iterate_image_sources(
+    dir: Path, root: Path | None = None
+) -> Iterable[tuple[str, Callable[[], bytes]]]:
+    """Yields (name, function reading the encoded image) in the order of
+    `images_in_dir`, reading the shards of a directory after its loose images.
+
+    The names are the paths relative to `root`, for cutouts in shards as if
+    they were loose files. The functions are only valid until the next item.
+    """
+    root = root or dir
+
+    for path in sorted(dir.glob("*.webp")):
+        yield path.relative_to(root).as_posix(), path.read_bytes
+
+    if shards.has_shards(dir):
+        prefix = dir.relative_to(root)
+        with shards.ShardReader(dir) as reader:
+            for i, key in enumerate(reader.keys()):
+                name = (prefix / shards.get_cutout_name(*key)).as_posix()
+                yield name, functools.partial(reader.read, i)
+
+    for subdir in sorted(dir.glob("*/")):
+        yield from iterate_image_sources(subdir, root)
+
+
+def iterate_encoded_images(
+    dir: Path, max_n_images: int | None = None, only: set[str] | None = None
+) -> Iterable[tuple[str, bytes]]:
+    """Like `iterate_images`, but yields (name, encoded image) pairs. With `only`,
+    the images with other names are skipped without reading them."""
+    for name, read in itertools.islice(iterate_image_sources(dir), max_n_images):
+        if only is None or name in only:
+            yield name, read()
+
+
+def list_images(dir: Path, max_n_images: int | None = None) -> list[str]:
+    """Returns the names `iterate_named_images` would yield, without reading the
+    images."""
+    sources = itertools.islice(iterate_image_sources(dir), max_n_images)
+    return [name for name, _ in sources]
+
+
+def open_image(dir: Path, name: str) -> ImageType:
+    """Opens a cutout by its name from `iterate_named_images`, whether it is a
+    loose file or in a shard."""
+    path = dir / name
+    if path.exists():
+        return Image.open(path)
+
+    return get_shard_reader(path.parent)[shards.parse_cutout_name(path.name)]
+
+
+@functools.lru_cache(maxsize=16)
+def get_shard_reader(dir: Path) -> shards.ShardReader:
+    """Opens the shards of a directory once, so cutouts added to them later are
+    not visible to `open_image`."""
+    return shards.ShardReader(dir)
+
+
+def iterate_named_images(
+    dir: Path, max_n_images: int | None = None
+) -> Iterable[tuple[str, ImageType]]:
+    """Like `iterate_images`, but yields (name, image) pairs."""
+    for name, data in iterate_encoded_images(dir, max_n_images):
+        yield name, Image.open(io.BytesIO(data))
+
+
+def count_images(dir: Path) -> int:
+    """Counts the cutouts `iterate_images` would yield, without reading them."""
+    n_images = len(list(dir.glob("*.webp")))
+
+    if shards.has_shards(dir):
+        with shards.ShardReader(dir) as reader:
+            n_images += len(reader)
+
+    return n_images + sum(count_images(subdir) for subdir in dir.glob("*/"))
+
+
 def iterate_images(dir: Path, max_n_images: int | None = None) -> Iterable[ImageType]:
-    for path in itertools.islice(images_in_dir(dir), max_n_images):
-        yield Image.open(path)
+    """Iterates over the cutouts in the directory and its subdirectories, whether
+    they are stored as loose files or in shards (see `segmentation.shards`)."""
+    for _, image in iterate_named_images(dir, max_n_images):
+        yield image
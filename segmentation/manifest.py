@@ -0,0 +1,145 @@
+"""A SQLite record of which source images have been turned into cutouts.
+
+Lets extraction runs skip finished images without listing the output directory,
+and answers questions about the extracted corpus, like the number of cutouts per
+shard.
+"""
+
+import argparse
+from collections import Counter
+import json
+from pathlib import Path
+import sqlite3
+import time
+
+STATUS_DONE = "done"
+# The image indices are not quite continuous, some images don't exist.
+STATUS_MISSING = "missing"
+
+
+class Manifest:
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Several extraction processes may share one manifest, hence the timeout.
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS images (
+                    image TEXT PRIMARY KEY,
+                    shard TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    n_cutouts INTEGER NOT NULL,
+                    reject_reasons TEXT NOT NULL,
+                    output_paths TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS images_shard ON images (shard)"
+            )
+
+    def __enter__(self) -> "Manifest":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def record(
+        self,
+        image: str,
+        shard: str,
+        status: str = STATUS_DONE,
+        output_paths: list[str] | None = None,
+        reject_reasons: dict[str, int] | None = None,
+    ):
+        """Records a processed source image, replacing any previous record."""
+        output_paths = output_paths or []
+
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    image,
+                    shard,
+                    status,
+                    len(output_paths),
+                    json.dumps(reject_reasons or {}),
+                    json.dumps([str(p) for p in output_paths]),
+                    time.time(),
+                ),
+            )
+
+    def is_done(self, image: str) -> bool:
+        row = self.connection.execute(
+            "SELECT 1 FROM images WHERE image = ?", (image,)
+        ).fetchone()
+        return row is not None
+
+    def get_done(self, shard: str | None = None) -> set[str]:
+        """Returns the names of the recorded images, optionally only for one shard."""
+        if shard is None:
+            rows = self.connection.execute("SELECT image FROM images")
+        else:
+            rows = self.connection.execute(
+                "SELECT image FROM images WHERE shard = ?", (shard,)
+            )
+        return {image for (image,) in rows}
+
+    def get_output_paths(self, image: str) -> list[str]:
+        row = self.connection.execute(
+            "SELECT output_paths FROM images WHERE image = ?", (image,)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else []
+
+    def get_n_cutouts_per_shard(self) -> dict[str, int]:
+        rows = self.connection.execute(
+            "SELECT shard, SUM(n_cutouts) FROM images GROUP BY shard ORDER BY shard"
+        )
+        return dict(rows)
+
+    def get_n_images_per_status(self, shard: str | None = None) -> dict[str, int]:
+        query = "SELECT status, COUNT(*) FROM images"
+        if shard is None:
+            rows = self.connection.execute(query + " GROUP BY status")
+        else:
+            rows = self.connection.execute(
+                query + " WHERE shard = ? GROUP BY status", (shard,)
+            )
+        return dict(rows)
+
+    def get_reject_reasons(self, shard: str | None = None) -> Counter:
+        """Sums up the rejection counts of all images, optionally of one shard."""
+        if shard is None:
+            rows = self.connection.execute("SELECT reject_reasons FROM images")
+        else:
+            rows = self.connection.execute(
+                "SELECT reject_reasons FROM images WHERE shard = ?", (shard,)
+            )
+
+        total = Counter()
+        for (reject_reasons,) in rows:
+            total.update(json.loads(reject_reasons))
+        return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarizes an extraction manifest")
+    parser.add_argument("path", type=Path)
+    args = parser.parse_args()
+
+    with Manifest(args.path) as manifest:
+        print("Images per status:", manifest.get_n_images_per_status())
+        print("Cutouts per shard:")
+        for shard, n_cutouts in manifest.get_n_cutouts_per_shard().items():
+            print(f"  {shard}: {n_cutouts}")
+        print("Reject reasons:", dict(manifest.get_reject_reasons()))
@@ -0,0 +1,119 @@
+"""Precomputed alpha masks of the cutouts, bit-packed and memory-mapped.
+
+Many steps only need to know which pixels of a cutout are opaque. Decoding the
+full RGBA image for that is wasteful, so the store keeps the masks of all
+cutouts in one file, 8 KB per 256x256 mask, in the order of
+`loading.iterate_images`. The file is memory-mapped, so processes reading the
+same store share it through the page cache.
+"""
+
+import argparse
+import functools
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import tqdm.auto
+
+from segmentation.loading import DATA_DIR, iterate_named_images
+from segmentation.placement import to_mask
+
+MASK_SIZE = 256
+PACKED_SHAPE = (MASK_SIZE, MASK_SIZE // 8)
+
+MASKS_FILENAME = "masks.bin"
+NAMES_FILENAME = "names.txt"
+
+# Number of set bits of every byte value
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(
+    axis=1
+)
+
+
+def pack_mask(mask: np.ndarray) -> np.ndarray:
+    """Packs a 256x256 boolean mask into 256x32 bytes, each row separately."""
+    if mask.shape != (MASK_SIZE, MASK_SIZE):
+        raise ValueError(f"Expected a {MASK_SIZE}x{MASK_SIZE} mask, got {mask.shape}")
+    return np.packbits(mask, axis=-1)
+
+
+def build_mask_store(input_dir: Path, store_dir: Path, max_n_images: int | None = None):
+    """Computes the masks of the cutouts in `input_dir`, replacing any existing
+    store in `store_dir`."""
+    store_dir.mkdir(parents=True, exist_ok=True)
+
+    with (
+        open(store_dir / MASKS_FILENAME, "wb") as masks_file,
+        open(store_dir / NAMES_FILENAME, "w") as names_file,
+    ):
+        for name, image in tqdm.auto.tqdm(
+            iterate_named_images(input_dir, max_n_images), total=max_n_images
+        ):
+            masks_file.write(pack_mask(to_mask(image)).tobytes())
+            names_file.write(name + "\n")
+
+
+class MaskStore:
+    def __init__(self, store_dir: Path):
+        self.store_dir = store_dir
+        self.names = (store_dir / NAMES_FILENAME).read_text().splitlines()
+
+        masks_path = store_dir / MASKS_FILENAME
+        if masks_path.stat().st_size == 0:
+            self.packed = np.zeros((0, *PACKED_SHAPE), dtype=np.uint8)
+        else:
+            self.packed = np.memmap(masks_path, dtype=np.uint8, mode="r").reshape(
+                -1, *PACKED_SHAPE
+            )
+
+        if len(self.packed) != len(self.names):
+            raise ValueError(
+                f"The store in {store_dir} has {len(self.packed)} masks "
+                f"but {len(self.names)} names, was its build interrupted?"
+            )
+
+    @functools.cached_property
+    def name_to_index(self) -> dict[str, int]:
+        return {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self) -> int:
+        return len(self.packed)
+
+    def get_packed(self, indices: int | slice | np.ndarray) -> np.ndarray:
+        """Returns the packed masks without copying if `indices` is an int or a slice."""
+        return self.packed[indices]
+
+    def __getitem__(self, indices: int | slice | np.ndarray) -> np.ndarray:
+        """Returns the unpacked mask(s) as a boolean array, 256x256 or Nx256x256."""
+        return np.unpackbits(self.packed[indices], axis=-1).view(bool)
+
+    def get_by_name(self, name: str) -> np.ndarray:
+        return self[self.name_to_index[name]]
+
+    def iter_batches(self, batch_size: int = 256) -> Iterator[np.ndarray]:
+        """Yields the unpacked masks in order, as Nx256x256 boolean arrays."""
+        for start in range(0, len(self), batch_size):
+            yield self[start : start + batch_size]
+
+    def get_coverage(
+        self, indices: int | slice | np.ndarray = slice(None)
+    ) -> np.ndarray:
+        """Returns the fraction of opaque pixels of the masks, without unpacking."""
+        counts = POPCOUNT[self.packed[indices]].sum(axis=(-2, -1))
+        return counts / (MASK_SIZE * MASK_SIZE)
+
+
+@functools.cache
+def open_mask_store(store_dir: Path) -> MaskStore:
+    """Returns the store, opening it only once per process."""
+    return MaskStore(store_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds a store of cutout masks")
+    parser.add_argument("--input-dir", "-i", type=Path, default=DATA_DIR / "cutouts2")
+    parser.add_argument("--output-dir", "-o", type=Path, default=DATA_DIR / "masks")
+    parser.add_argument("--max-n-images", type=int, default=None)
+    args = parser.parse_args()
+
+    build_mask_store(args.input_dir, args.output_dir, args.max_n_images)
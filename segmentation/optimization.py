@@ -1,17 +1,156 @@
-from typing import Iterable, TypeVar, Callable
+"""Picks the best-scoring items of an iterable.
+
+The items are scored in batches, either one by one by a scoring function or
+all at once by a batched one, serially or on a pool of threads or processes.
+The search can keep the `k` best items instead of just the best one and stop
+early once it has used up its evaluations or time or reached a target score.
+"""
+
+import collections
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
+import functools
+import heapq
+import itertools
+import os
+import time
+from typing import Callable, Iterable, Iterator, Sequence, TypeVar
+
 import numpy as np
 
 T = TypeVar("T")
 
+EXECUTORS = ["serial", "thread", "process"]
+
+# Set in each worker process, so that it's not sent along with every batch.
+worker_scoring_fn: Callable | None = None
+
+
+def score_batch(scoring_fn: Callable, batch: Sequence[T], batched: bool) -> list[float]:
+    if batched:
+        return list(scoring_fn(batch))
+    return [scoring_fn(item) for item in batch]
+
+
+def init_worker(scoring_fn: Callable):
+    global worker_scoring_fn
+    worker_scoring_fn = scoring_fn
+
+
+def score_batch_in_worker(batch: Sequence[T], batched: bool) -> list[float]:
+    return score_batch(worker_scoring_fn, batch, batched)
+
+
+def iter_scored_batches(
+    batches: Iterator[list[T]],
+    scoring_fn: Callable,
+    batched: bool,
+    executor: str,
+    n_workers: int | None,
+) -> Iterator[tuple[list[T], list[float]]]:
+    """Yields the batches with their scores in order. With a pool, at most two
+    batches per worker are in flight, so that stopping early wastes little work
+    and infinite iterables work too."""
+    if executor == "serial":
+        for batch in batches:
+            yield batch, score_batch(scoring_fn, batch, batched)
+        return
+
+    n_workers = n_workers or os.cpu_count() or 1
+    if executor == "thread":
+        pool = ThreadPoolExecutor(n_workers)
+        submit = functools.partial(pool.submit, score_batch, scoring_fn)
+    else:
+        pool = ProcessPoolExecutor(
+            n_workers, initializer=init_worker, initargs=(scoring_fn,)
+        )
+        submit = functools.partial(pool.submit, score_batch_in_worker)
+
+    with pool:
+        in_flight: collections.deque[tuple[list[T], Future]] = collections.deque()
+        try:
+            for batch in batches:
+                future = submit(batch, batched)
+                in_flight.append((batch, future))
+                if len(in_flight) >= 2 * n_workers:
+                    batch, future = in_flight.popleft()
+                    yield batch, future.result()
+
+            for batch, future in in_flight:
+                yield batch, future.result()
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+
+def select_top_k(
+    iterable: Iterable[T],
+    scoring_fn: Callable,
+    k: int = 10,
+    batched: bool = False,
+    batch_size: int = 64,
+    executor: str = "serial",
+    n_workers: int | None = None,
+    max_evaluations: int | None = None,
+    time_budget: float | None = None,
+    target_score: float | None = None,
+) -> list[tuple[T, float]]:
+    """Returns the `k` items with the highest scores, best first, with their scores.
+
+    With `batched`, `scoring_fn` takes a list of up to `batch_size` items and
+    returns their scores, otherwise it scores a single item. With the "process"
+    executor, the items and scores must be picklable, and so must `scoring_fn`
+    unless the processes are forked. The results don't depend on
+    the executor: ties go to the earlier item, and scores that are NaN or -inf
+    never make it into the results.
+
+    The search stops after `max_evaluations` items, after `time_budget` seconds
+    (checked between batches, so it can run over by up to a batch per worker),
+    or after the first batch with an item scoring at least `target_score`.
+    """
+    if executor not in EXECUTORS:
+        raise ValueError(f"Unknown executor {executor}, choose from {EXECUTORS}")
+
+    start = time.perf_counter()
+    items = itertools.islice(iterable, max_evaluations)
+    batches = iter(lambda: list(itertools.islice(items, batch_size)), [])
+
+    # A min-heap of (score, -index, item), so the worst of the top k is on top.
+    # The index breaks ties in favor of earlier items and keeps the items
+    # themselves from being compared.
+    top: list[tuple[float, int, T]] = []
+    index = 0
+
+    scored = iter_scored_batches(batches, scoring_fn, batched, executor, n_workers)
+    # Closing it right away cancels the batches still waiting for a worker.
+    with contextlib.closing(scored):
+        for batch, scores in scored:
+            for item, score in zip(batch, scores):
+                # Also false for NaN
+                if score > -np.inf:
+                    entry = (score, -index, item)
+                    if len(top) < k:
+                        heapq.heappush(top, entry)
+                    elif entry[:2] > top[0][:2]:
+                        heapq.heapreplace(top, entry)
+                index += 1
+
+            if target_score is not None and top and max(top)[0] >= target_score:
+                break
+            if time_budget is not None and time.perf_counter() - start >= time_budget:
+                break
 
-def select_best(iterable: Iterable[T], scoring_fn: Callable[[T], float]) -> T | None:
-    best = None
-    best_score = -np.inf
+    return [
+        (item, score)
+        for score, _, item in sorted(top, key=lambda entry: entry[:2], reverse=True)
+    ]
 
-    for item in iterable:
-        score = scoring_fn(item)
-        if score > best_score:
-            best = item
-            best_score = score
 
-    return best, best_score
+def select_best(
+    iterable: Iterable[T], scoring_fn: Callable, **kwargs
+) -> tuple[T | None, float]:
+    """Returns the item with the highest score and the score, or (None, -inf)
+    if there are no items. Takes the options of `select_top_k`."""
+    top = select_top_k(iterable, scoring_fn, k=1, **kwargs)
+    if not top:
+        return None, -np.inf
+    return top[0]
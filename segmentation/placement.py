@@ -2,10 +2,16 @@ from typing import Iterable
 import numpy as np
 from PIL import Image
 from PIL.Image import Image as ImageType
+import scipy.ndimage
+import scipy.signal
 import skimage
 from IPython.display import display
 
+from segmentation.optimization import select_best
+
 CANVAS_SIZE = (512, 512)
+# Width of the edge ring around a cutout that `get_tightness` looks at
+TIGHTNESS_DIAMETER = 10
 PlacementProposal = tuple[ImageType, tuple[int, int]]
 
 
@@ -129,6 +135,67 @@ def propose_grid(
             yield image, position
 
 
+def correlate_masks(image: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """Counts the pixels where the kernel and the image are both set, for every
+    position of the kernel fully inside the image, using the FFT.
+
+    Returns an integer array where [y, x] is the count with the kernel's top left
+    corner at (x, y).
+    """
+    if any(i < k for i, k in zip(image.shape, kernel.shape)):
+        return np.zeros((0, 0), dtype=np.int64)
+    if not image.any() or not kernel.any():
+        return np.zeros(np.subtract(image.shape, kernel.shape) + 1, dtype=np.int64)
+
+    correlation = scipy.signal.fftconvolve(
+        image.astype(np.float64), kernel[::-1, ::-1].astype(np.float64), mode="valid"
+    )
+    # The FFT leaves small rounding errors around the exact integer counts
+    return np.rint(correlation).astype(np.int64)
+
+
+def get_overlap_map(
+    canvas: np.ndarray | ImageType, cutout: np.ndarray | ImageType
+) -> np.ndarray:
+    """Counts the overlapping pixels for every position of the cutout inside the canvas.
+
+    Uses a single FFT cross-correlation of the masks instead of checking the
+    positions one by one. Returns an integer array where [y, x] is the overlap
+    when the cutout's top left corner is at (x, y), of shape
+    (canvas height - cutout height + 1, canvas width - cutout width + 1).
+    """
+    return correlate_masks(to_mask(canvas), to_mask(cutout))
+
+
+def get_feasible_positions(
+    canvas: np.ndarray | ImageType, cutout: np.ndarray | ImageType
+) -> np.ndarray:
+    """Returns all (x, y) positions where the cutout fits without overlap, as Nx2."""
+    y, x = np.nonzero(get_overlap_map(canvas, cutout) == 0)
+    return np.stack([x, y], axis=1)
+
+
+def propose_feasible_positions(
+    image: ImageType,
+    canvas: ImageType | np.ndarray,
+    attempts: int = 100,
+    rng: np.random.Generator | None = None,
+) -> Iterable[PlacementProposal]:
+    """Like `propose_random_positions`, but only proposes positions without overlap.
+
+    `canvas` can also be an occupancy mask, like `Canvas.mask`. Yields nothing
+    if the cutout fits nowhere.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    positions = get_feasible_positions(canvas, image)
+    chosen = rng.choice(len(positions), min(attempts, len(positions)), replace=False)
+
+    for x, y in positions[chosen].tolist():
+        yield image, (x, y)
+
+
 def to_mask(image: np.ndarray | ImageType) -> np.ndarray:
     """Returns a mask from the alpha channel as a boolean NumPy array (false = transparent)."""
     if isinstance(image, Image.Image):
@@ -156,7 +223,7 @@ def get_tightness(
     fg_mask = to_mask(fg_mask)
     assert bg_mask.shape == fg_mask.shape, "Masks have different sizes"
 
-    diameter = 10
+    diameter = TIGHTNESS_DIAMETER
 
     def pad(mask, value=0):
         return np.pad(
@@ -178,6 +245,30 @@ def get_tightness(
     return np.sum(edge_visible)
 
 
+def get_edge_ring(cutout: np.ndarray | ImageType) -> np.ndarray:
+    """The pixels within `TIGHTNESS_DIAMETER` of the cutout but outside it, with
+    the cutout padded by that much on each side."""
+    diameter = TIGHTNESS_DIAMETER
+    cutout_mask = np.pad(to_mask(cutout), diameter, constant_values=False)
+    dilated = skimage.morphology.dilation(
+        cutout_mask, skimage.morphology.disk(diameter)
+    )
+    return dilated & ~cutout_mask
+
+
+def get_tightness_map(
+    canvas: np.ndarray | ImageType, cutout: np.ndarray | ImageType
+) -> np.ndarray:
+    """`get_tightness` for every position of the cutout inside the canvas at once.
+
+    The edge ring around the cutout doesn't depend on its position, so the
+    tightness is a correlation of the ring with the padded canvas. The result is
+    indexed like `get_overlap_map`.
+    """
+    canvas_mask = np.pad(to_mask(canvas), TIGHTNESS_DIAMETER, constant_values=True)
+    return correlate_masks(canvas_mask, get_edge_ring(cutout))
+
+
 def place_greedily(
     canvas: ImageType, proposals: Iterable[PlacementProposal]
 ) -> ImageType | None:
@@ -193,17 +284,201 @@ def place_greedily(
 def place_best_tightness(
     canvas: ImageType, proposals: Iterable[PlacementProposal]
 ) -> ImageType | None:
-    best = None
-    best_tightness = -np.inf
+    """Places the proposal with the highest tightness among those without overlap.
+
+    The overlap and tightness of all positions are computed once per cutout, so
+    each proposal is only a lookup. Positions that would put part of the cutout
+    outside the canvas are skipped.
+
+    When most proposals are of different cutouts, like those of
+    `holes.propose_for_holes`, `place_best_tightness_locally` is faster.
+    """
+    maps = {}
+
+    def get_tightness_from_maps(proposal: PlacementProposal) -> float:
+        cur_cutout, (x, y) = proposal
+        if id(cur_cutout) not in maps:
+            maps[id(cur_cutout)] = (
+                cur_cutout,  # Keeps the id from being reused
+                get_overlap_map(canvas, cur_cutout),
+                get_tightness_map(canvas, cur_cutout),
+            )
+        _, overlap_map, tightness_map = maps[id(cur_cutout)]
 
-    for i, (cur_cutout, position) in enumerate(proposals):
-        # position = rng.integers(0, 512, size=2)
-        cur_cutout = expand_cutout_canvas(cur_cutout, position, canvas_size=canvas.size)
+        if not (0 <= y < overlap_map.shape[0] and 0 <= x < overlap_map.shape[1]):
+            return -np.inf
+        if overlap_map[y, x] != 0:
+            return -np.inf
+        return tightness_map[y, x]
 
-        if not has_overlap(canvas, cur_cutout):
-            tightness = get_tightness(bg_mask=canvas, fg_mask=cur_cutout)
-            if tightness > best_tightness:
-                best = cur_cutout
-                best_tightness = tightness
+    best, _ = select_best(proposals, get_tightness_from_maps)
+
+    if best is None:
+        return None
+
+    return place_image(canvas, expand_cutout_canvas(*best, canvas_size=canvas.size))
+
+
+def get_local_tightness(
+    canvas_mask: np.ndarray,
+    cutout_mask: np.ndarray,
+    ring: np.ndarray,
+    position: tuple[int, int],
+) -> float:
+    """`get_tightness` computed only around the cutout, given its mask and
+    `get_edge_ring`. Returns -inf if the cutout would overlap the canvas or
+    stick out of it."""
+    x, y = position
+    diameter = TIGHTNESS_DIAMETER
+    height, width = canvas_mask.shape
+    cutout_height, cutout_width = cutout_mask.shape
+
+    if not (0 <= x <= width - cutout_width and 0 <= y <= height - cutout_height):
+        return -np.inf
+    if np.any(canvas_mask[y : y + cutout_height, x : x + cutout_width] & cutout_mask):
+        return -np.inf
+
+    # The window of the canvas padded by `diameter` that the ring covers,
+    # padded with occupied pixels like in `get_tightness`.
+    top, left = y - diameter, x - diameter
+    bottom, right = y + cutout_height + diameter, x + cutout_width + diameter
+    window = np.ones(ring.shape, dtype=bool)
+    window[
+        max(-top, 0) : ring.shape[0] - max(bottom - height, 0),
+        max(-left, 0) : ring.shape[1] - max(right - width, 0),
+    ] = canvas_mask[max(top, 0) : bottom, max(left, 0) : right]
+    return np.count_nonzero(window & ring)
+
+
+def place_best_tightness_locally(
+    canvas: ImageType, proposals: Iterable[PlacementProposal]
+) -> ImageType | None:
+    """Like `place_best_tightness`, but checks each proposal only in the region
+    its cutout covers instead of computing the maps of the whole canvas.
+
+    Faster when there are few proposals per cutout, since the maps cost one FFT
+    of the canvas per cutout.
+    """
+    canvas_mask = to_mask(canvas)
+    rings = {}
+
+    def get_tightness_locally(proposal: PlacementProposal) -> float:
+        cur_cutout, position = proposal
+        if id(cur_cutout) not in rings:
+            rings[id(cur_cutout)] = (
+                cur_cutout,  # Keeps the id from being reused
+                to_mask(cur_cutout),
+                get_edge_ring(cur_cutout),
+            )
+        _, cutout_mask, ring = rings[id(cur_cutout)]
+        return get_local_tightness(canvas_mask, cutout_mask, ring, position)
+
+    best, _ = select_best(proposals, get_tightness_locally)
+
+    if best is None:
+        return None
+
+    return place_image(canvas, expand_cutout_canvas(*best, canvas_size=canvas.size))
+
+
+def place_tightest(canvas: ImageType, cutout: ImageType) -> ImageType | None:
+    """Places the cutout at the tightest of all positions without overlap."""
+    overlap_map = get_overlap_map(canvas, cutout)
+    if not np.any(overlap_map == 0):
+        return None
+
+    tightness_map = np.where(overlap_map == 0, get_tightness_map(canvas, cutout), -1)
+    y, x = np.unravel_index(np.argmax(tightness_map), tightness_map.shape)
+
+    return place_image(
+        canvas, expand_cutout_canvas(cutout, (int(x), int(y)), canvas_size=canvas.size)
+    )
+
+
+class Canvas:
+    """A canvas being filled with cutouts, kept as NumPy arrays.
+
+    Placing a cutout only updates the region it covers, in place, and the
+    occupancy mask is always at hand, so filling a canvas doesn't convert or
+    copy the whole image after every cutout like `place_image` and `to_mask` do.
+    """
+
+    def __init__(self, size: tuple[int, int] = CANVAS_SIZE):
+        width, height = size
+        self.pixels = np.zeros((height, width, 4), dtype=np.uint8)
+        self.mask = np.zeros((height, width), dtype=bool)
+        self._distance_transform = None
+
+    @classmethod
+    def from_image(cls, image: ImageType) -> "Canvas":
+        canvas = cls(image.size)
+        canvas.pixels[:] = np.array(image.convert("RGBA"))
+        canvas.mask[:] = to_mask(canvas.pixels)
+        return canvas
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.mask.shape[1], self.mask.shape[0]
+
+    def to_image(self) -> ImageType:
+        return Image.fromarray(self.pixels)
+
+    def _get_region(
+        self, cutout: ImageType, position: tuple[int, int]
+    ) -> tuple[slice, slice]:
+        x, y = position
+        if x < 0 or y < 0:
+            raise ValueError("Position must be positive")
+        if x + cutout.width > self.size[0] or y + cutout.height > self.size[1]:
+            raise ValueError("Foreground does not fit in the background")
+        return slice(y, y + cutout.height), slice(x, x + cutout.width)
+
+    def has_overlap(self, cutout: ImageType, position: tuple[int, int]) -> bool:
+        return bool(
+            np.any(self.mask[self._get_region(cutout, position)] & to_mask(cutout))
+        )
 
-    return place_image(canvas, best) if best is not None else None
+    def place(self, cutout: ImageType, position: tuple[int, int]):
+        """Alpha-composites the cutout onto the canvas, like `place_image`."""
+        rows, columns = self._get_region(cutout, position)
+
+        region = Image.fromarray(self.pixels[rows, columns])
+        region.alpha_composite(cutout)
+        self.pixels[rows, columns] = np.array(region)
+        self.mask[rows, columns] |= to_mask(cutout)
+        self._distance_transform = None
+
+    def get_distance_transform(self) -> np.ndarray:
+        """Distance of every pixel to the nearest occupied one, cached until the
+        next placement."""
+        if self._distance_transform is None:
+            self._distance_transform = scipy.ndimage.distance_transform_edt(~self.mask)
+        return self._distance_transform
+
+    def get_overlap_map(self, cutout: ImageType) -> np.ndarray:
+        return get_overlap_map(self.mask, cutout)
+
+    def get_tightness_map(self, cutout: ImageType) -> np.ndarray:
+        return get_tightness_map(self.mask, cutout)
+
+    def place_greedily(
+        self, proposals: Iterable[PlacementProposal]
+    ) -> tuple[int, int] | None:
+        """Like `place_greedily`, returns the position of the placed proposal, if any."""
+        for cutout, position in proposals:
+            if not self.has_overlap(cutout, position):
+                self.place(cutout, position)
+                return position
+        return None
+
+    def place_tightest(self, cutout: ImageType) -> tuple[int, int] | None:
+        """Like `place_tightest`, returns the position, or None if the cutout
+        fits nowhere."""
+        overlap_map = self.get_overlap_map(cutout)
+        if not np.any(overlap_map == 0):
+            return None
+
+        tightness_map = np.where(overlap_map == 0, self.get_tightness_map(cutout), -1)
+        y, x = np.unravel_index(np.argmax(tightness_map), tightness_map.shape)
+        self.place(cutout, (int(x), int(y)))
+        return int(x), int(y)
@@ -0,0 +1,117 @@
+"""Finds the cutouts whose shape matches a query best, by mask IoU.
+
+The hashes of `HashIndex` are too coarse to rank shapes well, and comparing the
+query with every mask is too slow. So `ShapeSearch` takes a few hundred
+candidates from the hash index and re-ranks them by their exact IoU with the
+query, computed on bit-packed masks.
+"""
+
+import functools
+from pathlib import Path
+
+import numpy as np
+from PIL.Image import Image as ImageType
+
+from segmentation.hash_index import HashIndex
+from segmentation.mask_store import MaskStore, open_mask_store, pack_mask
+from segmentation.placement import to_mask
+
+
+def count_bits(x: np.ndarray) -> np.ndarray:
+    """Number of set bits of each element of a uint64 array."""
+    if hasattr(np, "bitwise_count"):  # NumPy >= 2
+        return np.bitwise_count(x)
+
+    # The classic parallel bit count
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + (
+        (x >> np.uint64(2)) & np.uint64(0x3333333333333333)
+    )
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def get_packed_ious(query: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+    """IoU of a packed mask with each of an N x 256 x 32 stack of packed masks."""
+    # Counting bits 8 bytes at a time is much faster than looking up each byte.
+    query = np.ascontiguousarray(query).view(np.uint64)
+    candidates = np.ascontiguousarray(candidates).view(np.uint64)
+    intersection = count_bits(candidates & query).sum(axis=(1, 2), dtype=np.int64)
+    union = count_bits(candidates | query).sum(axis=(1, 2), dtype=np.int64)
+    return intersection / np.maximum(union, 1)
+
+
+class ShapeSearch:
+    def __init__(
+        self,
+        hash_index: HashIndex,
+        mask_store_dir: Path | None = None,
+        n_candidates: int = 200,
+        cache_size: int = 4096,
+    ):
+        """Re-ranks the `n_candidates` closest cutouts by hash.
+
+        The masks of the candidates come from the mask store if given (which
+        must contain all cutouts of the hash index), otherwise the cutouts are
+        decoded. Up to `cache_size` packed masks, 8 KB each, are kept in an LRU
+        cache.
+        """
+        self.hash_index = hash_index
+        self.mask_store = open_mask_store(mask_store_dir) if mask_store_dir else None
+        self.n_candidates = n_candidates
+        self.get_packed_mask = functools.lru_cache(maxsize=cache_size)(
+            self.load_packed_mask
+        )
+
+    def load_packed_mask(self, name: str) -> np.ndarray:
+        if self.mask_store is not None:
+            return self.mask_store.get_packed(self.mask_store.name_to_index[name])
+        else:
+            return pack_mask(to_mask(self.hash_index.open_image(name)))
+
+    def search_batch(
+        self, queries: list[ImageType] | np.ndarray, k: int = 10
+    ) -> list[tuple[np.ndarray, list[str]]]:
+        """Finds the k cutouts with the highest IoU with each query.
+
+        The queries are what the hash function of the index takes, images or
+        masks, all 256x256.
+
+        Returns:
+            for each query, the IoUs in decreasing order and the cutout names.
+        """
+        _, _, candidate_names = self.hash_index.get_closest_batch(
+            queries, self.n_candidates
+        )
+
+        results = []
+        for query, names in zip(queries, candidate_names):
+            names = [name for name in names if name is not None]
+            candidates = np.stack([self.get_packed_mask(name) for name in names])
+            ious = get_packed_ious(pack_mask(to_mask(query)), candidates)
+
+            best = np.argsort(-ious, kind="stable")[:k]
+            results.append((ious[best], [names[i] for i in best]))
+
+        return results
+
+    def search(
+        self, query: ImageType | np.ndarray, k: int = 10
+    ) -> tuple[np.ndarray, list[str]]:
+        return self.search_batch([query], k)[0]
+
+
+def search_exhaustively(
+    mask_store: MaskStore, query: ImageType | np.ndarray, k: int = 10
+) -> tuple[np.ndarray, list[str]]:
+    """Compares the query with every mask in the store. Slow, but exact, for
+    checking `ShapeSearch`."""
+    packed_query = pack_mask(to_mask(query))
+    ious = np.concatenate(
+        [
+            get_packed_ious(packed_query, mask_store.get_packed(slice(i, i + 1024)))
+            for i in range(0, len(mask_store), 1024)
+        ]
+    )
+    best = np.argsort(-ious, kind="stable")[:k]
+    return ious[best], [mask_store.names[i] for i in best]
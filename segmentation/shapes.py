@@ -19,10 +19,16 @@ def bool_array_to_bytes(bool_array: np.ndarray) -> np.ndarray:
     return packed
 
 
-def get_shape_hash(image: ImageType, size: int = 8):
-    assert image.mode == "RGBA"
+def get_shape_hash(image: ImageType | np.ndarray, size: int = 8):
+    """`image` can also be a boolean alpha mask, e.g. from `mask_store.MaskStore`."""
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image.astype(np.uint8))
+    else:
+        assert image.mode == "RGBA"
+        image = image.getchannel("A")
+
     image = image.resize((size, size), Image.NEAREST)
-    binary_mask = np.array(image)[:, :, 3] > 0
+    binary_mask = np.array(image) > 0
     return bool_array_to_bytes(binary_mask)
 
 
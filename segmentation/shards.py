@@ -0,0 +1,230 @@
+"""Packs many small encoded cutouts into a few large shard files.
+
+Each shard is a pair of files: `cutouts-00000.pack` with the encoded images
+concatenated, and `cutouts-00000.idx`, an append-only sidecar index with a
+fixed-size record per image. The writer always writes the data before its
+index record, so after a crash a shard is still readable up to the last
+complete record.
+"""
+
+import io
+import mmap
+from pathlib import Path
+from typing import Callable, Iterator
+
+import numpy as np
+from PIL import Image
+from PIL.Image import Image as ImageType
+
+SHARD_PREFIX = "cutouts"
+DEFAULT_MAX_SHARD_SIZE = 1 << 30
+
+INDEX_DTYPE = np.dtype(
+    [
+        ("image_index", "<i8"),
+        ("cutout_index", "<i4"),
+        ("offset", "<i8"),
+        ("length", "<i8"),
+    ]
+)
+
+
+def encode_cutout(cutout: ImageType) -> bytes:
+    """Encodes the cutout the same way as saving it to a .webp file."""
+    buffer = io.BytesIO()
+    cutout.save(buffer, format="webp")
+    return buffer.getvalue()
+
+
+def get_cutout_name(image_index: int, cutout_index: int) -> str:
+    return f"{image_index:08d}_{cutout_index:05d}.webp"
+
+
+def parse_cutout_name(name: str) -> tuple[int, int]:
+    """Inverse of `get_cutout_name`."""
+    image_index, cutout_index = Path(name).stem.split("_")
+    return int(image_index), int(cutout_index)
+
+
+def get_shard_paths(dir: Path) -> list[Path]:
+    """Returns the .pack files of the shards in the directory, in order."""
+    return sorted(dir.glob(f"{SHARD_PREFIX}-*.pack"))
+
+
+def has_shards(dir: Path) -> bool:
+    return bool(get_shard_paths(dir))
+
+
+class ShardWriter:
+    """Appends encoded cutouts to shards, starting a new shard once the current
+    one exceeds `max_shard_size` bytes.
+
+    `on_shard_closed` is called with the .pack path of every finished shard,
+    for instance to upload it. Only one writer may write to a directory at a
+    time; a new writer continues with a new shard after the existing ones.
+    """
+
+    def __init__(
+        self,
+        dir: Path,
+        max_shard_size: int = DEFAULT_MAX_SHARD_SIZE,
+        on_shard_closed: Callable[[Path], None] | None = None,
+    ):
+        self.dir = dir
+        self.max_shard_size = max_shard_size
+        self.on_shard_closed = on_shard_closed
+
+        dir.mkdir(parents=True, exist_ok=True)
+        existing = get_shard_paths(dir)
+        self.shard_number = int(existing[-1].stem.split("-")[-1]) + 1 if existing else 0
+
+        self.pack_file = None
+        self.index_file = None
+
+    def __enter__(self) -> "ShardWriter":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _open_shard(self):
+        self.pack_path = self.dir / f"{SHARD_PREFIX}-{self.shard_number:05d}.pack"
+        self.pack_file = open(self.pack_path, "wb")
+        self.index_file = open(self.pack_path.with_suffix(".idx"), "wb")
+        self.shard_number += 1
+
+    def _close_shard(self):
+        if self.pack_file is None:
+            return
+
+        self.pack_file.close()
+        self.index_file.close()
+        self.pack_file = self.index_file = None
+
+        if self.on_shard_closed:
+            self.on_shard_closed(self.pack_path)
+
+    def write(self, image_index: int, cutout_index: int, data: bytes) -> str:
+        """Appends an encoded cutout and returns its location, for the manifest."""
+        if self.pack_file is None:
+            self._open_shard()
+
+        offset = self.pack_file.tell()
+        self.pack_file.write(data)
+        self.pack_file.flush()
+
+        record = np.array(
+            [(image_index, cutout_index, offset, len(data))], dtype=INDEX_DTYPE
+        )
+        self.index_file.write(record.tobytes())
+        self.index_file.flush()
+
+        location = f"{self.pack_path.name}/{get_cutout_name(image_index, cutout_index)}"
+
+        if offset + len(data) >= self.max_shard_size:
+            self._close_shard()
+
+        return location
+
+    def close(self):
+        self._close_shard()
+
+
+class ShardReader:
+    """Reads the cutouts from all the shards in a directory.
+
+    The shards are memory-mapped, so reading a cutout doesn't need any system
+    calls once its pages are cached. Cutouts are ordered by (image index,
+    cutout index), like the loose files sorted by name. If a cutout was written
+    more than once, the last copy wins.
+    """
+
+    def __init__(self, dir: Path):
+        self.dir = dir
+        self.maps: list[mmap.mmap] = []
+        indices = []
+
+        for shard_number, pack_path in enumerate(get_shard_paths(dir)):
+            index_bytes = pack_path.with_suffix(".idx").read_bytes()
+            # Ignore a partially written last record
+            n_records = len(index_bytes) // INDEX_DTYPE.itemsize
+            index = np.frombuffer(
+                index_bytes, dtype=INDEX_DTYPE, count=n_records
+            ).copy()
+
+            pack_size = pack_path.stat().st_size
+            index = index[index["offset"] + index["length"] <= pack_size]
+
+            with open(pack_path, "rb") as f:
+                self.maps.append(
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    if pack_size > 0
+                    else b""
+                )
+
+            shard_column = np.full(len(index), shard_number, dtype=np.int32)
+            indices.append((index, shard_column))
+
+        if indices:
+            index = np.concatenate([index for index, _ in indices])
+            shard_numbers = np.concatenate([shards for _, shards in indices])
+        else:
+            index = np.zeros(0, dtype=INDEX_DTYPE)
+            shard_numbers = np.zeros(0, dtype=np.int32)
+
+        # Stable sort, so that among duplicates the last written one comes last.
+        order = np.lexsort((index["cutout_index"], index["image_index"]))
+        index, shard_numbers = index[order], shard_numbers[order]
+        keys = np.stack([index["image_index"], index["cutout_index"]], axis=1)
+        is_last = np.ones(len(index), dtype=bool)
+        is_last[:-1] = np.any(keys[1:] != keys[:-1], axis=1)
+
+        self.index = index[is_last]
+        self.shard_numbers = shard_numbers[is_last]
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __enter__(self) -> "ShardReader":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for m in self.maps:
+            if isinstance(m, mmap.mmap):
+                m.close()
+
+    def keys(self) -> list[tuple[int, int]]:
+        return list(
+            zip(self.index["image_index"].tolist(), self.index["cutout_index"].tolist())
+        )
+
+    def read(self, i: int) -> bytes:
+        """Reads the i-th cutout in the order of `keys`."""
+        offset, length = int(self.index["offset"][i]), int(self.index["length"][i])
+        return self.maps[self.shard_numbers[i]][offset : offset + length]
+
+    def get_bytes(self, image_index: int, cutout_index: int) -> bytes:
+        """Random access to one encoded cutout."""
+        image_indices = self.index["image_index"]
+        start = np.searchsorted(image_indices, image_index, side="left")
+        end = np.searchsorted(image_indices, image_index, side="right")
+        i = start + np.searchsorted(self.index["cutout_index"][start:end], cutout_index)
+
+        if i == end or self.index["cutout_index"][i] != cutout_index:
+            raise KeyError((image_index, cutout_index))
+
+        return self.read(i)
+
+    def __getitem__(self, key: tuple[int, int]) -> ImageType:
+        return Image.open(io.BytesIO(self.get_bytes(*key)))
+
+    def iter_bytes(self) -> Iterator[tuple[tuple[int, int], bytes]]:
+        for i, key in enumerate(self.keys()):
+            yield key, self.read(i)
+
+    def __iter__(self) -> Iterator[ImageType]:
+        for _, data in self.iter_bytes():
+            yield Image.open(io.BytesIO(data))
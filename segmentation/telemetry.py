@@ -0,0 +1,62 @@
+"""Wall time per stage of the extraction pipeline, summed over images and workers.
+
+Each worker fills a `StageTimer` for the image it processes and sends it back
+with the result, the parent adds them up and writes them into a JSON report.
+"""
+
+from collections import Counter
+import contextlib
+import cProfile
+from pathlib import Path
+import time
+from typing import Iterator
+
+
+class StageTimer:
+    def __init__(self):
+        self.seconds = Counter()
+        self.counts = Counter()
+
+    @contextlib.contextmanager
+    def __call__(self, stage: str) -> Iterator[None]:
+        """Adds the time spent in the `with` block to the stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - start
+            self.counts[stage] += 1
+
+    def update(self, other: "StageTimer"):
+        self.seconds.update(other.seconds)
+        self.counts.update(other.counts)
+
+    def to_dict(self) -> dict[str, dict]:
+        """Returns the total seconds, count and mean milliseconds of each stage,
+        slowest first."""
+        return {
+            stage: {
+                "seconds": seconds,
+                "count": self.counts[stage],
+                "mean_ms": seconds / self.counts[stage] * 1e3,
+            }
+            for stage, seconds in self.seconds.most_common()
+        }
+
+
+@contextlib.contextmanager
+def maybe_profile(output_path: Path | None) -> Iterator[None]:
+    """Profiles the `with` block into `output_path` (for `pstats` or snakeviz),
+    or does nothing if it's None."""
+    if output_path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(output_path)
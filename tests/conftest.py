@@ -0,0 +1,260 @@
+"""Deterministic synthetic data for the tests and benchmarks.
+
+The SA-1B-like images have the same layout as the real dataset: `sa_{i}.jpg`
+with `sa_{i}.json` next to it, holding COCO RLE masks with their bbox and area.
+The masks cover the cases the cutout filters distinguish: plain blobs, blobs cut
+off by the image edge, masks in several pieces and masks too small to keep. The
+same seed always gives the same files.
+"""
+
+import io
+import json
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+from PIL import Image
+from PIL.Image import Image as ImageType
+import pycocotools.mask
+import pytest
+import skimage.draw
+
+from segmentation.cutting import Annotation
+
+DEFAULT_IMAGE_SIZE = (2250, 1500)
+MASK_KINDS = ["blob", "edge", "disconnected", "tiny"]
+
+
+def get_rng(seed: int, image_index: int) -> np.random.Generator:
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(image_index,)))
+
+
+def draw_ellipse(
+    mask: np.ndarray, rng: np.random.Generator, center: tuple[int, int], radius: float
+):
+    rr, cc = skimage.draw.ellipse(
+        center[0],
+        center[1],
+        radius * rng.uniform(0.5, 1.5),
+        radius * rng.uniform(0.5, 1.5),
+        shape=mask.shape,
+        rotation=rng.uniform(0, np.pi),
+    )
+    mask[rr, cc] = 1
+
+
+def make_mask(rng: np.random.Generator, size: tuple[int, int], kind: str) -> np.ndarray:
+    """Makes a uint8 mask of the given kind, one of `MASK_KINDS`."""
+    width, height = size
+    mask = np.zeros((height, width), dtype=np.uint8)
+    radius = min(rng.choice([50, 100, 200]), min(width, height) // 4)
+
+    if kind == "blob":
+        center = (
+            rng.integers(radius, height - radius),
+            rng.integers(radius, width - radius),
+        )
+        draw_ellipse(mask, rng, center, radius)
+    elif kind == "edge":
+        # Centered on one of the edges, so it is cut off there
+        center = [rng.integers(0, height), rng.integers(0, width)]
+        side = rng.integers(4)
+        center[side % 2] = 0 if side < 2 else (height, width)[side % 2] - 1
+        draw_ellipse(mask, rng, tuple(center), radius)
+    elif kind == "disconnected":
+        for _ in range(rng.integers(2, 4)):
+            center = (rng.integers(0, height), rng.integers(0, width))
+            draw_ellipse(mask, rng, center, radius / 2)
+    elif kind == "tiny":
+        center = (rng.integers(0, height), rng.integers(0, width))
+        draw_ellipse(mask, rng, center, rng.uniform(2, 10))
+    else:
+        raise ValueError(f"Unknown mask kind {kind}, choose from {MASK_KINDS}")
+
+    return mask
+
+
+def make_image(rng: np.random.Generator, size: tuple[int, int]) -> ImageType:
+    """Smooth random colors with some noise, to compress roughly like a photo."""
+    width, height = size
+    coarse = (rng.random((height // 64 + 1, width // 64 + 1, 3)) * 256).astype(np.uint8)
+    image = Image.fromarray(coarse).resize(size, Image.BICUBIC)
+    noise = rng.normal(0, 8, (height, width, 3))
+    return Image.fromarray(np.clip(np.array(image) + noise, 0, 255).astype(np.uint8))
+
+
+def make_sa1b_image(
+    image_index: int = 1,
+    seed: int = 0,
+    n_annotations: int = 50,
+    size: tuple[int, int] = DEFAULT_IMAGE_SIZE,
+) -> tuple[ImageType, list[Annotation]]:
+    """Makes an image and its annotations, the same for the same index and seed."""
+    rng = get_rng(seed, image_index)
+    image = make_image(rng, size)
+
+    annotations = []
+    for i in range(n_annotations):
+        mask = make_mask(rng, size, rng.choice(MASK_KINDS, p=[0.4, 0.2, 0.2, 0.2]))
+        rle = pycocotools.mask.encode(np.asfortranarray(mask))
+        rle["counts"] = rle["counts"].decode()
+        annotations.append(
+            {
+                "id": i,
+                "segmentation": rle,
+                "bbox": pycocotools.mask.toBbox(rle).tolist(),
+                "area": int(pycocotools.mask.area(rle)),
+            }
+        )
+
+    return image, annotations
+
+
+def encode_sa1b_image(
+    image_index: int, image: ImageType, annotations: list[Annotation]
+) -> tuple[bytes, bytes]:
+    """Returns the contents of the .jpg and the .json file."""
+    buffer = io.BytesIO()
+    image.save(buffer, format="jpeg", quality=90)
+
+    data = {
+        "image": {
+            "image_id": image_index,
+            "width": image.width,
+            "height": image.height,
+            "file_name": f"sa_{image_index}.jpg",
+        },
+        "annotations": annotations,
+    }
+    return buffer.getvalue(), json.dumps(data).encode()
+
+
+def write_sa1b_dataset(
+    output_dir: Path,
+    n_images: int = 10,
+    seed: int = 0,
+    n_annotations: int = 50,
+    size: tuple[int, int] = DEFAULT_IMAGE_SIZE,
+):
+    """Writes images sa_1 to sa_{n_images} into a directory."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for image_index in range(1, n_images + 1):
+        image, annotations = make_sa1b_image(image_index, seed, n_annotations, size)
+        jpg, json_bytes = encode_sa1b_image(image_index, image, annotations)
+        (output_dir / f"sa_{image_index}.jpg").write_bytes(jpg)
+        (output_dir / f"sa_{image_index}.json").write_bytes(json_bytes)
+
+
+def make_example_cutouts(size: int = 256) -> list[ImageType]:
+    """Makes cutout-like RGBA images with a few different shapes."""
+    rng = np.random.default_rng(0)
+    shapes = [
+        skimage.draw.ellipse(128, 128, 100, 60, rotation=0.4),
+        skimage.draw.polygon([20, 240, 200, 60], [30, 10, 250, 200]),
+        skimage.draw.disk((128, 128), 127),
+        skimage.draw.polygon([0, 255, 255], [128, 0, 255]),
+    ]
+
+    cutouts = []
+    for rr, cc in shapes:
+        data = (rng.random((size, size, 4)) * 256).astype(np.uint8)
+        data[..., 3] = 0
+        data[rr, cc, 3] = 255
+        cutouts.append(Image.fromarray(data))
+
+    return cutouts
+
+
+def make_random_shapes(n: int, seed: int = 0) -> list[ImageType]:
+    """Makes RGBA cutouts of ellipses and triangles of random sizes and poses."""
+    rng = np.random.default_rng(seed)
+    cutouts = []
+    for _ in range(n):
+        data = np.zeros((256, 256, 4), dtype=np.uint8)
+        if rng.random() < 0.5:
+            r_radius, c_radius = rng.uniform(20, 127, size=2)
+            rr, cc = skimage.draw.ellipse(
+                128,
+                128,
+                r_radius,
+                c_radius,
+                shape=(256, 256),
+                rotation=rng.uniform(0, np.pi),
+            )
+        else:
+            rr, cc = skimage.draw.polygon(
+                rng.uniform(0, 255, 3), rng.uniform(0, 255, 3), shape=(256, 256)
+            )
+        data[rr, cc, 3] = 255
+        cutouts.append(Image.fromarray(data))
+
+    return cutouts
+
+
+def make_example_masks(
+    n_masks: int = 200, size: tuple[int, int] = (400, 300)
+) -> np.ndarray:
+    """Makes random masks covering the cases the cutout filters distinguish.
+
+    Shapes are clipped at the edges or not, sometimes split into several
+    components, sometimes touching only diagonally.
+    """
+    rng = np.random.default_rng(0)
+    height, width = size
+    masks = np.zeros((n_masks, height, width), dtype=bool)
+
+    for mask in masks:
+        for _ in range(rng.choice([1, 1, 2, 3])):
+            rr, cc = skimage.draw.ellipse(
+                rng.integers(0, height),
+                rng.integers(0, width),
+                rng.integers(5, height // 2),
+                rng.integers(5, width // 2),
+                shape=mask.shape,
+                rotation=rng.uniform(0, np.pi),
+            )
+            mask[rr, cc] = True
+
+        if rng.random() < 0.2:
+            # Cut the shape in two, maybe leaving a diagonal connection
+            y, x = rng.integers(0, height - 1), rng.integers(0, width - 1)
+            mask[y, :] = False
+            mask[y, x] = rng.random() < 0.5
+            mask[y + 1, x + 1] = True
+
+    return masks
+
+
+@pytest.fixture(scope="session")
+def sa1b_image() -> tuple[ImageType, list[Annotation]]:
+    """The first synthetic image, copy it before modifying it."""
+    return make_sa1b_image()
+
+
+@pytest.fixture
+def sa1b_dataset(tmp_path) -> Callable[..., Path]:
+    """Writes synthetic images into a temporary shard directory and returns it.
+    Takes the options of `write_sa1b_dataset`."""
+
+    def write(**kwargs) -> Path:
+        output_dir = tmp_path / "sa_000000"
+        write_sa1b_dataset(output_dir, **kwargs)
+        return output_dir
+
+    return write
+
+
+@pytest.fixture(scope="session")
+def example_cutouts() -> list[ImageType]:
+    return make_example_cutouts()
+
+
+@pytest.fixture(scope="session")
+def example_masks() -> np.ndarray:
+    return make_example_masks()
+
+
+@pytest.fixture(scope="session")
+def random_shapes() -> Callable[..., list[ImageType]]:
+    """`make_random_shapes`, for tests that need a different number or seed."""
+    return make_random_shapes
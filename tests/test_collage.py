@@ -0,0 +1,59 @@
+import json
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+import pytest
+
+from segmentation import collage
+from segmentation.shards import get_cutout_name
+
+
+@pytest.fixture(scope="module")
+def cutouts_dir(tmp_path_factory, example_cutouts, random_shapes) -> Path:
+    cutouts_dir = tmp_path_factory.mktemp("cutouts")
+    for i, cutout in enumerate(example_cutouts + random_shapes(20)):
+        cutout.save(cutouts_dir / get_cutout_name(i, 0), lossless=True)
+    return cutouts_dir
+
+
+def read_collages(output_dir: Path) -> dict[int, tuple[dict, np.ndarray]]:
+    """Returns the metadata and the image of each collage by canvas index."""
+    lines = (output_dir / collage.METADATA_FILENAME).read_text().splitlines()
+    collages = {}
+    for line in lines:
+        result = json.loads(line)
+        image = np.array(Image.open(output_dir / result["image"]))
+        collages[result["canvas_index"]] = result, image
+    return collages
+
+
+@pytest.mark.parametrize("strategy", ["greedy", "tightest"])
+def test_collages_do_not_depend_on_n_workers(tmp_path, cutouts_dir, strategy):
+    config = collage.CollageConfig(
+        canvas_size=(256, 256), n_cutouts=8, strategy=strategy, scale=0.3
+    )
+    collages = []
+    for n_workers in [1, 3]:
+        output_dir = tmp_path / f"{n_workers}_workers"
+        collage.main(cutouts_dir, output_dir, 6, 1, config, n_workers)
+        collages.append(read_collages(output_dir))
+
+    one_worker, three_workers = collages
+    assert one_worker.keys() == three_workers.keys() == set(range(6))
+    for i, (result, image) in three_workers.items():
+        assert result == one_worker[i][0]
+        assert np.array_equal(image, one_worker[i][1])
+
+
+def test_resume_checks_seed(tmp_path, cutouts_dir):
+    config = collage.CollageConfig(canvas_size=(256, 256), n_cutouts=4, scale=0.3)
+    output_dir = tmp_path / "collages"
+    collage.main(cutouts_dir, output_dir, 2, 1, config, 1)
+    # Only the canvases that are not done yet are added.
+    collage.main(cutouts_dir, output_dir, 4, 1, config, 1)
+    lines = (output_dir / collage.METADATA_FILENAME).read_text().splitlines()
+    assert [json.loads(line)["canvas_index"] for line in lines] == [0, 1, 2, 3]
+
+    with pytest.raises(ValueError, match="seed 1, not 2"):
+        collage.main(cutouts_dir, output_dir, 6, 2, config, 1)
@@ -0,0 +1,99 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from segmentation import cutting
+from segmentation.manifest import STATUS_DONE, STATUS_MISSING, Manifest
+from segmentation.telemetry import StageTimer
+
+
+def test_save_cutouts_resumes_through_manifest(tmp_path, sa1b_dataset):
+    input_dir = sa1b_dataset(n_images=4, n_annotations=20)
+    # SA-1B skips some indices
+    (input_dir / "sa_3.jpg").unlink()
+    (input_dir / "sa_3.json").unlink()
+    output_dir = tmp_path / "cutouts"
+
+    cutting.save_cutouts(input_dir, output_dir, max_n_images=5, parallel=False)
+
+    with Manifest(output_dir / "manifest.sqlite") as manifest:
+        assert manifest.get_done("sa_000000") == {"sa_1", "sa_2", "sa_3", "sa_4"}
+        rows = manifest.connection.execute(
+            "SELECT image, status, n_cutouts FROM images"
+        ).fetchall()
+    statuses = {image: status for image, status, _ in rows}
+    assert statuses["sa_3"] == STATUS_MISSING
+    assert statuses["sa_1"] == STATUS_DONE
+
+    n_cutouts = sum(n for _, _, n in rows)
+    assert n_cutouts > 0
+    assert len(list(output_dir.glob("*.png"))) == n_cutouts
+
+    # Everything is done, so nothing is read again
+    for path in input_dir.iterdir():
+        path.unlink()
+    cutting.save_cutouts(input_dir, output_dir, max_n_images=5, parallel=True)
+    assert len(list(output_dir.glob("*.png"))) == n_cutouts
+
+
+def extract_arrays(image, annotations, **kwargs) -> list[tuple[int, np.ndarray]]:
+    cutouts = cutting.extract_cutouts_from_image(image.copy(), annotations, **kwargs)
+    return [(i, np.array(cutout)) for i, cutout in cutouts]
+
+
+def test_prefilter_gives_the_same_cutouts(sa1b_image):
+    image, annotations = sa1b_image
+    stats = Counter()
+    expected = extract_arrays(image, annotations, prefilter=False)
+    actual = extract_arrays(image, annotations, prefilter=True, stats=stats)
+
+    assert stats["accepted"] > 0
+    assert [i for i, _ in actual] == [i for i, _ in expected]
+    assert all(np.array_equal(a, b) for (_, a), (_, b) in zip(actual, expected))
+
+
+def test_draft_cutouts_stay_close_to_full(sa1b_dataset, tolerance: float = 2.0):
+    """Only the annotations whose bbox is at least twice the standard cutout size
+    are kept, so that every image can be drafted. The cutouts have to stay within
+    `tolerance` of the full ones, as mean absolute difference per channel."""
+    input_dir = sa1b_dataset(n_images=3)
+    n_compared = 0
+    for path in sorted(input_dir.glob("*.jpg")):
+        _, annotations = cutting.load(path)
+        accepted = cutting.iter_accepted_masks(annotations, Counter(), StageTimer())
+        annotations = [
+            annotations[i]
+            for i, (left, top, right, bottom), _ in accepted
+            if max(right - left, bottom - top) >= 2 * cutting.STANDARD_CUTOUT_SIZE
+        ]
+
+        cutouts = {}
+        for draft in [False, True]:
+            image, _ = cutting.load(path)
+            cutouts[draft] = list(
+                cutting.extract_cutouts_from_image(image, annotations, draft=draft)
+            )
+
+        assert [i for i, _ in cutouts[False]] == [i for i, _ in cutouts[True]]
+        for (_, full), (_, drafted) in zip(cutouts[False], cutouts[True]):
+            diff = np.abs(np.array(full, dtype=float) - np.array(drafted))
+            assert diff.mean(axis=(0, 1)).max() <= tolerance
+            n_compared += 1
+
+    assert n_compared > 0
+
+
+@pytest.mark.benchmark(group="extract_cutouts")
+@pytest.mark.parametrize("draft", [False, True])
+def test_benchmark_extract_cutouts(benchmark, sa1b_dataset, draft):
+    path = sa1b_dataset(n_images=1) / "sa_1.jpg"
+    cutouts = benchmark(lambda: list(cutting.extract_cutouts(path, draft=draft)))
+    assert cutouts
+
+
+@pytest.mark.benchmark(group="extract_cutouts_from_image")
+@pytest.mark.parametrize("prefilter", [False, True])
+def test_benchmark_extract_cutouts_from_image(benchmark, sa1b_image, prefilter):
+    image, annotations = sa1b_image
+    benchmark(extract_arrays, image, annotations, prefilter=prefilter)
@@ -0,0 +1,282 @@
+from pathlib import Path
+import time
+
+import diskcache
+import numpy as np
+from PIL import Image
+import pytest
+
+from segmentation import escherize, loading, mask_store
+from segmentation.shards import get_cutout_name
+
+
+@pytest.fixture(scope="module")
+def configs() -> list[escherize.TilingConfig]:
+    return list(escherize.iter_configs())
+
+
+def test_tiling_scorer_matches_composited(example_cutouts, configs):
+    canvas = Image.new("RGBA", (256, 256), 0)
+    rng = np.random.default_rng(0)
+    subset = [configs[i] for i in rng.choice(len(configs), 25, replace=False)]
+
+    for cutout in example_cutouts:
+        scorer = escherize.TilingScorer(canvas, cutout)
+        for config in subset:
+            expected = escherize.score_tiling_composited(canvas, cutout, config)
+            assert scorer(config) == expected, f"Mismatch for {config}"
+
+
+def make_canvas(kind: str) -> Image.Image:
+    """An empty canvas, or one whose content counts as covered once (alpha 1)
+    in some places and twice (alpha 255) in others."""
+    data = np.zeros((256, 256, 4), dtype=np.uint8)
+    if kind == "partly_covered":
+        data[20:80, 30:200, 3] = 1
+        data[150:230, 100:140, 3] = 255
+        data[60:170, 120:125, 3] = 7
+    return Image.fromarray(data)
+
+
+# (delta1, delta2, canvas, the path `TilingScorer` takes)
+TILING_CASES = [
+    ((64, 0), (0, 64), "empty", "folded"),
+    ((96, 32), (-32, 128), "empty", "folded"),
+    ((200, 10), (30, 190), "empty", "folded"),
+    ((64, 0), (0, 64), "partly_covered", "explicit"),
+    ((96, 32), (-32, 128), "partly_covered", "explicit"),
+    # Collinear deltas, the tiles only form a line
+    ((64, 0), (128, 0), "empty", "collinear"),
+    ((32, 32), (-64, -64), "empty", "collinear"),
+    ((0, 0), (0, 0), "empty", "collinear"),
+    ((0, 0), (96, 32), "partly_covered", "collinear"),
+    # `place_tiled` only places the first 20 tiles in each direction
+    ((3, 0), (0, 5), "empty", "truncated"),
+    ((250, 3), (249, 3), "empty", "truncated"),
+    ((255, 1), (0, 8), "partly_covered", "truncated"),
+]
+
+
+@pytest.mark.parametrize(
+    "delta1, delta2, canvas_kind, path",
+    TILING_CASES,
+    ids=[f"{d1}-{d2}-{kind}" for d1, d2, kind, _ in TILING_CASES],
+)
+@pytest.mark.parametrize("cutout_index", range(4))
+def test_tiling_scorer_edge_cases(
+    example_cutouts, delta1, delta2, canvas_kind, path, cutout_index
+):
+    canvas = make_canvas(canvas_kind)
+    cutout = example_cutouts[cutout_index]
+    config = escherize.TilingConfig(delta1=delta1, delta2=delta2)
+    scorer = escherize.TilingScorer(canvas, cutout)
+
+    # Pin the path, so that the fallbacks stay covered
+    is_collinear = escherize.get_lattice_basis(config) is None
+    assert is_collinear == (path == "collinear")
+    assert scorer.is_canvas_empty == (canvas_kind == "empty")
+    if not is_collinear:
+        is_truncated = not escherize.is_within_tile_range(
+            config, canvas.size, scorer.tile_bbox
+        )
+        assert is_truncated == (path == "truncated")
+
+    expected = escherize.score_tiling_composited(canvas, cutout, config)
+    assert scorer(config) == expected
+    assert escherize.score_tiling(canvas, cutout, config) == expected
+
+
+@pytest.mark.parametrize("canvas_kind", ["empty", "partly_covered"])
+def test_score_batch_matches_calls(example_cutouts, canvas_kind):
+    """The batch mixes all paths, in an order that interleaves them."""
+    canvas = make_canvas(canvas_kind)
+    configs = [
+        escherize.TilingConfig(delta1=delta1, delta2=delta2)
+        for delta1, delta2, _, _ in TILING_CASES[::-1] + TILING_CASES
+    ]
+    for cutout in example_cutouts:
+        scorer = escherize.TilingScorer(canvas, cutout)
+        assert scorer.score_batch(configs) == [scorer(config) for config in configs]
+
+
+@pytest.mark.benchmark(group="score_tiling")
+@pytest.mark.parametrize("method", ["composited", "folded", "batched"])
+def test_benchmark_score_tiling(benchmark, example_cutouts, configs, method):
+    canvas = Image.new("RGBA", (256, 256), 0)
+    cutout = example_cutouts[0]
+    configs = configs[:20]
+
+    if method == "composited":
+        benchmark(
+            lambda: [
+                escherize.score_tiling_composited(canvas, cutout, config)
+                for config in configs
+            ]
+        )
+    elif method == "folded":
+        scorer = escherize.TilingScorer(canvas, cutout)
+        benchmark(lambda: [scorer(config) for config in configs])
+    else:
+        scorer = escherize.TilingScorer(canvas, cutout)
+        benchmark(scorer.score_batch, configs)
+
+
+def score_grid(scorer: escherize.TilingScorer, configs, batch_size=64) -> list[float]:
+    """Scores the configs in batches, like `search_exhaustive` does."""
+    return [
+        score
+        for start in range(0, len(configs), batch_size)
+        for score in scorer.score_batch(configs[start : start + batch_size])
+    ]
+
+
+@pytest.mark.benchmark(group="score_tiling_grid")
+@pytest.mark.parametrize("cutout_index", range(4))
+def test_benchmark_score_tiling_grid(benchmark, example_cutouts, configs, cutout_index):
+    """Scores all configs of the 32px grid and records the speedup per config
+    over compositing, which is timed on every 40th config because all of them
+    take minutes. The grid includes the configs that `place_tiled` truncates,
+    about a tenth, which take the slower explicit path.
+
+    On the machine of the stored baseline, the speedup is 125-170x for the
+    four example cutouts. Scoring one config at a time is about 80x faster.
+    """
+    canvas = Image.new("RGBA", (256, 256), 0)
+    cutout = example_cutouts[cutout_index]
+    scorer = escherize.TilingScorer(canvas, cutout)
+    sample = configs[::40]
+
+    start = time.perf_counter()
+    expected = [
+        escherize.score_tiling_composited(canvas, cutout, config) for config in sample
+    ]
+    composited_seconds = (time.perf_counter() - start) / len(sample)
+
+    start = time.perf_counter()
+    scores = score_grid(scorer, configs)
+    grid_seconds = (time.perf_counter() - start) / len(configs)
+    assert scores[::40] == expected
+
+    benchmark.pedantic(score_grid, args=(scorer, configs), rounds=3)
+    benchmark.extra_info["speedup"] = composited_seconds / grid_seconds
+
+
+@pytest.fixture(scope="module")
+def grid_score(example_cutouts, configs) -> float:
+    canvas = Image.new("RGBA", (256, 256), 0)
+    return max(score_grid(escherize.TilingScorer(canvas, example_cutouts[0]), configs))
+
+
+@pytest.mark.benchmark(group="tiling_search")
+@pytest.mark.parametrize(
+    "strategy, budget",
+    [
+        pytest.param(
+            strategy,
+            budget,
+            # Each step of the Bayesian optimization fits a Gaussian process to
+            # all evaluations before it, which takes most of a minute for 200.
+            marks=pytest.mark.slow if strategy == "bayesian" and budget > 50 else (),
+        )
+        for strategy in escherize.SEARCH_STRATEGIES
+        for budget in [25, 50, 100, 200]
+    ],
+)
+def test_benchmark_tiling_search(
+    benchmark, example_cutouts, grid_score, strategy, budget
+):
+    """Records the best score found with a budget of evaluations and the gap to
+    the best config on the full 32px grid. A negative gap means the strategy
+    found a better tiling than the grid contains."""
+    canvas = Image.new("RGBA", (256, 256), 0)
+    scorer = escherize.TilingScorer(canvas, example_cutouts[0])
+
+    search = escherize.SEARCH_STRATEGIES[strategy]
+    _, score = benchmark.pedantic(search, args=(scorer, budget), rounds=3)
+    benchmark.extra_info["score"] = score
+    benchmark.extra_info["gap"] = grid_score - score
+
+
+def test_get_shard_is_stable():
+    names = [get_cutout_name(i, 0) for i in range(200)]
+    shards = [escherize.get_shard(Path("a") / name, 4) for name in names]
+
+    # Only the filename counts, not where the cutout is.
+    assert shards == [escherize.get_shard(Path("b/c") / name, 4) for name in names]
+    assert set(shards) == {0, 1, 2, 3}
+    # The same on every machine and in every run
+    assert shards[:8] == [3, 3, 3, 3, 2, 3, 3, 3]
+
+
+@pytest.fixture
+def escher_input_dir(tmp_path, example_cutouts) -> Path:
+    """The example cutouts and a tiny one, which isn't reasonable to tile."""
+    input_dir = tmp_path / "cutouts"
+    input_dir.mkdir()
+    tiny = Image.new("RGBA", (256, 256))
+    tiny.paste((255, 0, 0, 255), (0, 0, 10, 10))
+    for i, cutout in enumerate([*example_cutouts, tiny]):
+        cutout.save(input_dir / get_cutout_name(i, 0), lossless=True)
+    return input_dir
+
+
+@pytest.fixture
+def escher_dirs(tmp_path, monkeypatch) -> tuple[Path, Path]:
+    cache_dir, images_dir = tmp_path / "cache", tmp_path / "images"
+    monkeypatch.setattr(escherize, "ESCHER_CACHE_DIR", cache_dir)
+    monkeypatch.setattr(escherize, "ESCHER_IMAGES_DIR", images_dir)
+    return cache_dir, images_dir
+
+
+def fail_to_escherize(path, *args, **kwargs):
+    raise AssertionError(f"{path.name} should have been skipped")
+
+
+def test_main_skips_done_cutouts(escher_input_dir, escher_dirs, monkeypatch):
+    cache_dir, images_dir = escher_dirs
+    escherize.main(escher_input_dir, budget=5, n_workers=1)
+
+    tiny_path = escher_input_dir / get_cutout_name(4, 0)
+    with diskcache.Cache(directory=cache_dir) as cache:
+        assert len(cache) == 5
+        assert cache[escherize.get_cache_key(tiny_path)] == {
+            "path": tiny_path,
+            "is_reasonable": False,
+        }
+    assert sorted(path.stem for path in images_dir.glob("*.png")) == [
+        get_cutout_name(i, 0).removesuffix(".webp") for i in range(4)
+    ]
+
+    # A cutout with an image from a run that crashed before caching it
+    example_cutout = Image.open(escher_input_dir / get_cutout_name(0, 0))
+    example_cutout.save(escher_input_dir / get_cutout_name(5, 0), lossless=True)
+    example_cutout.save(images_dir / get_cutout_name(5, 0).replace(".webp", ".png"))
+
+    # Cached cutouts, rejected ones too, and those with an image are skipped.
+    monkeypatch.setattr(escherize, "escherize_cutout", fail_to_escherize)
+    escherize.main(escher_input_dir, budget=5, n_workers=1)
+
+
+def test_escherize_cutout_from_mask_store(tmp_path, escher_input_dir):
+    store_dir = tmp_path / "masks"
+    mask_store.build_mask_store(escher_input_dir, store_dir)
+
+    for path in loading.images_in_dir(escher_input_dir):
+        from_store = escherize.escherize_cutout(
+            path, "exhaustive", 25, mask_store_dir=store_dir, input_dir=escher_input_dir
+        )
+        decoded = escherize.escherize_cutout(path, "exhaustive", 25)
+
+        assert from_store.keys() == decoded.keys()
+        for key in from_store.keys() - {"image"}:
+            assert from_store[key] == decoded[key]
+        if "image" in decoded:
+            assert np.array_equal(
+                np.array(from_store["image"]), np.array(decoded["image"])
+            )
+
+
+def test_default_budget_is_bounded():
+    n_configs = len(list(escherize.iter_configs()))
+    assert escherize.get_default_budget("exhaustive") == n_configs
+    assert escherize.get_default_budget("bayesian") < n_configs / 10
@@ -0,0 +1,185 @@
+from collections import Counter
+import itertools
+import json
+from pathlib import Path
+import tarfile
+import time
+
+import pytest
+
+from segmentation.extract_good_cutouts import (
+    MANIFEST_FILENAME,
+    iter_tar_images,
+    main_from_tar,
+    run_extraction,
+)
+from segmentation.manifest import STATUS_DONE, STATUS_MISSING, Manifest
+from segmentation.telemetry import StageTimer
+
+
+def process(i: int) -> dict:
+    return {"image": f"sa_{i}"}
+
+
+def fail_on_first(i: int) -> dict:
+    if i == 0:
+        raise ValueError("Corrupt image")
+    # The others are slow, so that the inputs in flight fill up the throttle
+    # before the failure arrives.
+    time.sleep(0.2)
+    return {"image": f"sa_{i}"}
+
+
+def process_with_stats(i: int) -> dict:
+    if i % 5 == 0:
+        return {"image": f"sa_{i}", "status": STATUS_MISSING}
+    timer = StageTimer()
+    with timer("decode"):
+        pass
+    for _ in range(i % 3):
+        with timer("encode"):
+            pass
+    stats = Counter(accepted=i % 4, too_small=i % 2, too_thin=1)
+    return {"image": f"sa_{i}", "stats": stats, "timer": timer}
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_run_extraction_report(tmp_path, parallel):
+    report_path = tmp_path / "report.json"
+    with Manifest(tmp_path / "manifest.sqlite") as manifest:
+        run_extraction(
+            process_with_stats,
+            range(20),
+            manifest,
+            "shard",
+            parallel=parallel,
+            report_path=report_path,
+        )
+    report = json.loads(report_path.read_text())
+
+    done = [i for i in range(20) if i % 5 != 0]
+    assert report["shard"] == "shard"
+    assert report["n_images"] == 20
+    assert report["n_images_per_status"] == {STATUS_DONE: 16, STATUS_MISSING: 4}
+    assert report["n_accepted"] == sum(i % 4 for i in done)
+    assert report["reject_reasons"] == {
+        "too_small": sum(i % 2 for i in done),
+        "too_thin": len(done),
+    }
+    stage_counts = {
+        stage: stats["count"] for stage, stats in report["worker_stages"].items()
+    }
+    assert stage_counts == {"decode": 16, "encode": sum(i % 3 for i in done)}
+    assert report["parent_stages"]["manifest_record"]["count"] == 20
+
+
+def test_run_extraction_skips_report_when_nothing_is_left(tmp_path):
+    report_path = tmp_path / "report.json"
+    with Manifest(tmp_path / "manifest.sqlite") as manifest:
+        run_extraction(process, range(0), manifest, "shard", report_path=report_path)
+    assert not report_path.exists()
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_run_extraction_records_all(tmp_path, parallel):
+    with Manifest(tmp_path / "manifest.sqlite") as manifest:
+        run_extraction(process, range(100), manifest, "shard", parallel=parallel)
+        assert len(manifest.get_done("shard")) == 100
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_run_extraction_raises_worker_error(tmp_path, parallel):
+    with Manifest(tmp_path / "manifest.sqlite") as manifest:
+        with pytest.raises(ValueError, match="Corrupt image"):
+            run_extraction(
+                fail_on_first, range(100), manifest, "shard", parallel=parallel
+            )
+
+
+def process_slowly(i: int) -> dict:
+    time.sleep(0.05)
+    return {"image": f"sa_{i}"}
+
+
+def fail_after(n: int):
+    """Inputs that fail like a tar with a missing file, after `n` good ones."""
+    yield from range(n)
+    raise FileNotFoundError("sa_3.jpg only")
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_run_extraction_records_in_flight_before_input_error(tmp_path, parallel):
+    with Manifest(tmp_path / "manifest.sqlite") as manifest:
+        with pytest.raises(FileNotFoundError, match="sa_3.jpg only"):
+            run_extraction(
+                process_slowly, fail_after(10), manifest, "shard", parallel=parallel
+            )
+        assert len(manifest.get_done("shard")) == 10
+
+
+def write_tar(tar_path: Path, input_dir: Path, names: list[str]):
+    with tarfile.open(tar_path, "w") as tar:
+        # Not an image or its annotations, these are ignored.
+        tar.add(input_dir, arcname=".", recursive=False)
+        for name in names:
+            tar.add(input_dir / name, arcname=f"./{name}")
+
+
+@pytest.fixture
+def sa1b_tar(tmp_path, sa1b_dataset) -> Path:
+    """A tar of images sa_1 to sa_4, where sa_3 has no annotations and sa_4 no
+    image."""
+    input_dir = sa1b_dataset(n_images=4, n_annotations=5)
+    tar_path = tmp_path / "sa_000000.tar"
+    names = ["sa_1.jpg", "sa_1.json", "sa_2.json", "sa_2.jpg", "sa_3.jpg"]
+    write_tar(tar_path, input_dir, names + ["sa_4.json"])
+    return tar_path
+
+
+def test_iter_tar_images_pairs_files(sa1b_tar, sa1b_dataset):
+    input_dir = sa1b_dataset(n_images=4, n_annotations=5)
+
+    def read(name: str) -> bytes:
+        return (input_dir / name).read_bytes()
+
+    assert list(iter_tar_images(sa1b_tar, error_on_missing_file=False)) == [
+        ("sa_1", read("sa_1.jpg"), read("sa_1.json")),
+        ("sa_2", read("sa_2.jpg"), read("sa_2.json")),
+        ("sa_3", read("sa_3.jpg"), None),
+        ("sa_4", None, read("sa_4.json")),
+    ]
+
+    tar_images = iter_tar_images(
+        sa1b_tar, skip={"sa_1", "sa_3"}, error_on_missing_file=False
+    )
+    assert [name for name, _, _ in tar_images] == ["sa_2", "sa_4"]
+
+    tar_images = iter_tar_images(sa1b_tar)
+    assert [name for name, _, _ in itertools.islice(tar_images, 2)] == ["sa_1", "sa_2"]
+    with pytest.raises(FileNotFoundError, match="sa_3.jpg only"):
+        next(tar_images)
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_main_from_tar_records_unpaired_files(tmp_path, sa1b_tar, parallel):
+    output_dir = tmp_path / "cutouts"
+
+    def extract(**kwargs) -> dict[str, int]:
+        main_from_tar(sa1b_tar, output_dir, 10, parallel=parallel, **kwargs)
+        return get_n_images_per_status()
+
+    def get_n_images_per_status() -> dict[str, int]:
+        with Manifest(output_dir / MANIFEST_FILENAME) as manifest:
+            return manifest.get_n_images_per_status("sa_000000")
+
+    # The images before the unpaired files are recorded all the same, and
+    # skipped when it's run again.
+    for _ in range(2):
+        with pytest.raises(FileNotFoundError, match="sa_3.jpg only"):
+            extract()
+        assert get_n_images_per_status() == {STATUS_DONE: 2}
+
+    expected = {STATUS_DONE: 2, STATUS_MISSING: 2}
+    assert extract(error_on_missing_file=False) == expected
+    # Now that all are recorded, nothing is left to raise about.
+    assert extract() == expected
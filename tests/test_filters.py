@@ -0,0 +1,185 @@
+import itertools
+
+import numpy as np
+from PIL import Image
+import pytest
+import skimage.draw
+
+from segmentation import cutting, filters
+
+SIZE = 300
+
+
+def to_image(mask: np.ndarray) -> Image.Image:
+    data = np.zeros((*mask.shape, 4), dtype=np.uint8)
+    data[..., 3] = mask * 255
+    return Image.fromarray(data)
+
+
+def stroke(points: list[tuple[float, float]], radius: float, size=SIZE) -> np.ndarray:
+    """Draws a thick polyline through (y, x) points, with round ends so that
+    they don't look cut off."""
+    mask = np.zeros((size, size), dtype=bool)
+    for (y0, x0), (y1, x1) in itertools.pairwise([points[0], *points]):
+        n_steps = int(max(abs(y1 - y0), abs(x1 - x0))) + 1
+        for y, x in zip(np.linspace(y0, y1, n_steps), np.linspace(x0, x1, n_steps)):
+            mask[skimage.draw.disk((y, x), radius, shape=mask.shape)] = True
+    return mask
+
+
+def staircase(mask: np.ndarray, start: tuple[int, int], step: tuple[int, int], n: int):
+    """Adds single pixels at `start + i * step`."""
+    for i in range(n):
+        mask[start[0] + i * step[0], start[1] + i * step[1]] = True
+
+
+def make_filter_cases(
+    rng: np.random.Generator,
+) -> dict[str, tuple[np.ndarray, str | None]]:
+    """Shapes the filters can get wrong, with their expected decision. The sizes
+    and positions are random, the decisions don't depend on them."""
+    o = rng.integers(0, 30)  # Offset
+    r = rng.integers(8, 15)  # Stroke radius
+    cases = {}
+
+    # A U only connects at the bottom, so its arms are separate components
+    # until then. Its sides are slanted and its bottom round, because long
+    # straight edges at the bbox look cut off.
+    bottom_arc = [
+        (170 + 80 * np.sin(t), 150 - 80 * np.cos(t)) for t in np.linspace(0, np.pi, 20)
+    ]
+    u = stroke([(20 + o, 50), *bottom_arc, (20, 250 - o)], r)
+    cases["u"] = u, None
+    cases["n"] = np.flipud(u), None
+    cases["w"] = (
+        stroke([(30, 20), (260, 80 + o), (40, 140), (260, 200), (30 + o, 270)], r),
+        None,
+    )
+    # Teeth hanging down from an arch, each joining it in a different row
+    cases["comb"] = (
+        np.flipud(u)
+        | stroke([(50, 100), (220 - o, 100)], r)
+        | stroke([(50, 190), (240, 190 + o)], r),
+        None,
+    )
+    ring = np.zeros((SIZE, SIZE), dtype=bool)
+    ring[skimage.draw.disk((150, 150), 140 - o)] = True
+    ring[skimage.draw.disk((150 + o // 2, 150), 60 + o)] = False
+    cases["ring"] = ring, None
+
+    # A single empty row or column between two shapes
+    top = stroke([(30, 60 + o), (120, 200)], r)
+    gap_y = np.flatnonzero(top.any(axis=1))[-1] + 2
+    bottom = stroke([(gap_y + r, 80), (280, 240 - o)], r)
+    bottom[: gap_y + 1] = False
+    cases["empty_row_gap"] = top | bottom, "not_connected"
+    left = stroke([(60 + o, 30), (240, 110)], r)
+    gap_x = np.flatnonzero(left.any(axis=0))[-1] + 2
+    right = stroke([(40, gap_x + r), (260 - o, 270)], r)
+    right[:, : gap_x + 1] = False
+    cases["empty_column_gap"] = left | right, "not_connected"
+
+    # Shapes joined only by pixels touching at their corners, which are
+    # 8-connected, in both diagonal directions
+    for name, start, step in [
+        ("diagonal", (40 + o, 40), (1, 1)),
+        ("antidiagonal", (40 + o, 260), (1, -1)),
+    ]:
+        end = (start[0] + 100 * step[0], start[1] + 100 * step[1])
+        mask = stroke([start], r) | stroke([end], r)
+        staircase(mask, start, step, 101)
+        cases[f"{name}_contact"] = mask, None
+
+        # A knight's move apart is not touching
+        mask = stroke([start], r) | stroke([(end[0], end[1] + step[1])], r)
+        staircase(mask, start, step, 51)
+        staircase(mask, (start[0] + 51, start[1] + 52 * step[1]), step, 50)
+        cases[f"{name}_gap"] = mask, "not_connected"
+
+    # Two pixels that touch diagonally across a row, and a blob above them
+    mask = stroke([(60 + o, 150)], 40)
+    mask[200, 100] = mask[201, 101] = True
+    cases["diagonal_pair"] = mask, "not_connected"
+
+    # Flat edges are cut off if they are wide enough compared to the shape
+    mask = stroke([(150, 150)], 120 - o)
+    mask[: 150 - 50 - o] = False
+    cases["flat_top"] = mask, "cut_off"
+    mask = stroke([(150, 150)], 120 - o)
+    mask[:, 150 + 80 :] = False
+    cases["flat_right"] = mask, "cut_off"
+    # A stem cut flat is narrow compared to the head above it
+    mask = stroke([(100, 150)], 60 + o // 2) | stroke([(100, 150), (280, 150)], 8)
+    mask[250:] = False
+    cases["thin_flat_bottom"] = mask, None
+
+    cases["empty"] = np.zeros((SIZE, SIZE), dtype=bool), "not_connected"
+    mask = np.zeros((SIZE, SIZE), dtype=bool)
+    mask[100 + o, 40:260] = True
+    cases["single_row"] = mask, "cut_off"
+
+    return cases
+
+
+@pytest.fixture(scope="module")
+def filter_cases() -> list[tuple[str, np.ndarray, str | None]]:
+    rng = np.random.default_rng(0)
+    return [
+        (f"{name}_{i}", mask, reason)
+        for i in range(3)
+        for name, (mask, reason) in make_filter_cases(rng).items()
+    ]
+
+
+def test_filter_cases_have_expected_decisions(filter_cases):
+    for name, mask, expected in filter_cases:
+        assert cutting.get_rejection_reason(to_image(mask)) == expected, name
+        assert filters.get_rejection_reason(mask) == expected, name
+
+
+@pytest.mark.parametrize("transform", ["identity", "rotate", "flip", "transpose"])
+def test_filters_match_cutting_on_cases(filter_cases, transform):
+    """Rotated and flipped too, so that every case is met from each side."""
+    transforms = {
+        "identity": lambda mask: mask,
+        "rotate": np.rot90,
+        "flip": np.flipud,
+        "transpose": np.transpose,
+    }
+    masks = np.stack([transforms[transform](mask) for _, mask, _ in filter_cases])
+    expected = [cutting.get_rejection_reason(to_image(mask)) for mask in masks]
+
+    assert [filters.get_rejection_reason(mask) for mask in masks] == expected
+    assert filters.get_rejection_reasons(masks) == expected
+    assert filters.get_rejection_reasons_stacked(masks) == expected
+
+
+def test_filters_match_cutting(example_masks):
+    expected = [cutting.get_rejection_reason(to_image(mask)) for mask in example_masks]
+    # All the decisions are covered
+    assert set(expected) == {None, "cut_off", "not_connected"}
+
+    assert filters.get_rejection_reasons(example_masks) == expected
+    assert filters.get_rejection_reasons_stacked(example_masks) == expected
+
+
+def test_filters_too_small():
+    masks = np.zeros((2, 255, 200), dtype=bool)
+    masks[0, 50:200, 20:180] = True
+    expected = [cutting.get_rejection_reason(to_image(mask)) for mask in masks]
+
+    assert expected == ["too_small", "too_small"]
+    assert filters.get_rejection_reasons(masks) == expected
+    assert filters.get_rejection_reasons_stacked(masks) == expected
+
+
+@pytest.mark.benchmark(group="rejection_reason")
+@pytest.mark.parametrize("implementation", ["image", "mask", "stacked"])
+def test_benchmark_rejection_reason(benchmark, example_masks, implementation):
+    if implementation == "image":
+        images = [to_image(mask) for mask in example_masks]
+        benchmark(lambda: [cutting.get_rejection_reason(image) for image in images])
+    elif implementation == "mask":
+        benchmark(filters.get_rejection_reasons, example_masks)
+    else:
+        benchmark(filters.get_rejection_reasons_stacked, example_masks)
@@ -0,0 +1,113 @@
+import pytest
+
+from segmentation import gcp
+
+
+@pytest.fixture(scope="module")
+def files(tmp_path_factory, example_cutouts, n_files=100):
+    tmp_path = tmp_path_factory.mktemp("files")
+    paths = []
+    for i, cutout in enumerate(example_cutouts * (n_files // 4)):
+        paths.append(tmp_path / f"{i:05d}.webp")
+        cutout.save(paths[-1])
+    return paths
+
+
+@pytest.mark.benchmark(group="upload")
+@pytest.mark.parametrize("pooled", [False, True])
+def test_benchmark_upload(benchmark, files, pooled, latency=0.02):
+    """Uploads to an in-memory backend that simulates the latency of requests,
+    one by one or with the uploader, which also has to retry failed uploads."""
+    if pooled:
+        backend = gcp.InMemoryBackend(latency=latency, fail_every=50)
+
+        def upload():
+            with gcp.Uploader(backend, backoff=latency) as uploader:
+                for path in files:
+                    uploader.submit(path, path.name)
+            return uploader.get_stats()
+    else:
+        backend = gcp.InMemoryBackend(latency=latency)
+
+        def upload():
+            for path in files:
+                backend.upload(path, path.name)
+
+    stats = benchmark.pedantic(upload, rounds=3)
+    assert all(backend.blobs[path.name] == path.read_bytes() for path in files)
+    if pooled:
+        benchmark.extra_info.update(
+            n_retries=stats["n_retries"], max_queue_depth=stats["max_queue_depth"]
+        )
+
+
+@pytest.fixture
+def sleeps(monkeypatch) -> list[float]:
+    """Records the backoff delays instead of waiting them out."""
+    delays = []
+
+    def sleep(seconds: float):
+        if seconds:
+            delays.append(seconds)
+
+    monkeypatch.setattr(gcp.time, "sleep", sleep)
+    return delays
+
+
+def test_uploader_retries_failed_uploads(files, sleeps):
+    # One thread, so that no file hits two failing attempts in a row
+    backend = gcp.InMemoryBackend(fail_every=3)
+    with gcp.Uploader(backend, n_threads=1, max_queue_size=8) as uploader:
+        futures = [uploader.submit(path, path.name) for path in files]
+    stats = uploader.get_stats()
+
+    assert all(future.exception() is None for future in futures)
+    assert all(backend.blobs[path.name] == path.read_bytes() for path in files)
+    assert stats["n_uploaded"] == len(files)
+    assert stats["n_failed"] == 0
+    assert stats["n_retries"] == backend.n_attempts - len(files) > 0
+    assert stats["queue_depth"] == 0
+    assert stats["max_queue_depth"] <= 8
+    # Each file failed at most once, so only the first backoff is used
+    assert sleeps == [1.0] * stats["n_retries"]
+
+
+def test_uploader_flush_raises_after_permanent_failures(files, sleeps):
+    backend = gcp.InMemoryBackend(fail_every=1)
+    uploader = gcp.Uploader(backend, n_threads=2, max_retries=2, backoff=0.5)
+    futures = [uploader.submit(path, path.name) for path in files[:5]]
+
+    with pytest.raises(RuntimeError, match="5 uploads failed") as info:
+        uploader.flush()
+    assert isinstance(info.value.__cause__, ConnectionError)
+    assert all(isinstance(future.exception(), ConnectionError) for future in futures)
+
+    stats = uploader.get_stats()
+    assert stats["n_failed"] == 5
+    assert stats["n_uploaded"] == 0
+    assert stats["n_retries"] == 10
+    assert backend.n_attempts == 15
+    assert sorted(sleeps) == [0.5] * 5 + [1.0] * 5
+    assert not backend.blobs
+
+    # Still reported when closing, which shuts the threads down all the same
+    with pytest.raises(RuntimeError):
+        uploader.close()
+    assert uploader.executor._shutdown
+
+
+def test_uploader_exit_keeps_the_original_exception(files, sleeps):
+    backend = gcp.InMemoryBackend(fail_every=1)
+    with pytest.raises(ValueError, match="in the with block"):
+        with gcp.Uploader(backend, max_retries=1) as uploader:
+            for path in files[:3]:
+                uploader.submit(path, path.name)
+            raise ValueError("in the with block")
+
+    # The uploads were still waited for
+    assert uploader.get_stats()["n_failed"] == 3
+
+    with pytest.raises(RuntimeError, match="3 uploads failed"):
+        with gcp.Uploader(backend, max_retries=1) as uploader:
+            for path in files[:3]:
+                uploader.submit(path, path.name)
@@ -0,0 +1,413 @@
+import itertools
+from pathlib import Path
+import time
+
+import faiss
+import numpy as np
+from PIL import Image
+import pytest
+import skimage.draw
+
+from segmentation import hash_index, shapes
+from segmentation.hash_index import HashIndex
+from segmentation.shards import get_cutout_name
+
+
+def write_cutouts(dir: Path, n: int, seed: int = 0) -> list[str]:
+    """Writes cutouts with random ellipses and returns their names."""
+    rng = np.random.default_rng(seed)
+    dir.mkdir(parents=True, exist_ok=True)
+    names = []
+    for i in range(n):
+        data = np.zeros((64, 64, 4), dtype=np.uint8)
+        rr, cc = skimage.draw.ellipse(
+            32, 32, rng.integers(5, 30), rng.integers(5, 30), shape=(64, 64)
+        )
+        data[rr, cc] = 255
+        name = get_cutout_name(seed, i)
+        Image.fromarray(data).save(dir / name, lossless=True)
+        names.append(name)
+    return names
+
+
+def slow_shape_hash(image):
+    # Slow enough for the pool to fill up its throttle before a failure arrives
+    time.sleep(0.01)
+    return shapes.get_shape_hash(image)
+
+
+def test_corrupt_cutout_fails_instead_of_hanging(tmp_path):
+    names = write_cutouts(tmp_path / "cutouts", 64)
+    # The first one in the order of the index
+    (tmp_path / "cutouts" / names[0]).write_bytes(b"not a webp")
+
+    with pytest.raises(OSError):
+        HashIndex(
+            slow_shape_hash,
+            tmp_path / "hashes.npy",
+            input_dir=tmp_path / "cutouts",
+            n_workers=2,
+            batch_size=4,
+        )
+
+
+def edges_hash(image):
+    return shapes.get_edges_hash(image, size=8)
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+@pytest.mark.parametrize("batch_size", [4, 64])
+def test_compute_hashes_matches_hash_function(tmp_path, n_workers, batch_size):
+    write_cutouts(tmp_path / "cutouts", 30)
+    index = HashIndex(
+        edges_hash,
+        tmp_path / "hashes.npy",
+        input_dir=tmp_path / "cutouts",
+        n_workers=n_workers,
+        batch_size=batch_size,
+    )
+    names = index.get_names()
+    expected = np.array([edges_hash(index.open_image(name)) for name in names])
+
+    assert np.array_equal(index.compute_hashes(names), expected)
+    assert np.array_equal(index.get_hashes(), expected)
+    # Any subset, as long as it's in the order of the index
+    assert np.array_equal(index.compute_hashes(names[5:12]), expected[5:12])
+
+
+def test_update_hashes_only_new_cutouts(tmp_path, capsys):
+    def make_index(hash_function_id="edges"):
+        return HashIndex(
+            edges_hash,
+            tmp_path / "hashes.npy",
+            input_dir=tmp_path / "cutouts",
+            n_workers=1,
+            hash_function_id=hash_function_id,
+        )
+
+    write_cutouts(tmp_path / "cutouts", 10, seed=0)
+    make_index()
+    assert "Hashed 10 new cutouts, kept 0, removed 0." in capsys.readouterr().out
+
+    write_cutouts(tmp_path / "cutouts", 5, seed=1)
+    removed = tmp_path / "cutouts" / get_cutout_name(0, 3)
+    removed.unlink()
+    index = make_index()
+    assert "Hashed 5 new cutouts, kept 9, removed 1." in capsys.readouterr().out
+    assert removed.name not in index.names
+    expected = np.array([edges_hash(index.open_image(name)) for name in index.names])
+    assert np.array_equal(index.get_hashes(), expected)
+
+    make_index()
+    assert "Hashed" not in capsys.readouterr().out
+
+    make_index("edges_v2")
+    out = capsys.readouterr().out
+    assert "hash_function_id has changed" in out
+    assert "Hashed 14 new cutouts, kept 0, removed 0." in out
+
+
+class EdgesHash:
+    def __call__(self, image):
+        return shapes.get_edges_hash(image, size=8)
+
+
+class EdgesHashV2:
+    def __call__(self, image):
+        return shapes.get_edges_hash(image, size=16)
+
+
+def test_hash_function_id_of_callable_objects():
+    get_id = hash_index.get_hash_function_id
+    assert get_id(EdgesHash()) == get_id(EdgesHash())
+    assert get_id(EdgesHash()).startswith(f"{__name__}.EdgesHash:")
+    # The constants in `__call__` are part of the code digest
+    _, digest = get_id(EdgesHash()).split(":")
+    _, digest_v2 = get_id(EdgesHashV2()).split(":")
+    assert digest != digest_v2
+    # Builtins have no code to hash, but still have a name
+    assert get_id(len) == "builtins.len"
+
+
+def test_save_and_load_index(tmp_path):
+    names = write_cutouts(tmp_path / "cutouts", 30)
+
+    def make_index(hash_function_id="edges", index_type="hnsw"):
+        return HashIndex(
+            edges_hash,
+            tmp_path / "hashes.npy",
+            input_dir=tmp_path / "cutouts",
+            n_workers=1,
+            hash_function_id=hash_function_id,
+            index_type=index_type,
+        )
+
+    index = make_index()
+    assert index.index_file.exists()
+    queries = index.get_hashes()[:5]
+
+    loaded = make_index()
+    assert loaded.load_index(names)
+    assert loaded.index.ntotal == 30
+    assert np.array_equal(
+        loaded.index.search(queries, 5)[1], index.index.search(queries, 5)[1]
+    )
+
+    # The persisted index is only used for exactly the rows it was built for,
+    # with the same hash function.
+    assert not loaded.load_index(names[:-1])
+    make_index("edges_v2")
+    assert not loaded.load_index(names)
+    assert make_index().load_index(names)
+
+    # Flat indices are cheap to build, so they are not persisted.
+    flat = make_index(index_type="flat")
+    assert not flat.index_file.exists()
+    assert not flat.load_index(names)
+
+
+@pytest.mark.parametrize("hash_size", [1, 2, 3, 4, 6, 64])
+def test_factory_string_for_small_hashes(hash_size):
+    factory_string = hash_index.get_factory_string("ivf_pq", hash_size, False, 1000)
+    index = faiss.index_factory(hash_size, factory_string)
+    assert index.d == hash_size
+
+
+@pytest.mark.parametrize(
+    "index_type, is_binary, params, match",
+    [
+        ("flat", False, {"nprobe": 8}, "nprobe is only for IVF"),
+        ("hnsw", False, {"nprobe": 8}, "nprobe is only for IVF"),
+        ("flat", True, {"nprobe": 8}, "nprobe is only for IVF"),
+        ("flat", False, {"ef_search": 16}, "ef_search is only for HNSW"),
+        ("ivf_flat", False, {"ef_search": 16}, "ef_search is only for HNSW"),
+        ("ivf_flat", True, {"ef_search": 16}, "ef_search is only for HNSW"),
+    ],
+)
+def test_search_parameters_must_match_index_type(index_type, is_binary, params, match):
+    index = hash_index.make_faiss_index(8, is_binary, index_type)
+    with pytest.raises(ValueError, match=match):
+        hash_index.set_search_parameters(index, **params)
+
+
+@pytest.mark.parametrize("is_binary", [False, True])
+def test_search_parameters_are_set(is_binary):
+    ivf_index = hash_index.make_faiss_index(8, is_binary, "ivf_flat")
+    hash_index.set_search_parameters(ivf_index, nprobe=3)
+    if not is_binary:
+        ivf_index = faiss.extract_index_ivf(ivf_index)
+    assert ivf_index.nprobe == 3
+
+    hnsw_index = hash_index.make_faiss_index(8, is_binary, "hnsw")
+    hash_index.set_search_parameters(hnsw_index, ef_search=7)
+    assert hnsw_index.hnsw.efSearch == 7
+
+
+@pytest.fixture(scope="module")
+def cutouts_dir(tmp_path_factory, random_shapes) -> Path:
+    cutouts_dir = tmp_path_factory.mktemp("cutouts")
+    for i, cutout in enumerate(random_shapes(200)):
+        cutout.save(cutouts_dir / get_cutout_name(i, 0), lossless=True)
+    return cutouts_dir
+
+
+@pytest.fixture(scope="module")
+def edges_index(tmp_path_factory, cutouts_dir) -> HashIndex:
+    cache_file = tmp_path_factory.mktemp("index") / "hashes.npy"
+    return HashIndex(edges_hash, cache_file, input_dir=cutouts_dir)
+
+
+@pytest.mark.benchmark(group="compute_hashes")
+@pytest.mark.parametrize("method", ["sequential", "index"])
+def test_benchmark_compute_hashes(benchmark, edges_index, method):
+    """Computes the hashes one by one in this process and with `HashIndex`."""
+    names = edges_index.get_names()
+
+    def compute_sequentially():
+        images = [edges_index.open_image(name) for name in names]
+        return np.array([edges_hash(image) for image in images])
+
+    if method == "sequential":
+        hashes = benchmark(compute_sequentially)
+    else:
+        hashes = benchmark(edges_index.compute_hashes, names)
+    assert np.array_equal(hashes, edges_index.get_hashes())
+
+
+@pytest.fixture(scope="module")
+def query_images(edges_index) -> list[Image.Image]:
+    images = [edges_index.open_image(name) for name in edges_index.names]
+    for image in images:
+        image.load()
+    return images
+
+
+def test_closest_batch_matches_one_by_one(edges_index, query_images, k=10):
+    one_by_one = [edges_index.get_closest(image, k) for image in query_images]
+    _, indices, names = edges_index.get_closest_batch(query_images, k)
+    _, indices_from_hashes, _ = edges_index.get_closest_batch(
+        edges_index.get_hashes(), k
+    )
+
+    assert np.array_equal(indices, one_by_one)
+    assert np.array_equal(indices, indices_from_hashes)
+    assert names[0] == [edges_index.names[i] for i in indices[0]]
+
+
+@pytest.mark.benchmark(group="closest")
+@pytest.mark.parametrize("method", ["one_by_one", "batch", "hashes"])
+def test_benchmark_closest(benchmark, edges_index, query_images, method, k=10):
+    if method == "one_by_one":
+        benchmark(lambda: [edges_index.get_closest(image, k) for image in query_images])
+    elif method == "batch":
+        benchmark(edges_index.get_closest_batch, query_images, k)
+    else:
+        benchmark(lambda: edges_index.get_closest_batch(edges_index.get_hashes(), k))
+
+
+@pytest.fixture(scope="module")
+def random_bits(n_hashes=5000, n_bits=1024, n_queries=100):
+    """Bit hashes of varying density and queries close to some of them."""
+    rng = np.random.default_rng(0)
+    bits = rng.random((n_hashes, n_bits)) < rng.random((n_hashes, 1))
+    queries = bits[rng.choice(n_hashes, n_queries)]
+    queries ^= rng.random(queries.shape) < 0.05
+    return bits, queries
+
+
+def search_bits(bits, queries, is_binary: bool, k=10):
+    if is_binary:
+        bits, queries = np.packbits(bits, axis=1), np.packbits(queries, axis=1)
+    else:
+        bits, queries = bits.astype(np.float32), queries.astype(np.float32)
+    index = hash_index.make_faiss_index(bits.shape[1], is_binary, "flat", bits)
+    return index, queries
+
+
+def test_binary_search_matches_float(random_bits):
+    """On 0/1 vectors the squared L2 distance is the Hamming distance, so both
+    indices find neighbors at the same distances."""
+    float_index, float_queries = search_bits(*random_bits, is_binary=False)
+    binary_index, binary_queries = search_bits(*random_bits, is_binary=True)
+
+    float_distances, _ = float_index.search(float_queries, 10)
+    binary_distances, _ = binary_index.search(binary_queries, 10)
+    assert np.array_equal(float_distances, binary_distances)
+
+
+@pytest.mark.benchmark(group="search_bits")
+@pytest.mark.parametrize("is_binary", [False, True])
+def test_benchmark_search_bits(benchmark, random_bits, is_binary):
+    index, queries = search_bits(*random_bits, is_binary=is_binary)
+    benchmark(index.search, queries, 10)
+    serialize = faiss.serialize_index_binary if is_binary else faiss.serialize_index
+    benchmark.extra_info["n_bytes"] = len(serialize(index))
+
+
+@pytest.fixture(scope="module")
+def clustered_hashes(n_hashes=20_000, hash_size=64, n_queries=100, k=10):
+    """Hashes clustered like real ones, so that the neighbors mean something,
+    queries and the true neighbors of the queries."""
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(200, hash_size)).astype(np.float32)
+    points = centers[rng.integers(0, len(centers), n_hashes + n_queries)]
+    points += 0.5 * rng.normal(size=points.shape).astype(np.float32)
+    hashes, queries = points[:n_hashes], points[n_hashes:]
+
+    flat_index = hash_index.make_faiss_index(hash_size, False, "flat", hashes)
+    _, true_neighbors = flat_index.search(queries, k)
+    return hashes, queries, true_neighbors
+
+
+@pytest.fixture(scope="module")
+def build_index(clustered_hashes):
+    """Builds an index of each type once, and returns it with its build time."""
+    hashes, _, _ = clustered_hashes
+    built = {}
+
+    def build(index_type: str) -> tuple[faiss.Index, float]:
+        if index_type not in built:
+            start = time.perf_counter()
+            index = hash_index.make_faiss_index(
+                hashes.shape[1], False, index_type, hashes
+            )
+            built[index_type] = index, time.perf_counter() - start
+        return built[index_type]
+
+    return build
+
+
+@pytest.mark.benchmark(group="index_types")
+@pytest.mark.parametrize(
+    "index_type, params",
+    [
+        ("flat", {}),
+        ("hnsw", {"ef_search": 16}),
+        ("hnsw", {"ef_search": 64}),
+        ("ivf_flat", {"nprobe": 1}),
+        ("ivf_flat", {"nprobe": 8}),
+        ("ivf_flat", {"nprobe": 32}),
+        # Training the product quantizer takes most of a minute.
+        pytest.param("ivf_pq", {"nprobe": 8}, marks=pytest.mark.slow),
+        pytest.param("ivf_pq", {"nprobe": 32}, marks=pytest.mark.slow),
+    ],
+)
+def test_benchmark_index_types(
+    benchmark, clustered_hashes, build_index, index_type, params, k=10
+):
+    """Times single queries and records the build time, the recall@k against the
+    flat index, the percentiles of the latencies of single queries and the size
+    of the serialized index."""
+    hashes, queries, true_neighbors = clustered_hashes
+    index, build_seconds = build_index(index_type)
+    hash_index.set_search_parameters(index, **params)
+
+    _, neighbors = index.search(queries, k)
+    recall = np.mean(
+        [
+            len(set(found) & set(true)) / k
+            for found, true in zip(neighbors, true_neighbors)
+        ]
+    )
+    if index_type == "flat":
+        assert recall == 1
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query[np.newaxis], k)
+        latencies.append(time.perf_counter() - start)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+
+    benchmark(index.search, queries[:1], k)
+    benchmark.extra_info.update(
+        build_seconds=build_seconds,
+        recall=recall,
+        p50_ms=p50 * 1e3,
+        p95_ms=p95 * 1e3,
+        p99_ms=p99 * 1e3,
+        n_bytes=len(faiss.serialize_index(index)),
+    )
+
+
+@pytest.mark.benchmark(group="hash_index")
+def test_benchmark_build(benchmark, tmp_path, cutouts_dir):
+    cache_numbers = itertools.count()
+
+    def build_index() -> HashIndex:
+        # A new cache file every time, so that nothing is loaded from a cache
+        cache_file = tmp_path / f"hashes-{next(cache_numbers)}.npy"
+        return HashIndex(shapes.get_shape_hash, cache_file, input_dir=cutouts_dir)
+
+    index = benchmark(build_index)
+    assert len(index.names) == 200
+
+
+@pytest.mark.benchmark(group="hash_index")
+def test_benchmark_query(benchmark, tmp_path, cutouts_dir, random_shapes):
+    index = HashIndex(
+        shapes.get_shape_hash, tmp_path / "hashes.npy", input_dir=cutouts_dir
+    )
+    queries = random_shapes(100, seed=2)
+    _, indices, _ = benchmark(index.get_closest_batch, queries, 10)
+    assert indices.shape == (100, 10)
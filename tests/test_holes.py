@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from segmentation import holes, placement, shapes
+from segmentation.hash_index import HashIndex
+from segmentation.shards import get_cutout_name
+
+
+def shape_hash(image):
+    return shapes.get_shape_hash_float(image, size=8).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory, random_shapes) -> HashIndex:
+    tmp_path = tmp_path_factory.mktemp("holes")
+    (tmp_path / "cutouts").mkdir()
+    for i, cutout in enumerate(random_shapes(200)):
+        cutout.save(tmp_path / "cutouts" / get_cutout_name(i, 0), lossless=True)
+    return HashIndex(
+        shape_hash, tmp_path / "hashes.npy", input_dir=tmp_path / "cutouts"
+    )
+
+
+@pytest.fixture(scope="module")
+def canvas(random_shapes) -> placement.Canvas:
+    rng = np.random.default_rng(0)
+    canvas = placement.Canvas()
+    for cutout in random_shapes(12, seed=1):
+        cutout = cutout.crop(cutout.getbbox())
+        canvas.place_greedily(
+            placement.propose_random_positions(cutout, canvas.size, rng=rng)
+        )
+    return canvas
+
+
+def propose_randomly(canvas, index, n_cutouts: int = 20):
+    """Random cutouts at random positions, like the collage notebook."""
+    rng = np.random.default_rng(0)
+    proposals = []
+    for i in rng.choice(len(index.names), n_cutouts, replace=False):
+        cutout = index.open_image(index.names[i]).convert("RGBA")
+        cutout = cutout.crop(cutout.getbbox())
+        cutout = cutout.resize((cutout.width // 2, cutout.height // 2))
+        proposals += placement.propose_random_positions(
+            cutout, canvas.size, attempts=10, rng=rng
+        )
+    return proposals
+
+
+def test_hole_proposals_are_feasible(canvas, index):
+    proposals = holes.propose_for_holes(canvas.mask, index)
+    assert proposals
+    for cutout, position in proposals:
+        assert not canvas.has_overlap(cutout, position)
+
+
+@pytest.mark.benchmark(group="holes")
+@pytest.mark.parametrize("propose", ["random", "holes"])
+def test_benchmark_holes(benchmark, canvas, index, propose):
+    """Proposes and places the tightest proposal. Records how many proposals
+    there are and how much of the canvas the placed cutout covers."""
+    canvas_image = canvas.to_image()
+
+    def propose_and_place():
+        if propose == "random":
+            proposals = propose_randomly(canvas, index)
+        else:
+            proposals = holes.propose_for_holes(canvas.mask, index)
+        # Nearly every proposal is of a different cutout
+        placed = placement.place_best_tightness_locally(canvas_image, proposals)
+        return proposals, placed
+
+    proposals, placed = benchmark.pedantic(propose_and_place, rounds=3)
+    n_feasible = sum(
+        not canvas.has_overlap(cutout, position) for cutout, position in proposals
+    )
+    added = (
+        0 if placed is None else placement.to_mask(placed).mean() - canvas.mask.mean()
+    )
+    benchmark.extra_info.update(
+        n_proposals=len(proposals), n_feasible=n_feasible, added_coverage=added
+    )
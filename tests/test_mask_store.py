@@ -0,0 +1,41 @@
+import numpy as np
+from PIL import Image
+import pytest
+
+from segmentation import loading, mask_store
+from segmentation.placement import to_mask
+from segmentation.shards import get_cutout_name
+
+
+@pytest.fixture(scope="module")
+def cutouts_dir(tmp_path_factory, example_cutouts, n_cutouts=200):
+    cutouts_dir = tmp_path_factory.mktemp("cutouts")
+    for i, cutout in enumerate(example_cutouts * (n_cutouts // 4)):
+        cutout.save(cutouts_dir / get_cutout_name(i, 0))
+    return cutouts_dir
+
+
+@pytest.fixture(scope="module")
+def store(tmp_path_factory, cutouts_dir) -> mask_store.MaskStore:
+    store_dir = tmp_path_factory.mktemp("masks")
+    mask_store.build_mask_store(cutouts_dir, store_dir)
+    return mask_store.MaskStore(store_dir)
+
+
+def decode(paths) -> np.ndarray:
+    return np.stack([to_mask(Image.open(path)) for path in paths])
+
+
+def test_mask_store_matches_decoding(cutouts_dir, store):
+    assert np.array_equal(store[:], decode(loading.images_in_dir(cutouts_dir)))
+
+
+@pytest.mark.benchmark(group="mask_store")
+@pytest.mark.parametrize("method", ["decode", "store", "batch"])
+def test_benchmark_mask_store(benchmark, cutouts_dir, store, method):
+    if method == "decode":
+        benchmark(decode, list(loading.images_in_dir(cutouts_dir)))
+    elif method == "store":
+        benchmark(lambda: [store[i] for i in range(len(store))])
+    else:
+        benchmark(lambda: store[:])
@@ -0,0 +1,50 @@
+from PIL import Image
+import pytest
+
+from segmentation import escherize, optimization
+
+
+@pytest.fixture(scope="module")
+def tiling_problem(example_cutouts):
+    """A scorer, the configs of the 32px grid and their indices, best first."""
+    canvas = Image.new("RGBA", (256, 256), 0)
+    scorer = escherize.TilingScorer(canvas, example_cutouts[0])
+    configs = list(escherize.iter_configs())
+    scores = [scorer(config) for config in configs]
+    order = sorted(range(len(configs)), key=lambda i: -scores[i])
+    return scorer, configs, order
+
+
+@pytest.mark.benchmark(group="select_top_k")
+@pytest.mark.parametrize("executor", optimization.EXECUTORS)
+def test_benchmark_select_top_k(benchmark, tiling_problem, executor, k=5):
+    """All executors find the same top k as sorting all the scores. On one core,
+    the pools only add overhead."""
+    scorer, configs, order = tiling_problem
+    top = benchmark.pedantic(
+        optimization.select_top_k,
+        args=(configs, scorer),
+        kwargs={"k": k, "executor": executor, "n_workers": 2},
+        rounds=3,
+    )
+    assert [config for config, _ in top] == [configs[i] for i in order[:k]]
+
+
+def test_select_best_stops_at_target_score(tiling_problem):
+    scorer, configs, order = tiling_problem
+    n_evaluations = 0
+
+    def counting_scorer(config: escherize.TilingConfig) -> float:
+        nonlocal n_evaluations
+        n_evaluations += 1
+        return scorer(config)
+
+    best, _ = optimization.select_best(
+        configs,
+        counting_scorer,
+        target_score=scorer(configs[order[0]]),
+        batch_size=16,
+    )
+    assert best == configs[order[0]]
+    # Stops after the batch with the best config
+    assert n_evaluations == (order[0] // 16 + 1) * 16
@@ -0,0 +1,190 @@
+import numpy as np
+from PIL import Image
+import pytest
+import skimage.draw
+
+from segmentation import placement
+
+
+def make_ellipse(size: int, rng: np.random.Generator) -> Image.Image:
+    data = np.zeros((size, size, 4), dtype=np.uint8)
+    rr, cc = skimage.draw.ellipse(
+        size // 2,
+        size // 2,
+        rng.integers(4, size // 2),
+        rng.integers(4, size // 2),
+        shape=(size, size),
+        rotation=rng.uniform(0, np.pi),
+    )
+    data[rr, cc] = 255
+    return Image.fromarray(data)
+
+
+def place_one_by_one(canvas, proposals):
+    best = None
+    best_tightness = -np.inf
+    for cutout, (x, y) in proposals:
+        if not (
+            0 <= x <= canvas.width - cutout.width
+            and 0 <= y <= canvas.height - cutout.height
+        ):
+            continue
+        expanded = placement.expand_cutout_canvas(cutout, (x, y), canvas.size)
+        if not placement.has_overlap(canvas, expanded):
+            tightness = placement.get_tightness(canvas, expanded)
+            if tightness > best_tightness:
+                best, best_tightness = expanded, tightness
+    return placement.place_image(canvas, best) if best is not None else None
+
+
+@pytest.mark.parametrize(
+    "place",
+    [placement.place_best_tightness, placement.place_best_tightness_locally],
+)
+@pytest.mark.parametrize("n_cutouts", [1, 20])
+def test_place_best_tightness_matches_one_by_one(place, n_cutouts):
+    rng = np.random.default_rng(n_cutouts)
+    canvas = Image.new("RGBA", (128, 96))
+    for _ in range(4):
+        canvas = placement.place_tightest(canvas, make_ellipse(32, rng))
+
+    cutouts = [make_ellipse(24, rng) for _ in range(n_cutouts)]
+    proposals = [
+        (cutouts[i % n_cutouts], (int(x), int(y)))
+        # Including positions that touch the edges or stick out of the canvas
+        for i, (x, y) in enumerate(rng.integers(-4, [110, 78], size=(60, 2)))
+    ]
+
+    expected = place_one_by_one(canvas, proposals)
+    placed = place(canvas, proposals)
+    assert expected is not None
+    assert np.array_equal(np.array(placed), np.array(expected))
+
+
+@pytest.fixture(scope="module")
+def crowded_canvas(random_shapes):
+    """A canvas with a few shapes placed as tightly as possible, another shape
+    and 20 random positions for it."""
+    cutouts = [cutout.resize((128, 128), Image.NEAREST) for cutout in random_shapes(6)]
+    canvas = Image.new("RGBA", placement.CANVAS_SIZE)
+    for cutout in cutouts[:5]:
+        canvas = placement.place_tightest(canvas, cutout)
+    cutout = cutouts[5]
+
+    rng = np.random.default_rng(0)
+    proposals = list(placement.propose_random_positions(cutout, canvas.size, 20, rng))
+    return canvas, cutout, proposals
+
+
+def test_tightness_map_matches_get_tightness(crowded_canvas):
+    canvas, cutout, proposals = crowded_canvas
+    tightness_map = placement.get_tightness_map(canvas, cutout)
+    for _, (x, y) in proposals:
+        expanded = placement.expand_cutout_canvas(cutout, (x, y))
+        assert tightness_map[y, x] == placement.get_tightness(canvas, expanded)
+
+
+def test_overlap_map_matches_placing_everywhere(random_shapes):
+    cutouts = [cutout.resize((64, 64), Image.NEAREST) for cutout in random_shapes(2)]
+    canvas = Image.new("RGBA", (160, 128))
+    canvas = placement.place_image(canvas, cutouts[0], (40, 30))
+    overlap_map = placement.get_overlap_map(canvas, cutouts[1])
+
+    assert overlap_map.shape == (128 - 64 + 1, 160 - 64 + 1)
+    for y in range(0, overlap_map.shape[0], 3):
+        for x in range(0, overlap_map.shape[1], 3):
+            expanded = placement.expand_cutout_canvas(cutouts[1], (x, y), canvas.size)
+            overlap = np.sum(placement.to_mask(canvas) & placement.to_mask(expanded))
+            assert overlap_map[y, x] == overlap
+
+
+@pytest.mark.benchmark(group="place_best_tightness")
+@pytest.mark.parametrize("method", ["one_by_one", "maps", "locally", "tightest"])
+def test_benchmark_place_best_tightness(benchmark, crowded_canvas, method):
+    """Finds the tightest of the proposals one by one on the whole canvas, from
+    the maps and only around the cutout. "tightest" finds the tightest of all
+    positions instead."""
+    canvas, cutout, proposals = crowded_canvas
+    if method == "one_by_one":
+        placed = benchmark.pedantic(place_one_by_one, (canvas, proposals), rounds=3)
+    elif method == "maps":
+        placed = benchmark(placement.place_best_tightness, canvas, proposals)
+    elif method == "locally":
+        placed = benchmark(placement.place_best_tightness_locally, canvas, proposals)
+    else:
+        placed = benchmark(placement.place_tightest, canvas, cutout)
+    assert placed is not None
+
+
+def fill_image(cutouts, tightest: bool) -> Image.Image:
+    rng = np.random.default_rng(0)
+    canvas = Image.new("RGBA", placement.CANVAS_SIZE)
+    for cutout in cutouts:
+        if tightest:
+            placed = placement.place_tightest(canvas, cutout)
+        else:
+            proposals = placement.propose_random_positions(cutout, canvas.size, rng=rng)
+            placed = placement.place_greedily(canvas, proposals)
+        canvas = placed if placed is not None else canvas
+    return canvas
+
+
+def fill_canvas(cutouts, tightest: bool) -> Image.Image:
+    rng = np.random.default_rng(0)
+    canvas = placement.Canvas()
+    for cutout in cutouts:
+        if tightest:
+            canvas.place_tightest(cutout)
+        else:
+            canvas.place_greedily(
+                placement.propose_random_positions(cutout, canvas.size, rng=rng)
+            )
+    return canvas.to_image()
+
+
+@pytest.fixture(scope="module")
+def small_cutouts(random_shapes):
+    return [cutout.resize((64, 64), Image.NEAREST) for cutout in random_shapes(100)]
+
+
+@pytest.mark.parametrize("tightest", [False, True])
+def test_canvas_matches_image(small_cutouts, tightest):
+    assert np.array_equal(
+        np.array(fill_image(small_cutouts, tightest)),
+        np.array(fill_canvas(small_cutouts, tightest)),
+    )
+
+
+@pytest.mark.benchmark(group="fill")
+@pytest.mark.parametrize("tightest", [False, True])
+@pytest.mark.parametrize("fill", [fill_image, fill_canvas])
+def test_benchmark_fill(benchmark, small_cutouts, fill, tightest):
+    benchmark(fill, small_cutouts, tightest)
+    benchmark.extra_info["n_cutouts"] = len(small_cutouts)
+
+
+@pytest.mark.benchmark(group="fill_feasible")
+@pytest.mark.parametrize("feasible", [False, True])
+def test_benchmark_fill_feasible(benchmark, random_shapes, feasible):
+    """Fills a canvas, proposing random and only feasible positions. Random
+    proposals give up after 100 attempts, so they also place fewer cutouts once
+    the canvas gets crowded."""
+    cutouts = [cutout.resize((128, 128), Image.NEAREST) for cutout in random_shapes(50)]
+
+    def fill() -> int:
+        rng = np.random.default_rng(0)
+        canvas = placement.Canvas()
+        n_placed = 0
+        for cutout in cutouts:
+            if feasible:
+                proposals = placement.propose_feasible_positions(
+                    cutout, canvas.mask, attempts=1, rng=rng
+                )
+            else:
+                proposals = placement.propose_random_positions(
+                    cutout, canvas.size, rng=rng
+                )
+            n_placed += canvas.place_greedily(proposals) is not None
+        return n_placed
+
+    benchmark.extra_info["n_placed"] = benchmark(fill)
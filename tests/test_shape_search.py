@@ -0,0 +1,74 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from segmentation import mask_store, shape_search, shapes
+from segmentation.hash_index import HashIndex
+from segmentation.shards import get_cutout_name
+
+N_CUTOUTS = 500
+
+
+def shape_hash(image):
+    return shapes.get_shape_hash_float(image, size=8).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory, random_shapes) -> tuple[HashIndex, Path]:
+    """A hash index of random shapes and the mask store of the same cutouts."""
+    tmp_path = tmp_path_factory.mktemp("shape_search")
+    cutouts_dir = tmp_path / "cutouts"
+    cutouts_dir.mkdir()
+    for i, cutout in enumerate(random_shapes(N_CUTOUTS)):
+        cutout.save(cutouts_dir / get_cutout_name(i, 0), lossless=True)
+    mask_store.build_mask_store(cutouts_dir, tmp_path / "masks")
+
+    index = HashIndex(shape_hash, tmp_path / "hashes.npy", input_dir=cutouts_dir)
+    return index, tmp_path / "masks"
+
+
+@pytest.fixture(scope="module")
+def queries(random_shapes):
+    return random_shapes(20, seed=1)
+
+
+@pytest.fixture(scope="module")
+def exact(corpus, queries, k=10):
+    store = mask_store.open_mask_store(corpus[1])
+    return [shape_search.search_exhaustively(store, query, k) for query in queries]
+
+
+@pytest.mark.parametrize("use_mask_store", [False, True])
+def test_reranking_all_cutouts_is_exact(corpus, queries, exact, use_mask_store):
+    index, masks_dir = corpus
+    search = shape_search.ShapeSearch(
+        index, masks_dir if use_mask_store else None, n_candidates=N_CUTOUTS
+    )
+    for (ious, _), (true_ious, _) in zip(search.search_batch(queries, 10), exact):
+        assert np.allclose(ious, true_ious)
+
+
+@pytest.mark.benchmark(group="shape_search")
+@pytest.mark.parametrize("n_candidates", [None, 50, 200])
+def test_benchmark_shape_search(benchmark, corpus, queries, exact, n_candidates):
+    """Re-ranks the hash candidates by IoU, or compares every mask if
+    `n_candidates` is None. Records the recall, the fraction of the exact top k
+    by IoU that the search finds."""
+    index, masks_dir = corpus
+    if n_candidates is None:
+        store = mask_store.open_mask_store(masks_dir)
+        results = benchmark(
+            lambda: [shape_search.search_exhaustively(store, q, 10) for q in queries]
+        )
+    else:
+        search = shape_search.ShapeSearch(index, masks_dir, n_candidates=n_candidates)
+        results = benchmark(search.search_batch, queries, 10)
+
+    # Compare IoUs rather than names, the order of ties is arbitrary.
+    benchmark.extra_info["recall"] = np.mean(
+        [
+            np.mean(found_ious >= true_ious[-1] - 1e-9)
+            for (found_ious, _), (true_ious, _) in zip(results, exact)
+        ]
+    )
@@ -0,0 +1,14 @@
+import pytest
+
+from segmentation import shapes
+
+
+@pytest.mark.benchmark(group="shape_hash")
+@pytest.mark.parametrize(
+    "hash_function",
+    [shapes.get_shape_hash, shapes.get_shape_hash_float, shapes.get_edges_hash],
+)
+def test_benchmark_shape_hash(benchmark, random_shapes, hash_function):
+    cutouts = random_shapes(20)
+    hashes = benchmark(lambda: [hash_function(cutout) for cutout in cutouts])
+    assert len({hash.tobytes() for hash in hashes}) == len(cutouts)
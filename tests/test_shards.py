@@ -0,0 +1,96 @@
+import numpy as np
+from PIL import Image
+import pytest
+
+from segmentation import loading, shards
+
+
+@pytest.fixture(scope="module")
+def cutout_dirs(tmp_path_factory, example_cutouts, n_cutouts=500):
+    """The same cutouts as loose files and in shards."""
+    tmp_path = tmp_path_factory.mktemp("shards")
+    files_dir, shards_dir = tmp_path / "files", tmp_path / "shards"
+    files_dir.mkdir()
+    encoded = [shards.encode_cutout(cutout) for cutout in example_cutouts]
+    with shards.ShardWriter(shards_dir, max_shard_size=1 << 20) as writer:
+        for i in range(n_cutouts):
+            data = encoded[i % len(encoded)]
+            (files_dir / shards.get_cutout_name(i, 0)).write_bytes(data)
+            writer.write(i, 0, data)
+    return files_dir, shards_dir
+
+
+def read_files(files_dir):
+    return [path.read_bytes() for path in loading.images_in_dir(files_dir)]
+
+
+def read_shards(shards_dir):
+    with shards.ShardReader(shards_dir) as reader:
+        return [data for _, data in reader.iter_bytes()]
+
+
+def test_shards_hold_the_same_cutouts(cutout_dirs):
+    files_dir, shards_dir = cutout_dirs
+    assert len(shards.get_shard_paths(shards_dir)) > 1
+    assert read_files(files_dir) == read_shards(shards_dir)
+
+
+@pytest.mark.parametrize("image_index", [0, 1, 137, 499])
+def test_random_access(cutout_dirs, image_index):
+    files_dir, shards_dir = cutout_dirs
+    path = files_dir / shards.get_cutout_name(image_index, 0)
+    with shards.ShardReader(shards_dir) as reader:
+        assert reader.get_bytes(image_index, 0) == path.read_bytes()
+        assert np.array_equal(
+            np.array(reader[image_index, 0]), np.array(Image.open(path))
+        )
+
+
+@pytest.mark.parametrize("key", [(500, 0), (3, 1), (-1, 0)])
+def test_missing_cutout_raises_key_error(cutout_dirs, key):
+    _, shards_dir = cutout_dirs
+    with shards.ShardReader(shards_dir) as reader:
+        with pytest.raises(KeyError):
+            reader.get_bytes(*key)
+        with pytest.raises(KeyError):
+            reader[key]
+
+
+def test_last_write_wins(tmp_path):
+    with shards.ShardWriter(tmp_path) as writer:
+        writer.write(1, 0, b"first")
+        writer.write(2, 0, b"second")
+        writer.write(1, 0, b"first again")
+    # A resumed run continues with a new shard.
+    with shards.ShardWriter(tmp_path) as writer:
+        writer.write(2, 0, b"second again")
+
+    assert len(shards.get_shard_paths(tmp_path)) == 2
+    with shards.ShardReader(tmp_path) as reader:
+        assert reader.keys() == [(1, 0), (2, 0)]
+        assert reader.get_bytes(1, 0) == b"first again"
+        assert reader.get_bytes(2, 0) == b"second again"
+        assert [data for _, data in reader.iter_bytes()] == [
+            b"first again",
+            b"second again",
+        ]
+
+
+def test_open_image_from_shards(cutout_dirs):
+    files_dir, shards_dir = cutout_dirs
+    for image_index in [0, 42, 499]:
+        name = shards.get_cutout_name(image_index, 0)
+        image = loading.open_image(shards_dir, name)
+        assert np.array_equal(
+            np.array(image), np.array(loading.open_image(files_dir, name))
+        )
+
+
+@pytest.mark.benchmark(group="read_cutouts")
+@pytest.mark.parametrize("source", ["files", "shards"])
+def test_benchmark_read_cutouts(benchmark, cutout_dirs, source):
+    files_dir, shards_dir = cutout_dirs
+    if source == "files":
+        benchmark(read_files, files_dir)
+    else:
+        benchmark(read_shards, shards_dir)